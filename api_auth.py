@@ -1,12 +1,46 @@
 from functools import wraps
 from flask import request, jsonify, g
 from models import User
+import api_tokens
 import logging
 
+# Error bodies shared with the ASGI API so both surfaces answer identically
+MISSING_TOKEN_ERROR = {
+    'error': 'Missing or invalid Authorization header',
+    'message': 'Please provide a valid Bearer token'
+}
+INVALID_TOKEN_ERROR = {
+    'error': 'Invalid token',
+    'message': 'The provided token is invalid or expired'
+}
+MANAGE_WORKMEN_ERROR = {
+    'error': 'Insufficient permissions',
+    'message': 'This operation requires supervisor or admin privileges'
+}
+CLOCK_WORKMEN_ERROR = {
+    'error': 'Insufficient permissions',
+    'message': 'This operation requires employee, supervisor or admin privileges'
+}
 
-def extract_bearer_token():
-    """Extract bearer token from Authorization header"""
-    auth_header = request.headers.get('Authorization')
+
+def role_error(required_roles):
+    """Error body for a user lacking one of the required roles"""
+    return {
+        'error': 'Insufficient permissions',
+        'message': f'This operation requires one of: {", ".join(required_roles)}'
+    }
+
+
+def rate_limit_error(retry_after):
+    """Error body for a login or token request refused by the rate limiter"""
+    return {
+        'error': 'Too many attempts',
+        'message': f'Please try again in {retry_after} seconds'
+    }
+
+
+def parse_bearer_token(auth_header):
+    """Return the token from an Authorization header value, if any"""
     if not auth_header:
         return None
     
@@ -16,24 +50,27 @@ def extract_bearer_token():
     return auth_header[7:]  # Remove 'Bearer ' prefix
 
 
+def extract_bearer_token():
+    """Extract bearer token from Authorization header"""
+    return parse_bearer_token(request.headers.get('Authorization'))
+
+
 def require_api_token(f):
     """Decorator to require valid API token for route access"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        token = extract_bearer_token()
-        
-        if not token:
-            return jsonify({
-                'error': 'Missing or invalid Authorization header',
-                'message': 'Please provide a valid Bearer token'
-            }), 401
-        
-        user = User.find_by_token(token)
-        if not user:
-            return jsonify({
-                'error': 'Invalid token',
-                'message': 'The provided token is invalid or expired'
-            }), 401
+        # Operations of an API batch were authenticated once, by the batch (api_batch.py)
+        user = g.get('api_batch_user')
+        if user is None:
+            token = extract_bearer_token()
+            
+            if not token:
+                return jsonify(MISSING_TOKEN_ERROR), 401
+            
+            user = User.find_by_token(token)
+            if not user:
+                return jsonify(INVALID_TOKEN_ERROR), 401
+            api_tokens.record_use(token)
         
         # Set the current user for the request
         g.current_user = user
@@ -54,10 +91,7 @@ def require_api_role(required_roles):
             user = g.current_user
             
             if user.role.value not in required_roles:
-                return jsonify({
-                    'error': 'Insufficient permissions',
-                    'message': f'This operation requires one of: {", ".join(required_roles)}'
-                }), 403
+                return jsonify(role_error(required_roles)), 403
             
             return f(*args, **kwargs)
         return decorated_function
@@ -72,10 +106,7 @@ def require_api_manage_workmen(f):
         user = g.current_user
         
         if not user.can_manage_workmen():
-            return jsonify({
-                'error': 'Insufficient permissions',
-                'message': 'This operation requires supervisor or admin privileges'
-            }), 403
+            return jsonify(MANAGE_WORKMEN_ERROR), 403
         
         return f(*args, **kwargs)
     return decorated_function
@@ -89,10 +120,7 @@ def require_api_clock_workmen(f):
         user = g.current_user
         
         if not user.can_clock_workmen():
-            return jsonify({
-                'error': 'Insufficient permissions',
-                'message': 'This operation requires employee, supervisor or admin privileges'
-            }), 403
+            return jsonify(CLOCK_WORKMEN_ERROR), 403
         
         return f(*args, **kwargs)
     return decorated_function
\ No newline at end of file
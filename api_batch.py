@@ -0,0 +1,179 @@
+"""Several API calls in one HTTP round trip.
+
+``POST /api/v1/batch`` takes an ordered list of operations::
+
+    {"atomic": false,
+     "operations": [{"id": "me", "method": "GET", "path": "/api/v1/me"},
+                    {"method": "POST", "path": "/workmen/T1/clock-in", "body": {}}]}
+
+Paths may be given with or without the /api/v1 prefix. Each operation is
+dispatched to the normal api_bp view with its own request and app context
+(so per-request hooks, metrics and query audits see it as a request of its
+own). The bearer token is checked once for the whole batch, and every
+operation runs on the same database session.
+
+With ``atomic`` the operations also share one transaction. The commits
+done by the views only release savepoints. The batch stops at the first
+operation answering 4xx or 5xx and rolls everything back; otherwise it
+commits once at the end. The clock ledger and background jobs use their own
+connections, so clock events and job starts of an atomic batch are held back
+until after the commit. Atomic batches need a single database and are
+refused when company sharding is enabled.
+"""
+import logging
+from flask import current_app, g, jsonify, request
+from werkzeug.test import EnvironBuilder
+from app import db
+import clock_ledger
+import jobs
+import sharding
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/api/v1'
+BATCH_PATH = f'{API_PREFIX}/batch'
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+# Response headers worth passing back to the client per operation
+RESULT_HEADERS = ('Location', 'Retry-After')
+# Request headers not copied to the operations; their bodies are built anew
+_SKIPPED_HEADERS = {'content-type', 'content-length'}
+
+NOT_RUN_STATUS = 424
+
+
+class BatchError(ValueError):
+    """The batch is malformed and nothing was run"""
+
+
+def parse_operations(data):
+    """Validated (id, method, path, body) tuples of a batch request body"""
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise BatchError('operations must be a non-empty list')
+    limit = current_app.config['API_BATCH_MAX_OPERATIONS']
+    if len(operations) > limit:
+        raise BatchError(f'A batch can hold at most {limit} operations')
+
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or not isinstance(operation.get('path'), str):
+            raise BatchError(f'Operation {index} needs a path')
+        method = str(operation.get('method', 'GET')).upper()
+        if method not in METHODS:
+            raise BatchError(f"Operation {index}: method must be one of {', '.join(METHODS)}")
+        path = operation['path']
+        if not path.startswith(f'{API_PREFIX}/'):
+            path = f"{API_PREFIX}/{path.lstrip('/')}"
+        if path.split('?', 1)[0].rstrip('/') == BATCH_PATH:
+            raise BatchError(f'Operation {index}: batches cannot be nested')
+        parsed.append((operation.get('id'), method, path, operation.get('body')))
+    return parsed
+
+
+def _result(operation_id, status, body, headers=None):
+    result = {'id': operation_id} if operation_id is not None else {}
+    result.update(status=status, body=body)
+    if headers:
+        result['headers'] = headers
+    return result
+
+
+def _response_result(operation_id, response):
+    body = response.get_json(silent=True) if response.is_json else response.get_data(as_text=True)
+    headers = {name: response.headers[name] for name in RESULT_HEADERS if name in response.headers}
+    return _result(operation_id, response.status_code, body, headers)
+
+
+def _dispatch(session, carried, method, path, body):
+    """Run one operation as its own request on the shared session"""
+    app = current_app._get_current_object()
+    headers = [(name, value) for name, value in request.headers if name.lower() not in _SKIPPED_HEADERS]
+    builder = EnvironBuilder(path=path, method=method, headers=headers, base_url=request.host_url,
+                             json=body if body is not None and method != 'GET' else None,
+                             environ_base={'REMOTE_ADDR': request.remote_addr})
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+
+    # A fresh app context gives the operation its own g; the session is handed over
+    # and taken back before teardown, which would otherwise close it
+    with app.app_context():
+        db.session.registry.set(session)
+        for name, value in carried.items():
+            setattr(g, name, value)
+        try:
+            with app.request_context(environ):
+                try:
+                    response = app.full_dispatch_request()
+                except Exception:
+                    logger.exception("Batch operation %s %s failed", method, path,
+                                     extra={'method': method, 'path': path})
+                    session.rollback()
+                    response = jsonify({'error': 'Internal server error'})
+                    response.status_code = 500
+            # Later operations must read this one's writes from the primary
+            if g.get('db_wrote'):
+                carried['db_wrote'] = True
+        finally:
+            db.session.registry.clear()
+    return response
+
+
+def run_batch(operations, user, atomic=False):
+    """Run parsed operations in order as ``user``; returns the JSON-ready envelope"""
+    if atomic and sharding.enabled():
+        raise BatchError('Atomic batches are not available while company sharding is enabled')
+
+    # Every operation is authenticated as the user the batch was authenticated as
+    carried = {'api_batch_user': user}
+    connection = transaction = None
+    deferred_events, deferred_jobs = [], []
+    if atomic:
+        # Lists shared by every operation's g (clock_ledger.record and jobs.submit append to them)
+        carried['clock_events_deferred'] = deferred_events
+        carried['jobs_deferred'] = deferred_jobs
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        if connection.dialect.name == 'sqlite':
+            # pysqlite defers BEGIN, and releasing the first savepoint would then commit
+            connection.exec_driver_sql('BEGIN')
+        session = db.session.session_factory(bind=connection, join_transaction_mode='create_savepoint')
+    else:
+        session = db.session()
+
+    results = []
+    failed = completed = committed = False
+    try:
+        for operation_id, method, path, body in operations:
+            if failed:
+                results.append(_result(operation_id, NOT_RUN_STATUS, {'error': 'Not run, an earlier operation failed'}))
+                continue
+            response = _dispatch(session, carried, method, path, body)
+            results.append(_response_result(operation_id, response))
+            failed = atomic and response.status_code >= 400
+        completed = True
+    finally:
+        if atomic:
+            session.close()
+            if completed and not failed and transaction.is_active:
+                transaction.commit()
+                committed = True
+            else:
+                transaction.rollback()
+            connection.close()
+
+    if committed:
+        for clock_event in deferred_events:
+            clock_ledger.ledger().record(clock_event)
+        for job_id in deferred_jobs:
+            jobs.dispatch(job_id)
+
+    if carried.get('db_wrote'):
+        g.db_wrote = True
+    logger.info("Ran batch of %s operations for %s", len(operations), user.username,
+                extra={'operations': len(operations), 'atomic': atomic, 'failed': failed})
+    envelope = {'atomic': atomic, 'results': results}
+    if atomic:
+        envelope['committed'] = committed
+    return envelope
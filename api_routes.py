@@ -1,10 +1,37 @@
-from flask import Blueprint, request, jsonify, g
-from app import app, db
-from models import User, Workman, TimeEntry, UserRole
-from api_auth import require_api_token, require_api_role, require_api_manage_workmen, require_api_clock_workmen
+from flask import Blueprint, current_app, request, jsonify, g
+from app import db
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+from models import User, ApiToken, Workman, TimeEntry, UserRole, Company, Location
+from api_auth import (require_api_token, require_api_role, require_api_manage_workmen, require_api_clock_workmen,
+                      extract_bearer_token, rate_limit_error)
+from serializers import (serialize_user, serialize_user_with_permissions, serialize_workman,
+                         serialize_workman_detail, serialize_time_entry, serialize_time_entries, serialize_job)
+from collections import Counter
 from datetime import datetime
+import heapq
+import api_batch
+import api_tokens
+import archive
+import attendance
+import clock_ledger
+import edge
+import stale_entries
+import slow_queries
+import profiler
+import provisioning
+import jobs
+import rate_limit
+import reporting
+import sharding
+import snapshots
+import workman_deletion
+from query_audit import query_budget
 import logging
 
+logger = logging.getLogger(__name__)
+clock_logger = logging.getLogger('workmen.clock')
+
 # Create API blueprint
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
@@ -23,39 +50,42 @@ def generate_token():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
+    # Refuse before the deliberately slow password hash runs
+    retry_after = rate_limit.check_credentials_attempt(username)
+    if retry_after:
+        return jsonify(rate_limit_error(retry_after)), 429, {'Retry-After': str(retry_after)}
+    
     user = User.query.filter_by(username=username).first()
-    if not user or not user.check_password(password):
+    if not user or not api_tokens.check_password(user, password):
         return jsonify({'error': 'Invalid credentials'}), 401
     
     if not user.is_active:
         return jsonify({'error': 'Account is deactivated'}), 401
     
-    # Generate new token
-    token = user.generate_api_token()
-    db.session.commit()
-    
-    logging.info(f"API token generated for user {username}")
+    # The device keeps its token; other devices' tokens stay valid
+    device = api_tokens.device_name(data.get('device'))
+    token = api_tokens.issue_token(user, device)
     
     return jsonify({
         'token': token,
-        'user': {
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'role': user.role.value
-        }
+        'device': device,
+        'user': serialize_user(user)
     })
 
 
 @api_bp.route('/auth/revoke', methods=['POST'])
 @require_api_token
 def revoke_token():
-    """Revoke current API token"""
+    """Revoke current API token, or every device's with {"all": true}"""
     user = g.current_user
-    user.revoke_api_token()
+    data = request.get_json(silent=True) or {}
+    if data.get('all'):
+        user.revoke_api_tokens()
+    else:
+        db.session.execute(delete(ApiToken).where(ApiToken.token == extract_bearer_token()))
     db.session.commit()
     
-    logging.info(f"API token revoked for user {user.username}")
+    logger.info("API token revoked for user %s", user.username)
     
     return jsonify({'message': 'Token revoked successfully'})
 
@@ -65,43 +95,40 @@ def revoke_token():
 @require_api_token
 def get_current_user():
     """Get current user information"""
-    user = g.current_user
-    return jsonify({
-        'id': user.id,
-        'username': user.username,
-        'email': user.email,
-        'role': user.role.value,
-        'permissions': {
-            'can_manage_workmen': user.can_manage_workmen(),
-            'can_clock_workmen': user.can_clock_workmen()
-        }
-    })
+    return jsonify(serialize_user_with_permissions(g.current_user))
 
 
 # Workmen management endpoints
 @api_bp.route('/workmen', methods=['GET'])
 @require_api_token
+@query_budget(4)
 def list_workmen():
     """List all workmen"""
     search = request.args.get('search', '')
+    company_id = request.args.get('company_id', type=int)
+    location_id = request.args.get('location_id', type=int)
+    
+    parts = sharding.gather(_serialized_roster, search, company_id, location_id,
+                            shards=sharding.shards_for(company_id=company_id))
     
+    return jsonify({
+        'workmen': list(heapq.merge(*parts, key=lambda workman: workman['name']))
+    })
+
+
+def _serialized_roster(search, company_id, location_id):
+    """Serialized workmen of this shard matching the roster filters, by name"""
     query = Workman.query
     if search:
         query = query.filter(Workman.name.ilike(f'%{search}%'))
+    if company_id:
+        query = query.filter(Workman.company_id == company_id)
+    if location_id:
+        query = query.filter(Workman.location_id == location_id)
     
     workmen = query.order_by(Workman.name).all()
-    
-    return jsonify({
-        'workmen': [{
-            'trn': w.trn,
-            'name': w.name,
-            'company': w.company,
-            'location': w.location,
-            'status': w.get_current_status(),
-            'created_at': w.created_at.isoformat(),
-            'updated_at': w.updated_at.isoformat()
-        } for w in workmen]
-    })
+    clocked_in = Workman.clocked_in_trns()
+    return [serialize_workman(w, 'clocked_in' if w.trn in clocked_in else 'clocked_out') for w in workmen]
 
 
 @api_bp.route('/workmen', methods=['POST'])
@@ -117,11 +144,13 @@ def create_workman():
         if not data.get(field):
             return jsonify({'error': f'{field} is required'}), 400
     
-    # Check if TRN already exists
-    existing = Workman.query.filter_by(trn=data['trn']).first()
+    # Check if TRN already exists, on whichever shard it is
+    sharding.route_to_workman(data['trn'])
+    existing = db.session.scalar(Workman.lookup_including_deleted(data['trn']))
     if existing:
         return jsonify({'error': 'TRN already exists'}), 400
     
+    sharding.route_to_company(data['company'])
     workman = Workman(
         trn=data['trn'],
         name=data['name'],
@@ -132,18 +161,11 @@ def create_workman():
     db.session.add(workman)
     db.session.commit()
     
-    logging.info(f"Workman {workman.name} created via API by {g.current_user.username}")
+    logger.info("Workman %s created via API by %s", workman.name, g.current_user.username)
     
     return jsonify({
         'message': 'Workman created successfully',
-        'workman': {
-            'trn': workman.trn,
-            'name': workman.name,
-            'company': workman.company,
-            'location': workman.location,
-            'status': workman.get_current_status(),
-            'created_at': workman.created_at.isoformat()
-        }
+        'workman': serialize_workman(workman, workman.get_current_status())
     }), 201
 
 
@@ -155,17 +177,8 @@ def get_workman(trn):
     if not workman:
         return jsonify({'error': 'Workman not found'}), 404
     
-    return jsonify({
-        'trn': workman.trn,
-        'name': workman.name,
-        'company': workman.company,
-        'location': workman.location,
-        'status': workman.get_current_status(),
-        'latest_clock_in': workman.get_latest_clock_in().isoformat() if workman.get_latest_clock_in() else None,
-        'latest_clock_out': workman.get_latest_clock_out().isoformat() if workman.get_latest_clock_out() else None,
-        'created_at': workman.created_at.isoformat(),
-        'updated_at': workman.updated_at.isoformat()
-    })
+    return jsonify(serialize_workman_detail(workman, workman.get_current_status(),
+                                            workman.get_latest_clock_in(), workman.get_latest_clock_out()))
 
 
 @api_bp.route('/workmen/<string:trn>', methods=['PUT'])
@@ -191,18 +204,11 @@ def update_workman(trn):
     workman.updated_at = datetime.utcnow()
     db.session.commit()
     
-    logging.info(f"Workman {workman.trn} updated via API by {g.current_user.username}")
+    logger.info("Workman %s updated via API by %s", workman.trn, g.current_user.username)
     
     return jsonify({
         'message': 'Workman updated successfully',
-        'workman': {
-            'trn': workman.trn,
-            'name': workman.name,
-            'company': workman.company,
-            'location': workman.location,
-            'status': workman.get_current_status(),
-            'updated_at': workman.updated_at.isoformat()
-        }
+        'workman': serialize_workman(workman, workman.get_current_status())
     })
 
 
@@ -215,14 +221,40 @@ def delete_workman(trn):
         return jsonify({'error': 'Workman not found'}), 404
     
     name = workman.name
-    db.session.delete(workman)
-    db.session.commit()
+    workman_deletion.delete_workman(workman, g.current_user)
     
-    logging.info(f"Workman {trn} ({name}) deleted via API by {g.current_user.username}")
+    logger.info("Workman %s (%s) deleted via API by %s", trn, name, g.current_user.username)
     
     return jsonify({'message': f'Workman {name} deleted successfully'})
 
 
+# Company and location lookups
+def _dimension_counts(model, column):
+    """List a lookup table with workman counts from an indexed GROUP BY"""
+    counts = Counter()
+    for part in sharding.gather(lambda: db.session.query(column, func.count(Workman.trn)).group_by(column).all()):
+        counts.update(dict(part))
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'workmen': counts.get(row.id, 0)
+    } for row in db.session.query(model).order_by(model.name)]
+
+
+@api_bp.route('/companies', methods=['GET'])
+@require_api_token
+def list_companies():
+    """List companies with workman counts"""
+    return jsonify({'companies': _dimension_counts(Company, Workman.company_id)})
+
+
+@api_bp.route('/locations', methods=['GET'])
+@require_api_token
+def list_locations():
+    """List locations with workman counts"""
+    return jsonify({'locations': _dimension_counts(Location, Workman.location_id)})
+
+
 # Time tracking endpoints
 @api_bp.route('/workmen/<string:trn>/clock-in', methods=['POST'])
 @require_api_clock_workmen
@@ -232,6 +264,9 @@ def clock_in_workman(trn):
     if not workman:
         return jsonify({'error': 'Workman not found'}), 404
     
+    # Serialize clock changes for this workman so the checks below stay valid
+    db.session.execute(Workman.clock_lock_statement(trn))
+    
     # Check if already clocked in
     existing_entry = TimeEntry.query.filter_by(workman_trn=trn, clock_out=None).first()
     if existing_entry:
@@ -248,17 +283,21 @@ def clock_in_workman(trn):
         time_entry.notes = data['notes']
     
     db.session.add(time_entry)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another writer opened an entry first (uq_time_entries_open_workman)
+        db.session.rollback()
+        return jsonify({'error': f'{workman.name} is already clocked in'}), 400
     
-    logging.info(f"Workman {trn} clocked in via API by {g.current_user.username}")
+    clock_ledger.record(trn, clock_ledger.CLOCK_IN, g.current_user.username, 'api', time_entry.clock_in,
+                        notes=time_entry.notes, device_time=clock_ledger.parse_device_time((data or {}).get('device_time')))
+    clock_logger.info("Workman %s clocked in via API by %s", trn, g.current_user.username,
+                      extra={'event': 'clock_in', 'trn': trn, 'actor': g.current_user.username})
     
     return jsonify({
         'message': f'{workman.name} clocked in successfully',
-        'time_entry': {
-            'id': time_entry.id,
-            'clock_in': time_entry.clock_in.isoformat(),
-            'notes': time_entry.notes
-        }
+        'time_entry': serialize_time_entry(time_entry)
     })
 
 
@@ -270,6 +309,9 @@ def clock_out_workman(trn):
     if not workman:
         return jsonify({'error': 'Workman not found'}), 404
     
+    # Serialize clock changes for this workman so the checks below stay valid
+    db.session.execute(Workman.clock_lock_statement(trn))
+    
     # Find active time entry
     active_entry = TimeEntry.query.filter_by(workman_trn=trn, clock_out=None).first()
     if not active_entry:
@@ -287,18 +329,15 @@ def clock_out_workman(trn):
     
     db.session.commit()
     
-    logging.info(f"Workman {trn} clocked out via API by {g.current_user.username}")
+    clock_ledger.record(trn, clock_ledger.CLOCK_OUT, g.current_user.username, 'api', active_entry.clock_out,
+                        notes=(data or {}).get('notes'),
+                        device_time=clock_ledger.parse_device_time((data or {}).get('device_time')))
+    clock_logger.info("Workman %s clocked out via API by %s", trn, g.current_user.username,
+                      extra={'event': 'clock_out', 'trn': trn, 'actor': g.current_user.username})
     
     return jsonify({
         'message': f'{workman.name} clocked out successfully',
-        'time_entry': {
-            'id': active_entry.id,
-            'clock_in': active_entry.clock_in.isoformat(),
-            'clock_out': active_entry.clock_out.isoformat(),
-            'duration_hours': active_entry.get_duration_hours(),
-            'duration_formatted': active_entry.get_duration_formatted(),
-            'notes': active_entry.notes
-        }
+        'time_entry': serialize_time_entry(active_entry)
     })
 
 
@@ -310,32 +349,223 @@ def get_workman_time_entries(trn):
     if not workman:
         return jsonify({'error': 'Workman not found'}), 404
     
-    entries = TimeEntry.query.filter_by(workman_trn=trn).order_by(TimeEntry.clock_in.desc()).all()
+    # Optional clock_in range; the archive is only read when the range reaches it
+    try:
+        start_dt, end_dt = archive.parse_date_range(request.args.get('start_date'), request.args.get('end_date'))
+    except ValueError:
+        return jsonify({'error': 'Dates must use the YYYY-MM-DD format'}), 400
+    
+    query = TimeEntry.query.filter_by(workman_trn=trn)
+    if start_dt:
+        query = query.filter(TimeEntry.clock_in >= start_dt)
+    if end_dt:
+        query = query.filter(TimeEntry.clock_in < end_dt)
+    entries = query.order_by(TimeEntry.clock_in.desc()).all()
+    entries = archive.with_archived_entries(entries, start_dt, end_dt, trn)
+    
+    return jsonify(serialize_time_entries(workman, entries))
+
+
+# Attendance, answered from the per-workman day bitmaps
+@api_bp.route('/workmen/<string:trn>/attendance', methods=['GET'])
+@require_api_token
+def get_workman_attendance(trn):
+    """Days worked, streaks and attended dates of a workman (last 30 days by default)"""
+    workman = Workman.query.filter_by(trn=trn).first()
+    if not workman:
+        return jsonify({'error': 'Workman not found'}), 404
+    try:
+        start, end = attendance.parse_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
+    window = attendance.workman_window(trn, start, end)
+    return jsonify({'trn': trn, 'name': workman.name, **attendance.summarize_window(window, start, end)})
+
+
+@api_bp.route('/attendance', methods=['GET'])
+@require_api_token
+def list_attendance():
+    """Days worked and longest streak of every workman, optionally by company or location"""
+    try:
+        start, end = attendance.parse_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    length = attendance.window_length(start, end)
+    
+    windows = attendance.roster_windows(start, end, request.args.get('company_id', type=int),
+                                        request.args.get('location_id', type=int))
     return jsonify({
-        'workman': {
-            'trn': workman.trn,
-            'name': workman.name
-        },
-        'time_entries': [{
-            'id': entry.id,
-            'clock_in': entry.clock_in.isoformat(),
-            'clock_out': entry.clock_out.isoformat() if entry.clock_out else None,
-            'duration_hours': entry.get_duration_hours(),
-            'duration_formatted': entry.get_duration_formatted(),
-            'notes': entry.notes
-        } for entry in entries],
-        'total_completed_hours': sum([entry.get_duration_hours() or 0 for entry in entries]),
-        'completed_sessions': len([entry for entry in entries if entry.clock_out])
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'days_in_range': length,
+        'workmen': [{
+            'trn': trn,
+            'name': name,
+            'days_worked': window.bit_count(),
+            'longest_streak': attendance.longest_streak(window),
+            'every_day': window.bit_count() == length,
+        } for trn, name, window in windows],
     })
 
 
+@api_bp.route('/attendance/days', methods=['GET'])
+@require_api_token
+def get_attendance_days():
+    """Dates every matching workman attended (``op=all``, the default) or any of them did (``op=any``)"""
+    op = request.args.get('op', 'all')
+    if op not in attendance.SET_OPERATIONS:
+        return jsonify({'error': f"op must be one of: {', '.join(attendance.SET_OPERATIONS)}"}), 400
+    try:
+        start, end = attendance.parse_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    windows = attendance.roster_windows(start, end, request.args.get('company_id', type=int),
+                                        request.args.get('location_id', type=int))
+    combined = attendance.combine_windows([window for _, _, window in windows], op,
+                                          attendance.window_length(start, end))
+    return jsonify({
+        'op': op,
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'workmen': len(windows),
+        'days': [day.isoformat() for day in attendance.window_days(combined, start)],
+    })
+
+
+# Batches of API calls in one round trip
+@api_bp.route('/batch', methods=['POST'])
+@require_api_token
+def run_batch():
+    """Run an ordered list of API operations with one auth check and one database session"""
+    data = request.get_json(silent=True)
+    try:
+        operations = api_batch.parse_operations(data)
+        return jsonify(api_batch.run_batch(operations, g.current_user, atomic=bool(data.get('atomic'))))
+    except api_batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# Reports
+@api_bp.route('/reports', methods=['GET'])
+@require_api_token
+def get_report_summary():
+    """Report totals and per-workman statistics.
+
+    ``period`` (yesterday, last_week, last_month, pay_period) and exact period
+    date ranges are served from the precomputed snapshot when no other filter is set.
+    Other large reports are queued as a job: 202 with the job's URL in Location.
+    """
+    try:
+        params = reporting.normalize_report_params(snapshots.apply_period(request.args.to_dict()))
+    except ValueError:
+        return jsonify({'error': f"period must be one of: {', '.join(snapshots.PERIODS)}; "
+                                 "dates must use the YYYY-MM-DD format"}), 400
+    
+    snapshot = snapshots.find_snapshot(params)
+    if snapshot:
+        return jsonify({'filters': params, 'source': 'snapshot', 'period': snapshot.period,
+                        'built_at': snapshot.built_at.isoformat(), **snapshot.data})
+    
+    if not reporting.runs_inline(params):
+        return _job_accepted(jobs.submit('report_summary', params, g.current_user))
+    
+    return jsonify({'source': 'live', **reporting.build_summary(params)})
+
+
+def _job_accepted(job):
+    """202 pointing at a queued report job"""
+    response = jsonify(serialize_job(job))
+    response.headers['Location'] = f'/api/v1/reports/jobs/{job.id}'
+    return response, 202
+
+
+# Report jobs
+@api_bp.route('/reports/jobs', methods=['POST'])
+@require_api_token
+def submit_report_job():
+    """Queue a report ('report', JSON), summary ('report_summary') or export ('report_csv') job"""
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind', 'report')
+    if kind not in jobs.REPORT_JOB_KINDS:
+        return jsonify({'error': f"kind must be one of: {', '.join(jobs.REPORT_JOB_KINDS)}"}), 400
+    
+    try:
+        params = reporting.normalize_report_params(data)
+    except ValueError:
+        return jsonify({'error': 'Dates must use the YYYY-MM-DD format and ids must be integers'}), 400
+    
+    return _job_accepted(jobs.submit(kind, params, g.current_user))
+
+
+@api_bp.route('/reports/jobs/<string:job_id>', methods=['GET'])
+@require_api_token
+def get_report_job(job_id):
+    """Status of a report job"""
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(serialize_job(job))
+
+
+@api_bp.route('/reports/jobs/<string:job_id>/result', methods=['GET'])
+@require_api_token
+def get_report_job_result(job_id):
+    """Result of a finished report job"""
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != jobs.SUCCEEDED:
+        return jsonify({'error': 'Job has not succeeded', 'status': job.status, 'detail': job.error}), 409
+    
+    return current_app.response_class(job.result, mimetype=job.content_type)
+
+
+# Edge node replication (see edge.py); bodies are gzip-compressed JSON
+@api_bp.route('/edge/push', methods=['POST'])
+@require_api_manage_workmen
+def edge_push():
+    """Accept the workmen and clock events recorded on an edge node"""
+    try:
+        payload = edge.unpack(request.get_data(), request.headers.get('Content-Encoding'))
+        return edge.packed_response(edge.accept_push(payload))
+    except edge.EdgeError as e:
+        return jsonify({'error': str(e)}), 501
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        return jsonify({'error': f'Malformed edge payload: {e}'}), 400
+
+
+@api_bp.route('/edge/pull', methods=['GET'])
+@require_api_manage_workmen
+def edge_pull():
+    """Workmen and clock events an edge node has not seen yet"""
+    node = request.args.get('node', '').strip()
+    if not node:
+        return jsonify({'error': 'node is required'}), 400
+    try:
+        return edge.packed_response(edge.build_pull(
+            node,
+            events_after=request.args.get('events_after', 0, type=int),
+            workmen_cursor=request.args.get('workmen_cursor'),
+            location=request.args.get('location'),
+            limit=request.args.get('limit', type=int),
+        ))
+    except edge.EdgeError as e:
+        return jsonify({'error': str(e)}), 501
+    except ValueError:
+        return jsonify({'error': 'workmen_cursor is malformed'}), 400
+
+
 # Admin endpoints
 @api_bp.route('/admin/users', methods=['GET'])
 @require_api_role('admin')
 def list_users():
     """List all users (admin only)"""
     users = User.query.order_by(User.username).all()
+    with_tokens = set(db.session.scalars(
+        select(ApiToken.user_id).where(ApiToken.expires_at > datetime.utcnow()).distinct()))
     
     return jsonify({
         'users': [{
@@ -344,10 +574,100 @@ def list_users():
             'email': user.email,
             'role': user.role.value,
             'is_active': user.is_active,
-            'has_token': bool(user.api_token),
+            'has_token': user.id in with_tokens,
             'created_at': user.created_at.isoformat()
         } for user in users]
     })
 
 
+@api_bp.route('/admin/users/bulk', methods=['POST'])
+@require_api_role('admin')
+def bulk_create_users():
+    """Create users from a CSV upload, a text/csv body or JSON {"csv": ...} (admin only)"""
+    if 'file' in request.files:
+        text = request.files['file'].read().decode('utf-8-sig')
+    elif request.is_json:
+        text = (request.get_json(silent=True) or {}).get('csv') or ''
+    else:
+        text = request.get_data(as_text=True)
+    if not text.strip():
+        return jsonify({'error': 'No CSV data provided'}), 400
+    
+    issue_tokens = request.args.get('issue_tokens', 'false').lower() == 'true'
+    strict = request.args.get('strict', 'false').lower() == 'true'
+    try:
+        result = provisioning.provision_users(text, issue_tokens=issue_tokens, strict=strict)
+    except provisioning.ProvisioningError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    logger.info("%s users provisioned via API by %s", len(result['created']), g.current_user.username)
+    status = 400 if strict and result['errors'] else 201
+    return jsonify(result), status
+
+
+@api_bp.route('/admin/stale-entries', methods=['GET'])
+@require_api_manage_workmen
+def stale_entries_summary():
+    """Summary of open time entries that were never clocked out"""
+    max_shift_hours = request.args.get('max_shift_hours', type=float) or current_app.config['STALE_ENTRY_MAX_SHIFT_HOURS']
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    
+    parts = sharding.gather(lambda: (stale_entries.find_stale_entries(max_shift_hours, limit=limit),
+                                     stale_entries.count_open_entries(),
+                                     stale_entries.count_stale_entries(max_shift_hours)))
+    entries = list(heapq.merge(*(part[0] for part in parts), key=lambda entry: entry.clock_in))[:limit]
+    
+    return jsonify({
+        'max_shift_hours': max_shift_hours,
+        'action': current_app.config['STALE_ENTRY_ACTION'],
+        'open_entries': sum(part[1] for part in parts),
+        'stale_entries': sum(part[2] for part in parts),
+        'oldest': [{
+            'id': entry.id,
+            'workman_trn': entry.workman_trn,
+            'clock_in': entry.clock_in.isoformat(),
+            'notes': entry.notes
+        } for entry in entries],
+        'last_run': stale_entries.last_run or None
+    })
+
+
+@api_bp.route('/admin/slow-queries', methods=['GET'])
+@require_api_role('admin')
+def list_slow_queries():
+    """Recent slow statements with their query plans (admin only)"""
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    
+    return jsonify({
+        'threshold_ms': current_app.config['SLOW_QUERY_THRESHOLD_MS'],
+        'slow_queries': slow_queries.recent_slow_queries(limit)
+    })
+
+
+@api_bp.route('/admin/slow-queries', methods=['DELETE'])
+@require_api_role('admin')
+def clear_slow_queries():
+    """Empty the slow query log (admin only)"""
+    slow_queries.clear_slow_queries()
+    return jsonify({'message': 'Slow query log cleared'})
+
+
+@api_bp.route('/admin/profiles', methods=['GET'])
+@require_api_role('admin')
+def list_profiles():
+    """Stored request profiles, newest first (admin only)"""
+    return jsonify({'profiles': profiler.list_profiles()})
+
+
+@api_bp.route('/admin/profiles/<profile_id>', methods=['GET'])
+@require_api_role('admin')
+def get_profile(profile_id):
+    """Top functions and SQL timings of one profiled request (admin only)"""
+    profile = profiler.get_profile(profile_id)
+    if not profile:
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    return jsonify(profile)
+
+
 # Blueprint will be registered in app.py
\ No newline at end of file
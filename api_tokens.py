@@ -0,0 +1,167 @@
+"""API token issuance and verification kept off the write path.
+
+Each device a user signs in from holds its own token, so signing in on a new
+phone no longer logs out the others. Clients that do not name their device
+share one slot per user, so legacy clients keep reusing a token instead of
+adding a row on every sign-in; the slot name is returned with the token.
+Requesting a token again from the same device returns the token it already
+has while at least half of its lifetime is left, so repeat sign-ins write
+nothing.
+Credentials that were verified recently are remembered in process memory as
+an HMAC, which spares repeat sign-ins the deliberately slow password hash.
+
+Verifying a token is a single indexed read. Its ``last_used_at`` is buffered
+in memory and written in one batch per API_TOKEN_FLUSH_SECONDS by a periodic
+task, which also deletes expired tokens.
+"""
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam, delete
+from app import db
+from models import ApiToken
+from scheduler import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Devices that do not name themselves share this slot
+DEFAULT_DEVICE = 'default'
+
+class CredentialCache:
+    """Recently verified passwords, as HMACs bound to the user's password hash.
+
+    The HMAC key is random per process and the stored hash is part of the
+    message, so a cached entry never outlives a password change.
+    """
+
+    def __init__(self, ttl_seconds, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, user, password):
+        message = f'{user.id}:{user.password_hash}:{password}'.encode()
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check_password(self, user, password):
+        """``user.check_password``, skipped when the same credentials passed recently"""
+        if self.ttl_seconds <= 0:
+            return user.check_password(password)
+
+        digest = self._digest(user, password)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(user.id)
+        if cached and cached[1] > now and hmac.compare_digest(cached[0], digest):
+            return True
+
+        if not user.check_password(password):
+            return False
+        with self._lock:
+            self._entries.pop(user.id, None)
+            self._entries[user.id] = (digest, now + self.ttl_seconds)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+
+class UsageBuffer:
+    """Last use of each token since the previous flush"""
+
+    def __init__(self):
+        self._last_used = {}
+        self._lock = threading.Lock()
+
+    def touch(self, token):
+        with self._lock:
+            self._last_used[token] = datetime.utcnow()
+
+    def drain(self):
+        with self._lock:
+            last_used, self._last_used = self._last_used, {}
+        return last_used
+
+
+def device_name(requested):
+    """Device slot for a token request: the client's own name, else the user's shared unnamed slot.
+
+    The User-Agent is not used: phones running the same app send the same one.
+    """
+    name = str(requested or '').strip()[:100]
+    return name or DEFAULT_DEVICE
+
+
+def token_ttl(config):
+    return timedelta(days=config['API_TOKEN_TTL_DAYS'])
+
+
+def reuse_cutoff(config):
+    """Tokens expiring before this are replaced rather than handed out again"""
+    return datetime.utcnow() + token_ttl(config) / 2
+
+
+def issue_token(user, device):
+    """The device's token, reusing a valid one and only writing when it must"""
+    token = db.session.scalar(ApiToken.reusable_lookup(user.id, device, reuse_cutoff(current_app.config)))
+    if token is None:
+        token = ApiToken.issue(user, device, token_ttl(current_app.config))
+        db.session.add(token)
+        db.session.commit()
+        logger.info("API token issued for user %s on %s", user.username, device)
+    return token.token
+
+
+def check_password(user, password):
+    """Verify a password through the app's credential cache"""
+    return current_app.extensions['credential_cache'].check_password(user, password)
+
+
+def record_use(token, app=None):
+    """Note that a token was used; the timestamp is written by the next flush"""
+    (app or current_app).extensions['api_token_usage'].touch(token)
+
+
+def flush_last_used(usage):
+    """Write buffered last-used timestamps in a single batch"""
+    last_used = usage.drain()
+    if not last_used:
+        return 0
+    table = ApiToken.__table__
+    db.session.execute(
+        table.update().where(table.c.token == bindparam('b_token')).values(last_used_at=bindparam('b_used_at')),
+        [{'b_token': token, 'b_used_at': used_at} for token, used_at in last_used.items()]
+    )
+    db.session.commit()
+    return len(last_used)
+
+
+def delete_expired():
+    deleted = db.session.execute(delete(ApiToken).where(ApiToken.expires_at <= datetime.utcnow())).rowcount
+    db.session.commit()
+    if deleted:
+        logger.info("Deleted %s expired API tokens", deleted)
+    return deleted
+
+
+def run_maintenance(app):
+    flush_last_used(app.extensions['api_token_usage'])
+    delete_expired()
+
+
+def init_app(app):
+    """Set up the credential cache, usage buffer and their periodic flush"""
+    app.extensions['credential_cache'] = CredentialCache(app.config['API_TOKEN_CREDENTIAL_CACHE_SECONDS'])
+    app.extensions['api_token_usage'] = UsageBuffer()
+
+    task = PeriodicTask('api-token-maintenance', app.config['API_TOKEN_FLUSH_SECONDS'],
+                        lambda: run_maintenance(app), app=app)
+    task.start_on_first_request(app)
+    app.extensions['api_token_maintenance'] = task
@@ -1,37 +1,23 @@
 import os
-import logging
+import socket
+import tempfile
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import db_routing
+import logging_config
+import metrics
 
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
-
-# Create the Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "workmen-management-secret-key")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+db = SQLAlchemy(model_class=Base, session_options={"class_": db_routing.RoutingSession})
 
-# Initialize the app with the extension
-db.init_app(app)
-
-# Initialize Flask-Login
+# Flask-Login is bound to the app inside create_app
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
@@ -41,23 +27,298 @@ def load_user(user_id):
     from models import User
     return User.query.get(int(user_id))
 
-with app.app_context():
-    # Import models to ensure tables are created
-    from models import User, Workman, TimeEntry
-    try:
-        db.create_all()
-        logging.info("Database tables created successfully")
-    except Exception as e:
-        logging.error(f"Database initialization error: {e}")
-        # Continue without failing - tables might already exist
-
-# Register authentication blueprint
-from auth import auth_bp
-app.register_blueprint(auth_bp)
-
-# Register API routes
-from api_routes import api_bp
-app.register_blueprint(api_bp)
-
-# Import routes after app creation to avoid circular imports
-from routes import *
+
+def configure(app):
+    """Load configuration from environment variables"""
+    app.secret_key = os.environ.get("SESSION_SECRET", "workmen-management-secret-key")
+
+    # Configure the database
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    # Pool that reports connection wait time to /metrics
+    pool_class = metrics.pool_class_for(app.config["SQLALCHEMY_DATABASE_URI"])
+    if pool_class:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]["poolclass"] = pool_class
+
+    # Bearer token required to scrape /metrics (open when unset)
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+    # N+1 detection for development and tests (see query_audit.py)
+    app.config["QUERY_AUDIT_ENABLED"] = os.environ.get("QUERY_AUDIT_ENABLED", "false").lower() == "true"
+    app.config["QUERY_AUDIT_REPEAT_THRESHOLD"] = int(os.environ.get("QUERY_AUDIT_REPEAT_THRESHOLD", "3"))
+
+    # Slow query log (see slow_queries.py)
+    app.config["SLOW_QUERY_ENABLED"] = os.environ.get("SLOW_QUERY_ENABLED", "true").lower() == "true"
+    app.config["SLOW_QUERY_THRESHOLD_MS"] = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", "500"))
+    app.config["SLOW_QUERY_EXPLAIN"] = os.environ.get("SLOW_QUERY_EXPLAIN", "true").lower() == "true"
+    app.config["SLOW_QUERY_LOG_SIZE"] = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "100"))
+
+    # On-demand admin request profiling (see profiler.py)
+    app.config["PROFILER_STORE_SIZE"] = int(os.environ.get("PROFILER_STORE_SIZE", "50"))
+    app.config["PROFILER_TOP_FUNCTIONS"] = int(os.environ.get("PROFILER_TOP_FUNCTIONS", "40"))
+
+    # Connection pool of the async engine used by the ASGI entry point (asgi.py)
+    app.config["ASYNC_DATABASE_POOL_SIZE"] = int(os.environ.get("ASYNC_DATABASE_POOL_SIZE", "20"))
+    app.config["ASYNC_DATABASE_MAX_OVERFLOW"] = int(os.environ.get("ASYNC_DATABASE_MAX_OVERFLOW", "20"))
+
+    # Optional read replicas for GET traffic
+    app.config["SQLALCHEMY_BINDS"] = db_routing.replica_binds(os.environ.get("DATABASE_REPLICA_URLS"))
+    app.config["DATABASE_REPLICA_STICKY_SECONDS"] = int(os.environ.get("DATABASE_REPLICA_STICKY_SECONDS", "10"))
+
+    # Optional sharding of workmen by company as "name=url,..." (see sharding.py);
+    # a move waits the grace period for requests routed before the company was locked
+    app.config["SQLALCHEMY_BINDS"].update(db_routing.shard_binds(os.environ.get("DATABASE_SHARDS")))
+    app.config["SHARD_GATHER_WORKERS"] = int(os.environ.get("SHARD_GATHER_WORKERS", "8"))
+    app.config["SHARD_MOVE_BATCH_SIZE"] = int(os.environ.get("SHARD_MOVE_BATCH_SIZE", "100"))
+    app.config["SHARD_MOVE_GRACE_SECONDS"] = float(os.environ.get("SHARD_MOVE_GRACE_SECONDS", "5"))
+
+    # Forgotten clock-out detection
+    app.config["STALE_ENTRY_JOB_ENABLED"] = os.environ.get("STALE_ENTRY_JOB_ENABLED", "true").lower() == "true"
+    app.config["STALE_ENTRY_MAX_SHIFT_HOURS"] = float(os.environ.get("STALE_ENTRY_MAX_SHIFT_HOURS", "16"))
+    app.config["STALE_ENTRY_ACTION"] = os.environ.get("STALE_ENTRY_ACTION", "close")
+    app.config["STALE_ENTRY_BATCH_SIZE"] = int(os.environ.get("STALE_ENTRY_BATCH_SIZE", "500"))
+    app.config["STALE_ENTRY_INTERVAL_SECONDS"] = int(os.environ.get("STALE_ENTRY_INTERVAL_SECONDS", "900"))
+
+    # Background report/export jobs (see jobs.py)
+    app.config["JOBS_MAX_WORKERS"] = int(os.environ.get("JOBS_MAX_WORKERS", "2"))
+    app.config["JOBS_RESULT_TTL_SECONDS"] = int(os.environ.get("JOBS_RESULT_TTL_SECONDS", "900"))
+    app.config["JOBS_TIMEOUT_SECONDS"] = int(os.environ.get("JOBS_TIMEOUT_SECONDS", "1800"))
+    app.config["JOBS_EVICT_INTERVAL_SECONDS"] = int(os.environ.get("JOBS_EVICT_INTERVAL_SECONDS", "300"))
+    # Pending jobs whose process stopped refreshing them for this long are abandoned
+    app.config["JOBS_HEARTBEAT_SECONDS"] = int(os.environ.get("JOBS_HEARTBEAT_SECONDS", "15"))
+    app.config["JOBS_CLAIM_TIMEOUT_SECONDS"] = int(os.environ.get("JOBS_CLAIM_TIMEOUT_SECONDS", "60"))
+    # Reports over longer ranges (or without a start date) run as background jobs
+    app.config["REPORT_INLINE_MAX_DAYS"] = int(os.environ.get("REPORT_INLINE_MAX_DAYS", "62"))
+
+    # Precomputed report periods (see snapshots.py); pay periods start on the anchor date
+    app.config["PAY_PERIOD_DAYS"] = int(os.environ.get("PAY_PERIOD_DAYS", "14"))
+    app.config["PAY_PERIOD_ANCHOR"] = os.environ.get("PAY_PERIOD_ANCHOR", "2024-01-01")
+    app.config["REPORT_SNAPSHOTS_ENABLED"] = os.environ.get("REPORT_SNAPSHOTS_ENABLED", "true").lower() == "true"
+    app.config["REPORT_SNAPSHOT_CHECK_SECONDS"] = int(os.environ.get("REPORT_SNAPSHOT_CHECK_SECONDS", "3600"))
+    app.config["REPORT_SNAPSHOT_RETENTION_DAYS"] = int(os.environ.get("REPORT_SNAPSHOT_RETENTION_DAYS", "400"))
+
+    # Login/token rate limits as "<attempts>/<seconds>" (see rate_limit.py); the
+    # storage is a SQLite file shared by the workers, or "memory"
+    app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    app.config["RATE_LIMIT_STORAGE"] = os.environ.get(
+        "RATE_LIMIT_STORAGE", os.path.join(tempfile.gettempdir(), "workmen-rate-limit.sqlite3"))
+    app.config["RATE_LIMIT_IP"] = os.environ.get("RATE_LIMIT_IP", "30/60")
+    app.config["RATE_LIMIT_USERNAME"] = os.environ.get("RATE_LIMIT_USERNAME", "10/60")
+    app.config["RATE_LIMIT_MAX_KEYS"] = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+
+    # Deleting workmen (see workman_deletion.py): "soft" hides them at once and
+    # purges their history in the background, "hard" deletes in one statement
+    app.config["WORKMAN_DELETE_MODE"] = os.environ.get("WORKMAN_DELETE_MODE", "soft")
+    app.config["WORKMAN_PURGE_BATCH_SIZE"] = int(os.environ.get("WORKMAN_PURGE_BATCH_SIZE", "5000"))
+
+    # Clock event ledger (see clock_ledger.py); durability is "buffered" or "sync".
+    # Edge nodes refold entries from the ledger after every pull, so they default to sync
+    edge_mode = bool(os.environ.get("EDGE_UPSTREAM_URL"))
+    app.config["CLOCK_LEDGER_DURABILITY"] = os.environ.get("CLOCK_LEDGER_DURABILITY", "sync" if edge_mode else "buffered")
+    app.config["CLOCK_LEDGER_BUFFER_SIZE"] = int(os.environ.get("CLOCK_LEDGER_BUFFER_SIZE", "10000"))
+    app.config["CLOCK_LEDGER_BATCH_SIZE"] = int(os.environ.get("CLOCK_LEDGER_BATCH_SIZE", "500"))
+    app.config["CLOCK_LEDGER_FLUSH_INTERVAL_MS"] = int(os.environ.get("CLOCK_LEDGER_FLUSH_INTERVAL_MS", "1000"))
+
+    # Default output directory of flask export-columnar (see columnar_export.py)
+    app.config["ANALYTICS_EXPORT_DIR"] = os.environ.get("ANALYTICS_EXPORT_DIR")
+
+    # Per-device API tokens (see api_tokens.py)
+    app.config["API_TOKEN_TTL_DAYS"] = int(os.environ.get("API_TOKEN_TTL_DAYS", "30"))
+    app.config["API_TOKEN_FLUSH_SECONDS"] = int(os.environ.get("API_TOKEN_FLUSH_SECONDS", "60"))
+    app.config["API_TOKEN_CREDENTIAL_CACHE_SECONDS"] = int(os.environ.get("API_TOKEN_CREDENTIAL_CACHE_SECONDS", "300"))
+
+    # Bulk user provisioning (see provisioning.py); 0 hashing workers means one per core
+    app.config["PROVISION_HASH_WORKERS"] = int(os.environ.get("PROVISION_HASH_WORKERS", "0"))
+    app.config["PROVISION_BATCH_SIZE"] = int(os.environ.get("PROVISION_BATCH_SIZE", "500"))
+
+    # Attendance bitmaps (see attendance.py): longest date range a query may ask for
+    app.config["ATTENDANCE_MAX_DAYS"] = int(os.environ.get("ATTENDANCE_MAX_DAYS", "3660"))
+
+    # Most operations one POST /api/v1/batch may carry (see api_batch.py)
+    app.config["API_BATCH_MAX_OPERATIONS"] = int(os.environ.get("API_BATCH_MAX_OPERATIONS", "20"))
+
+    # Edge mode (see edge.py): a site node on local SQLite replicating with the central instance
+    app.config["EDGE_UPSTREAM_URL"] = os.environ.get("EDGE_UPSTREAM_URL", "").rstrip("/")
+    app.config["EDGE_UPSTREAM_TOKEN"] = os.environ.get("EDGE_UPSTREAM_TOKEN", "")
+    app.config["EDGE_NODE_ID"] = os.environ.get("EDGE_NODE_ID", socket.gethostname())
+    app.config["EDGE_LOCATION"] = os.environ.get("EDGE_LOCATION", "")
+    app.config["EDGE_SYNC_INTERVAL_SECONDS"] = int(os.environ.get("EDGE_SYNC_INTERVAL_SECONDS", "30"))
+    app.config["EDGE_SYNC_BATCH_SIZE"] = int(os.environ.get("EDGE_SYNC_BATCH_SIZE", "500"))
+    app.config["EDGE_SYNC_TIMEOUT_SECONDS"] = float(os.environ.get("EDGE_SYNC_TIMEOUT_SECONDS", "30"))
+    # Rows behind a node's pull cursors sent again, for transactions that committed late
+    app.config["EDGE_SYNC_OVERLAP_EVENTS"] = int(os.environ.get("EDGE_SYNC_OVERLAP_EVENTS", "200"))
+    app.config["EDGE_SYNC_OVERLAP_SECONDS"] = int(os.environ.get("EDGE_SYNC_OVERLAP_SECONDS", "60"))
+
+    # SQLite tuning for concurrent workers, on by default in edge mode: WAL lets
+    # readers run beside the writer, NORMAL syncs only at checkpoints
+    app.config["SQLITE_JOURNAL_MODE"] = os.environ.get("SQLITE_JOURNAL_MODE", "WAL" if edge_mode else "")
+    app.config["SQLITE_SYNCHRONOUS"] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL" if edge_mode else "")
+    app.config["SQLITE_BUSY_TIMEOUT_MS"] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000" if edge_mode else "0"))
+
+
+def _add_missing_columns(table, inspector):
+    """Add nullable columns introduced since the table was created"""
+    from sqlalchemy import text
+    from sqlalchemy.schema import CreateColumn
+
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing and column.nullable:
+            ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+
+
+def _upgrade_foreign_keys(table, inspector):
+    """Recreate foreign keys whose ON DELETE rule changed (PostgreSQL only)"""
+    from sqlalchemy import text
+    from sqlalchemy.schema import AddConstraint
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+    existing = {tuple(fk['constrained_columns']): fk for fk in inspector.get_foreign_keys(table.name)}
+    for constraint in table.foreign_key_constraints:
+        current = existing.get(tuple(constraint.column_keys))
+        if current is None or (current['options'].get('ondelete') or None) == constraint.ondelete:
+            continue
+        with db.engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT {current["name"]}'))
+            conn.execute(AddConstraint(constraint))
+
+
+def init_db():
+    """Create missing tables, and the columns, indexes and foreign key rules added to existing ones"""
+    from sqlalchemy import inspect
+    import models  # noqa: F401 - registers every model on db.metadata
+    # Only the primary: replicas are never written and shards get their tables below
+    db.create_all(bind_key=None)
+    # create_all skips existing tables, so bring them up to date
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        _add_missing_columns(table, inspector)
+        _upgrade_foreign_keys(table, inspector)
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Workman tables and copies of the companies and locations on every shard
+    import sharding
+    sharding.create_shard_schema()
+
+
+@click.command('init-db')
+def init_db_command():
+    """Create the database schema"""
+    init_db()
+    click.echo("Database tables created successfully")
+
+
+def create_app(config=None):
+    """Application factory.
+
+    Importing this module does no I/O: the schema is created by ``flask init-db``,
+    and blueprints, models and background jobs are wired up here so that
+    ``gunicorn --preload`` can build the app once before forking workers.
+    """
+    app = Flask(__name__)
+    # x_for: remote_addr is the client behind the proxy, which rate limiting keys on
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
+    logging_config.configure_logging()
+
+    configure(app)
+    if config:
+        app.config.update(config)
+
+    # Initialize the app with the extensions
+    db.init_app(app)
+    db_routing.init_app(app, db)
+    login_manager.init_app(app)
+
+    # Company sharding: request routing and the shard map (no-op without DATABASE_SHARDS)
+    import sharding
+    sharding.init_app(app)
+
+    # Soft deleted workmen are hidden from every query; SQLite enforces cascades
+    import workman_deletion
+    workman_deletion.init_app(app)
+
+    # SQLite tuning and edge-node replication with the central instance
+    import edge
+    edge.init_app(app)
+
+    # Rate limiting of password checks, shared across workers
+    import rate_limit
+    rate_limit.init_app(app)
+
+    # Per-device API tokens with batched last-used writes
+    import api_tokens
+    api_tokens.init_app(app)
+
+    # Admin-triggered request profiling; registered first so it wraps the other hooks
+    import profiler
+    profiler.init_app(app)
+
+    # Request latency, SQL and pool metrics on /metrics
+    metrics.init_app(app)
+
+    # Per-request N+1 query detection
+    import query_audit
+    query_audit.init_app(app)
+
+    # Slow statements with their query plans
+    import slow_queries
+    slow_queries.init_app(app)
+
+    # Register authentication blueprint
+    from auth import auth_bp
+    app.register_blueprint(auth_bp)
+
+    # Register API routes
+    from api_routes import api_bp
+    app.register_blueprint(api_bp)
+
+    # Register the HTML routes
+    import routes
+    routes.init_app(app)
+
+    # Append-only clock event ledger and the replay command
+    import clock_ledger
+    clock_ledger.init_app(app)
+
+    # Forgotten clock-out job, started lazily in each worker process
+    import stale_entries
+    stale_entries.init_app(app)
+
+    # Background report jobs and eviction of their cached results
+    import jobs
+    jobs.init_app(app)
+
+    # Nightly snapshots of the standard report periods
+    import snapshots
+    snapshots.init_app(app)
+
+    # Register the time entry archival command
+    import archive
+    archive.init_app(app)
+
+    # Register the columnar analytics export command (needs the analytics extra)
+    import columnar_export
+    columnar_export.init_app(app)
+
+    # Register the bulk user provisioning command
+    import provisioning
+    provisioning.init_app(app)
+
+    # Attendance bitmaps: kept current on clock-in, plus the rebuild command
+    import attendance
+    attendance.init_app(app)
+
+    # Register the company/location migration command
+    import dimensions
+    dimensions.init_app(app)
+
+    app.cli.add_command(init_db_command)
+
+    return app
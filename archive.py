@@ -0,0 +1,216 @@
+import click
+import heapq
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.orm import selectinload
+from app import db
+from models import Workman, TimeEntry, ArchivedTimeEntry, DailySummary
+from db_routing import current_shard
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# Newest archived clock_in per shard, cached briefly so range checks stay off the database
+_LATEST_CACHE_SECONDS = 60
+_latest_archived = {}
+
+
+def month_start(value):
+    """First instant of the month containing ``value``"""
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    """Shift a month start by a (possibly negative) number of months"""
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def parse_date_range(start_date=None, end_date=None):
+    """Parse YYYY-MM-DD bounds into a [start, end) clock_in range.
+
+    The end date is inclusive, so one day is added to it. Raises ValueError
+    on malformed dates.
+    """
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d') if start_date else None
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1) if end_date else None
+    return start_dt, end_dt
+
+
+def latest_archived_clock_in():
+    """Newest clock_in in the archive, or None when nothing is archived"""
+    now = time.monotonic()
+    value, checked_at = _latest_archived.get(current_shard(), (None, 0.0))
+    if now - checked_at > _LATEST_CACHE_SECONDS:
+        value = db.session.query(func.max(ArchivedTimeEntry.clock_in)).scalar()
+        _latest_archived[current_shard()] = (value, now)
+    return value
+
+
+def needs_archive(start_dt=None):
+    """Whether a range starting at ``start_dt`` can reach archived entries"""
+    return reaches_archive(latest_archived_clock_in(), start_dt)
+
+
+def reaches_archive(latest, start_dt=None):
+    """Whether a range starting at ``start_dt`` reaches an archive ending at ``latest``"""
+    return latest is not None and (start_dt is None or start_dt <= latest)
+
+
+def archived_entries_statement(start_dt=None, end_dt=None, workman_trn=None, company_id=None, location_id=None):
+    """Select archived entries in a clock_in range, newest first"""
+    stmt = select(ArchivedTimeEntry)
+    if start_dt:
+        stmt = stmt.where(ArchivedTimeEntry.clock_in >= start_dt)
+    if end_dt:
+        stmt = stmt.where(ArchivedTimeEntry.clock_in < end_dt)
+    if workman_trn:
+        stmt = stmt.where(ArchivedTimeEntry.workman_trn == workman_trn)
+    if company_id or location_id:
+        stmt = stmt.join(Workman)
+        if company_id:
+            stmt = stmt.where(Workman.company_id == company_id)
+        if location_id:
+            stmt = stmt.where(Workman.location_id == location_id)
+    return stmt.options(selectinload(ArchivedTimeEntry.workman)).order_by(ArchivedTimeEntry.clock_in.desc())
+
+
+def with_archived_entries(entries, start_dt=None, end_dt=None, workman_trn=None, company_id=None, location_id=None,
+                          whole_archive=False):
+    """Merge archived entries into a newest-first list of live entries.
+
+    The archive is only queried when the requested range starts at or before the
+    newest archived entry. A range without a start date would read the whole
+    archive, so it gets no archived entries unless ``whole_archive`` is set;
+    archived_totals counts them instead.
+    """
+    if (start_dt is None and not whole_archive) or not needs_archive(start_dt):
+        return entries
+    archived = db.session.scalars(archived_entries_statement(start_dt, end_dt, workman_trn, company_id, location_id)).all()
+    if not archived:
+        return entries
+    return list(heapq.merge(entries, archived, key=lambda entry: entry.clock_in, reverse=True))
+
+
+def archived_totals(start_dt=None, end_dt=None, workman_trn=None, company_id=None, location_id=None):
+    """(workman, hours, sessions) of the archived entries in a clock_in range, per workman.
+
+    Read from the daily summaries, which hold exactly the archived entries, so
+    the archive itself is not touched. Days are the clock_in dates.
+    """
+    stmt = (select(Workman, func.sum(DailySummary.total_hours), func.sum(DailySummary.sessions))
+            .join(DailySummary, DailySummary.workman_trn == Workman.trn).group_by(Workman.trn))
+    if start_dt:
+        stmt = stmt.where(DailySummary.day >= start_dt.date())
+    if end_dt:
+        stmt = stmt.where(DailySummary.day < end_dt.date())
+    if workman_trn:
+        stmt = stmt.where(Workman.trn == workman_trn)
+    if company_id:
+        stmt = stmt.where(Workman.company_id == company_id)
+    if location_id:
+        stmt = stmt.where(Workman.location_id == location_id)
+    return [(workman, hours or 0.0, sessions or 0) for workman, hours, sessions in db.session.execute(stmt)]
+
+
+def ensure_partitions(months):
+    """Create monthly archive partitions on PostgreSQL if they do not exist yet"""
+    # The archive's database, which is a shard's when sharding is on
+    bind = db.session.get_bind(mapper=ArchivedTimeEntry.__mapper__)
+    if bind.dialect.name != 'postgresql':
+        return
+    for start in sorted(months):
+        end = add_months(start, 1)
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS time_entries_archive_{start:%Y_%m} "
+            f"PARTITION OF time_entries_archive "
+            f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        ), bind_arguments={'bind': bind})
+
+
+def _update_daily_summaries(entries):
+    totals = defaultdict(lambda: [0.0, 0])
+    for entry in entries:
+        bucket = totals[(entry.workman_trn, entry.clock_in.date())]
+        bucket[0] += entry.get_duration_hours() or 0
+        bucket[1] += 1
+
+    trns = {trn for trn, _ in totals}
+    days = [day for _, day in totals]
+    existing = {
+        (summary.workman_trn, summary.day): summary
+        for summary in db.session.query(DailySummary).filter(
+            DailySummary.workman_trn.in_(trns),
+            DailySummary.day >= min(days),
+            DailySummary.day <= max(days)
+        )
+    }
+
+    for (trn, day), (hours, sessions) in totals.items():
+        summary = existing.get((trn, day))
+        if summary is None:
+            summary = DailySummary(workman_trn=trn, day=day, total_hours=0, sessions=0)
+            db.session.add(summary)
+        summary.total_hours = round(summary.total_hours + hours, 2)
+        summary.sessions += sessions
+
+
+def archive_time_entries(months, batch_size=5000):
+    """Move closed entries older than ``months`` whole months into the archive.
+
+    Works in committed batches: copy into the archive, fold the batch into the
+    daily summaries and delete it from time_entries. Open entries are never
+    archived, and neither are those of a company being moved to another shard.
+    """
+    cutoff = add_months(month_start(datetime.utcnow()), -months)
+    archived = 0
+
+    while True:
+        entries = db.session.query(TimeEntry).filter(
+            TimeEntry.clock_in < cutoff,
+            TimeEntry.clock_out.isnot(None),
+            sharding.unlocked_workmen(TimeEntry.workman_trn)
+        ).order_by(TimeEntry.clock_in).limit(batch_size).all()
+        if not entries:
+            break
+
+        ensure_partitions({month_start(entry.clock_in) for entry in entries})
+        db.session.execute(insert(ArchivedTimeEntry), [{
+            'id': entry.id,
+            'workman_trn': entry.workman_trn,
+            'clock_in': entry.clock_in,
+            'clock_out': entry.clock_out,
+            'notes': entry.notes,
+            'archived_at': datetime.utcnow()
+        } for entry in entries])
+        _update_daily_summaries(entries)
+        db.session.execute(
+            delete(TimeEntry).where(TimeEntry.id.in_([entry.id for entry in entries])),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        db.session.expunge_all()
+
+        archived += len(entries)
+        logger.info("Archived %s time entries older than %s", archived, cutoff.date())
+
+    _latest_archived.pop(current_shard(), None)
+    return archived
+
+
+@click.command('archive-time-entries')
+@click.option('--months', type=int, default=12, show_default=True,
+              help='Keep this many whole months of entries in the live table')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def archive_time_entries_command(months, batch_size):
+    """Move old closed time entries into the archive"""
+    archived = sum(sharding.gather(archive_time_entries, months, batch_size=batch_size))
+    click.echo(f"Archived {archived} time entries")
+
+
+def init_app(app):
+    """Register the archival CLI command"""
+    app.cli.add_command(archive_time_entries_command)
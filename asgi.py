@@ -0,0 +1,502 @@
+"""ASGI entry point serving the /api/v1 surface with async handlers.
+
+Select it at deploy time instead of main:app, for example:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+
+The core API endpoints below run on an async SQLAlchemy engine, so slow clients
+only hold a coroutine rather than a worker process. Any other path (HTML pages,
+admin API endpoints) is handed to the Flask app unchanged.
+"""
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import delete, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from app import create_app
+from models import User, ApiToken, Workman, TimeEntry, ArchivedTimeEntry, Company, Location
+from serializers import (serialize_user, serialize_user_with_permissions, serialize_workman,
+                         serialize_workman_detail, serialize_time_entry, serialize_time_entries)
+import api_auth
+import api_tokens
+import archive
+import clock_ledger
+import sharding
+import workman_deletion
+
+logger = logging.getLogger(__name__)
+clock_logger = logging.getLogger('workmen.clock')
+
+flask_app = create_app()
+
+# Permission levels mirroring the api_auth decorators
+PUBLIC = 'public'
+TOKEN = 'token'
+MANAGE = 'manage'
+CLOCK = 'clock'
+
+
+def async_database_url(url):
+    """Translate a sync DATABASE_URL into an async driver URL and connect args"""
+    url = make_url(url)
+    connect_args = {}
+    backend = url.get_backend_name()
+    if backend in ('postgres', 'postgresql'):
+        sslmode = url.query.get('sslmode')
+        url = url.set(drivername='postgresql+asyncpg').difference_update_query(['sslmode'])
+        if sslmode and sslmode != 'disable':
+            connect_args['ssl'] = sslmode
+    elif backend == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    return url, connect_args
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if sharding.enabled(flask_app):
+        # The async handlers below only know the primary database
+        raise RuntimeError("The ASGI entry point does not support DATABASE_SHARDS yet; serve main:app instead")
+    url, connect_args = async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    engine = create_async_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=flask_app.config['ASYNC_DATABASE_POOL_SIZE'],
+        max_overflow=flask_app.config['ASYNC_DATABASE_MAX_OVERFLOW'],
+        pool_recycle=300,
+        pool_pre_ping=True
+    )
+    workman_deletion.enable_sqlite_foreign_keys(engine.sync_engine)
+    app.state.sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    # Core API requests never reach Flask, so start the last-used flush here
+    token_maintenance = flask_app.extensions['api_token_maintenance']
+    token_maintenance.start()
+    yield
+    token_maintenance.stop()
+    await run_in_threadpool(token_maintenance.run_once)
+    await engine.dispose()
+
+
+def error(body, status_code):
+    """JSON error response"""
+    if isinstance(body, str):
+        body = {'error': body}
+    return JSONResponse(body, status_code=status_code)
+
+
+async def json_body(request):
+    """Parsed JSON body, or None when missing or malformed"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def api_route(permission=TOKEN):
+    """Open a session and apply the same token and permission rules as api_auth"""
+    def decorator(handler):
+        async def endpoint(request):
+            async with request.app.state.sessionmaker() as session:
+                user = None
+                if permission != PUBLIC:
+                    token = api_auth.parse_bearer_token(request.headers.get('Authorization'))
+                    if not token:
+                        return error(api_auth.MISSING_TOKEN_ERROR, 401)
+                    user = await session.scalar(User.token_lookup(token))
+                    if not user:
+                        return error(api_auth.INVALID_TOKEN_ERROR, 401)
+                    api_tokens.record_use(token, flask_app)
+                    if permission == MANAGE and not user.can_manage_workmen():
+                        return error(api_auth.MANAGE_WORKMEN_ERROR, 403)
+                    if permission == CLOCK and not user.can_clock_workmen():
+                        return error(api_auth.CLOCK_WORKMEN_ERROR, 403)
+                return await handler(request, session, user, **request.path_params)
+        endpoint.__name__ = handler.__name__
+        endpoint.__doc__ = handler.__doc__
+        return endpoint
+    return decorator
+
+
+def submit_purge(workman, user):
+    with flask_app.app_context():
+        workman_deletion.submit_purge(workman, user)
+
+
+async def get_workman_or_none(session, trn):
+    return await session.scalar(select(Workman).filter_by(trn=trn))
+
+
+async def get_dimension(session, model, name):
+    """Async counterpart of DimensionMixin.get_or_create"""
+    key = model.normalize_name(name).lower()
+    row = await session.scalar(select(model).where(func.lower(model.name) == key))
+    if row is None:
+        row = model(name=model.normalize_name(name))
+        session.add(row)
+    return row
+
+
+async def current_status(session, trn):
+    latest_entry = await session.scalar(
+        select(TimeEntry).filter_by(workman_trn=trn).order_by(TimeEntry.clock_in.desc()).limit(1))
+    if latest_entry and not latest_entry.clock_out:
+        return 'clocked_in'
+    return 'clocked_out'
+
+
+# Authentication endpoints
+@api_route(PUBLIC)
+async def generate_token(request, session, user):
+    """Generate API token for user"""
+    data = await json_body(request)
+    if not data:
+        return error('No JSON data provided', 400)
+
+    username = data.get('username')
+    password = data.get('password')
+
+    if not username or not password:
+        return error('Username and password required', 400)
+
+    # Refuse before the deliberately slow password hash runs
+    limiter = flask_app.extensions.get('rate_limiter')
+    if limiter is not None:
+        client_ip = request.client.host if request.client else None
+        retry_after = await run_in_threadpool(limiter.check, client_ip, username)
+        if retry_after:
+            return JSONResponse(api_auth.rate_limit_error(retry_after), status_code=429,
+                                headers={'Retry-After': str(retry_after)})
+
+    user = await session.scalar(select(User).filter_by(username=username))
+    # Password hashing is CPU bound, keep it off the event loop
+    credentials = flask_app.extensions['credential_cache']
+    if not user or not await run_in_threadpool(credentials.check_password, user, password):
+        return error('Invalid credentials', 401)
+
+    if not user.is_active:
+        return error('Account is deactivated', 401)
+
+    # The device keeps its token; other devices' tokens stay valid
+    device = api_tokens.device_name(data.get('device'))
+    token = await session.scalar(ApiToken.reusable_lookup(user.id, device, api_tokens.reuse_cutoff(flask_app.config)))
+    if token is None:
+        token = ApiToken.issue(user, device, api_tokens.token_ttl(flask_app.config))
+        session.add(token)
+        await session.commit()
+        logger.info("API token issued for user %s on %s", username, device)
+
+    return JSONResponse({
+        'token': token.token,
+        'device': device,
+        'user': serialize_user(user)
+    })
+
+
+@api_route()
+async def revoke_token(request, session, user):
+    """Revoke current API token, or every device's with {"all": true}"""
+    data = await json_body(request) or {}
+    if data.get('all'):
+        await session.execute(delete(ApiToken).where(ApiToken.user_id == user.id))
+    else:
+        token = api_auth.parse_bearer_token(request.headers.get('Authorization'))
+        await session.execute(delete(ApiToken).where(ApiToken.token == token))
+    await session.commit()
+
+    logger.info("API token revoked for user %s", user.username)
+
+    return JSONResponse({'message': 'Token revoked successfully'})
+
+
+@api_route()
+async def get_current_user(request, session, user):
+    """Get current user information"""
+    return JSONResponse(serialize_user_with_permissions(user))
+
+
+# Workmen management endpoints
+@api_route()
+async def list_workmen(request, session, user):
+    """List all workmen"""
+    search = request.query_params.get('search', '')
+    company_id = request.query_params.get('company_id')
+    location_id = request.query_params.get('location_id')
+
+    stmt = select(Workman)
+    if search:
+        stmt = stmt.where(Workman.name.ilike(f'%{search}%'))
+    if company_id and company_id.isdigit():
+        stmt = stmt.where(Workman.company_id == int(company_id))
+    if location_id and location_id.isdigit():
+        stmt = stmt.where(Workman.location_id == int(location_id))
+
+    workmen = (await session.scalars(stmt.order_by(Workman.name))).all()
+
+    # One lookup through the open-entry index instead of a query per workman
+    clocked_in = set((await session.scalars(
+        select(TimeEntry.workman_trn).where(TimeEntry.clock_out.is_(None))
+    )).all())
+
+    return JSONResponse({
+        'workmen': [serialize_workman(w, 'clocked_in' if w.trn in clocked_in else 'clocked_out')
+                    for w in workmen]
+    })
+
+
+@api_route(MANAGE)
+async def create_workman(request, session, user):
+    """Create a new workman"""
+    data = await json_body(request)
+    if not data:
+        return error('No JSON data provided', 400)
+
+    for field in ['trn', 'name', 'company', 'location']:
+        if not data.get(field):
+            return error(f'{field} is required', 400)
+
+    if await session.scalar(Workman.lookup_including_deleted(data['trn'])):
+        return error('TRN already exists', 400)
+
+    workman = Workman(
+        trn=data['trn'],
+        name=data['name'],
+        company_ref=await get_dimension(session, Company, data['company']),
+        location_ref=await get_dimension(session, Location, data['location'])
+    )
+    session.add(workman)
+    await session.commit()
+
+    logger.info("Workman %s created via API by %s", workman.name, user.username)
+
+    return JSONResponse({
+        'message': 'Workman created successfully',
+        'workman': serialize_workman(workman, 'clocked_out')
+    }, status_code=201)
+
+
+@api_route()
+async def get_workman(request, session, user, trn):
+    """Get specific workman details"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    latest_entry = await session.scalar(
+        select(TimeEntry).filter_by(workman_trn=trn).order_by(TimeEntry.clock_in.desc()).limit(1))
+    latest_clock_out = await session.scalar(
+        select(func.max(TimeEntry.clock_out)).where(TimeEntry.workman_trn == trn))
+    is_open = latest_entry is not None and not latest_entry.clock_out
+
+    return JSONResponse(serialize_workman_detail(
+        workman,
+        'clocked_in' if is_open else 'clocked_out',
+        latest_entry.clock_in if is_open else None,
+        latest_clock_out
+    ))
+
+
+@api_route(MANAGE)
+async def update_workman(request, session, user, trn):
+    """Update workman details"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    data = await json_body(request)
+    if not data:
+        return error('No JSON data provided', 400)
+
+    if 'name' in data:
+        workman.name = data['name']
+    if 'company' in data:
+        workman.company_ref = await get_dimension(session, Company, data['company'])
+    if 'location' in data:
+        workman.location_ref = await get_dimension(session, Location, data['location'])
+
+    workman.updated_at = datetime.utcnow()
+    await session.commit()
+
+    logger.info("Workman %s updated via API by %s", workman.trn, user.username)
+
+    return JSONResponse({
+        'message': 'Workman updated successfully',
+        'workman': serialize_workman(workman, await current_status(session, trn))
+    })
+
+
+@api_route(MANAGE)
+async def delete_workman(request, session, user, trn):
+    """Delete workman"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    name = workman.name
+    if flask_app.config['WORKMAN_DELETE_MODE'] == workman_deletion.HARD:
+        # History first: older SQLite databases have no cascading foreign keys
+        session.expunge(workman)
+        for statement in workman_deletion.hard_delete_statements(trn):
+            await session.execute(statement)
+        await session.commit()
+    else:
+        workman.deleted_at = datetime.utcnow()
+        await session.commit()
+        await run_in_threadpool(submit_purge, workman, user)
+
+    logger.info("Workman %s (%s) deleted via API by %s", trn, name, user.username)
+
+    return JSONResponse({'message': f'Workman {name} deleted successfully'})
+
+
+# Company and location lookups
+async def dimension_counts(session, model, column):
+    counts = dict((await session.execute(
+        select(column, func.count(Workman.trn)).group_by(column))).all())
+    rows = (await session.scalars(select(model).order_by(model.name))).all()
+    return [{'id': row.id, 'name': row.name, 'workmen': counts.get(row.id, 0)} for row in rows]
+
+
+@api_route()
+async def list_companies(request, session, user):
+    """List companies with workman counts"""
+    return JSONResponse({'companies': await dimension_counts(session, Company, Workman.company_id)})
+
+
+@api_route()
+async def list_locations(request, session, user):
+    """List locations with workman counts"""
+    return JSONResponse({'locations': await dimension_counts(session, Location, Workman.location_id)})
+
+
+# Time tracking endpoints
+@api_route(CLOCK)
+async def clock_in_workman(request, session, user, trn):
+    """Clock in a workman"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    # Serialize clock changes for this workman so the checks below stay valid
+    await session.execute(Workman.clock_lock_statement(trn))
+
+    existing_entry = await session.scalar(select(TimeEntry).filter_by(workman_trn=trn, clock_out=None))
+    if existing_entry:
+        return error(f'{workman.name} is already clocked in', 400)
+
+    time_entry = TimeEntry(workman_trn=trn, clock_in=datetime.utcnow())
+
+    data = await json_body(request)
+    if data and 'notes' in data:
+        time_entry.notes = data['notes']
+
+    session.add(time_entry)
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Another writer opened an entry first (uq_time_entries_open_workman)
+        await session.rollback()
+        return error(f'{workman.name} is already clocked in', 400)
+
+    await run_in_threadpool(clock_ledger.record, trn, clock_ledger.CLOCK_IN, user.username, 'api', time_entry.clock_in,
+                            notes=time_entry.notes, device_time=clock_ledger.parse_device_time((data or {}).get('device_time')),
+                            app=flask_app)
+    clock_logger.info("Workman %s clocked in via API by %s", trn, user.username,
+                      extra={'event': 'clock_in', 'trn': trn, 'actor': user.username})
+
+    return JSONResponse({
+        'message': f'{workman.name} clocked in successfully',
+        'time_entry': serialize_time_entry(time_entry)
+    })
+
+
+@api_route(CLOCK)
+async def clock_out_workman(request, session, user, trn):
+    """Clock out a workman"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    # Serialize clock changes for this workman so the checks below stay valid
+    await session.execute(Workman.clock_lock_statement(trn))
+
+    active_entry = await session.scalar(select(TimeEntry).filter_by(workman_trn=trn, clock_out=None))
+    if not active_entry:
+        return error('Cannot clock out without clocking in first', 400)
+
+    active_entry.clock_out = datetime.utcnow()
+
+    data = await json_body(request)
+    if data and 'notes' in data:
+        if active_entry.notes:
+            active_entry.notes += f" | {data['notes']}"
+        else:
+            active_entry.notes = data['notes']
+
+    await session.commit()
+
+    await run_in_threadpool(clock_ledger.record, trn, clock_ledger.CLOCK_OUT, user.username, 'api', active_entry.clock_out,
+                            notes=(data or {}).get('notes'),
+                            device_time=clock_ledger.parse_device_time((data or {}).get('device_time')), app=flask_app)
+    clock_logger.info("Workman %s clocked out via API by %s", trn, user.username,
+                      extra={'event': 'clock_out', 'trn': trn, 'actor': user.username})
+
+    return JSONResponse({
+        'message': f'{workman.name} clocked out successfully',
+        'time_entry': serialize_time_entry(active_entry)
+    })
+
+
+@api_route()
+async def get_workman_time_entries(request, session, user, trn):
+    """Get time entries for a workman"""
+    workman = await get_workman_or_none(session, trn)
+    if not workman:
+        return error('Workman not found', 404)
+
+    try:
+        start_dt, end_dt = archive.parse_date_range(request.query_params.get('start_date'),
+                                                    request.query_params.get('end_date'))
+    except ValueError:
+        return error('Dates must use the YYYY-MM-DD format', 400)
+
+    stmt = select(TimeEntry).filter_by(workman_trn=trn)
+    if start_dt:
+        stmt = stmt.where(TimeEntry.clock_in >= start_dt)
+    if end_dt:
+        stmt = stmt.where(TimeEntry.clock_in < end_dt)
+    entries = (await session.scalars(stmt.order_by(TimeEntry.clock_in.desc()))).all()
+
+    # As archive.with_archived_entries: only a range with a start date reads the archive
+    latest_archived = await session.scalar(select(func.max(ArchivedTimeEntry.clock_in))) if start_dt else None
+    if start_dt and archive.reaches_archive(latest_archived, start_dt):
+        archived = (await session.scalars(archive.archived_entries_statement(start_dt, end_dt, trn))).all()
+        entries = sorted([*entries, *archived], key=lambda entry: entry.clock_in, reverse=True)
+
+    return JSONResponse(serialize_time_entries(workman, entries))
+
+
+routes = [
+    Route('/api/v1/auth/token', generate_token, methods=['POST']),
+    Route('/api/v1/auth/revoke', revoke_token, methods=['POST']),
+    Route('/api/v1/me', get_current_user, methods=['GET']),
+    Route('/api/v1/workmen', list_workmen, methods=['GET']),
+    Route('/api/v1/workmen', create_workman, methods=['POST']),
+    Route('/api/v1/workmen/{trn}', get_workman, methods=['GET']),
+    Route('/api/v1/workmen/{trn}', update_workman, methods=['PUT']),
+    Route('/api/v1/workmen/{trn}', delete_workman, methods=['DELETE']),
+    Route('/api/v1/workmen/{trn}/clock-in', clock_in_workman, methods=['POST']),
+    Route('/api/v1/workmen/{trn}/clock-out', clock_out_workman, methods=['POST']),
+    Route('/api/v1/workmen/{trn}/time-entries', get_workman_time_entries, methods=['GET']),
+    Route('/api/v1/companies', list_companies, methods=['GET']),
+    Route('/api/v1/locations', list_locations, methods=['GET']),
+    # Everything else keeps being served by the Flask app
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,235 @@
+"""Per-workman attendance bitmaps for days-worked queries.
+
+Every workman has one bit string with a bit per day, starting at their
+first clock-in (see AttendanceBitmap). A clock-in sets its day's bit in the
+same transaction that inserts the entry, so "how many days did each workman
+attend" and "who attended every day of this week" are popcounts, shifts and
+ANDs/ORs of integers instead of scans over time_entries. Days are the UTC
+dates of clock_in.
+
+Bits are only ever set. Entries deleted or rewritten afterwards (a ledger
+replay, a manual fix) leave their day set until ``flask rebuild-attendance``
+recomputes the bitmaps from the live and archived entries.
+"""
+import click
+import heapq
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, event, insert, select, update
+from app import db
+from models import Workman, TimeEntry, ArchivedTimeEntry, AttendanceBitmap
+import archive
+import sharding
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW_DAYS = 30
+# Set operations across workmen: attended on every listed day, or on any
+SET_OPERATIONS = ('all', 'any')
+
+
+class Bitmap:
+    """Attendance days as an int: bit i is ``start_day`` + i days"""
+
+    __slots__ = ('start_day', 'value')
+
+    def __init__(self, start_day=None, value=0):
+        self.start_day = start_day
+        self.value = value
+
+    @classmethod
+    def from_row(cls, start_day, bits):
+        return cls(start_day, int.from_bytes(bits, 'little'))
+
+    def to_bytes(self):
+        return self.value.to_bytes(max(1, (self.value.bit_length() + 7) // 8), 'little')
+
+    def add(self, day):
+        """Set the bit of ``day``; returns False when it was already set"""
+        if self.start_day is None:
+            self.start_day = day
+        offset = (day - self.start_day).days
+        if offset < 0:
+            # A day before the first one moves the start back
+            self.value <<= -offset
+            self.start_day = day
+            offset = 0
+        bit = 1 << offset
+        if self.value & bit:
+            return False
+        self.value |= bit
+        return True
+
+    def window(self, start, end):
+        """The days from ``start`` to ``end`` (inclusive) as an int whose bit 0 is ``start``"""
+        if self.start_day is None:
+            return 0
+        offset = (start - self.start_day).days
+        value = self.value >> offset if offset >= 0 else self.value << -offset
+        return value & ((1 << window_length(start, end)) - 1)
+
+
+def window_length(start, end):
+    return (end - start).days + 1
+
+
+def window_days(window, start):
+    """Dates of the set bits of a window, oldest first"""
+    days = []
+    while window:
+        lowest = window & -window
+        days.append(start + timedelta(days=lowest.bit_length() - 1))
+        window ^= lowest
+    return days
+
+
+def longest_streak(window):
+    """Longest run of consecutive attended days"""
+    streak = 0
+    while window:
+        # Each step shortens every run by one day
+        window &= window >> 1
+        streak += 1
+    return streak
+
+
+def current_streak(window, length):
+    """Consecutive attended days ending on the window's last day.
+
+    A last day that is not set yet (today, before the first clock-in) does
+    not break the streak; it then ends the day before.
+    """
+    if not window >> (length - 1) & 1:
+        length -= 1
+    gaps = ~window & ((1 << length) - 1)
+    return length - gaps.bit_length()
+
+
+def parse_window(args):
+    """(start, end) dates of the start_date and end_date arguments, the last 30 days by default.
+
+    Raises ValueError for malformed or reversed dates and for windows longer
+    than ATTENDANCE_MAX_DAYS.
+    """
+    try:
+        start_dt, end_dt = archive.parse_date_range(args.get('start_date') or None, args.get('end_date') or None)
+    except ValueError:
+        raise ValueError('Dates must use the YYYY-MM-DD format')
+    end = (end_dt - timedelta(days=1)).date() if end_dt else datetime.utcnow().date()
+    start = start_dt.date() if start_dt else end - timedelta(days=DEFAULT_WINDOW_DAYS - 1)
+    if start > end:
+        raise ValueError('start_date must not be after end_date')
+    max_days = current_app.config['ATTENDANCE_MAX_DAYS']
+    if window_length(start, end) > max_days:
+        raise ValueError(f'The date range cannot exceed {max_days} days')
+    return start, end
+
+
+def summarize_window(window, start, end):
+    """JSON-ready days-worked count, streaks and dates of one window"""
+    return {
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'days_in_range': window_length(start, end),
+        'days_worked': window.bit_count(),
+        'longest_streak': longest_streak(window),
+        'current_streak': current_streak(window, window_length(start, end)),
+        'days': [day.isoformat() for day in window_days(window, start)],
+    }
+
+
+def workman_window(trn, start, end):
+    """Attendance window of one workman; 0 when they never clocked in"""
+    row = db.session.execute(
+        select(AttendanceBitmap.start_day, AttendanceBitmap.bits).where(AttendanceBitmap.workman_trn == trn)
+    ).first()
+    return Bitmap.from_row(*row).window(start, end) if row else 0
+
+
+def roster_windows(start, end, company_id=None, location_id=None):
+    """(trn, name, window) of every workman matching the filters, by name, across shards"""
+    parts = sharding.gather(_shard_windows, start, end, company_id, location_id,
+                            shards=sharding.shards_for(company_id=company_id))
+    return list(heapq.merge(*parts, key=lambda row: row[1]))
+
+
+def _shard_windows(start, end, company_id, location_id):
+    query = (select(Workman.trn, Workman.name, AttendanceBitmap.start_day, AttendanceBitmap.bits)
+             .outerjoin(AttendanceBitmap).order_by(Workman.name))
+    if company_id:
+        query = query.where(Workman.company_id == company_id)
+    if location_id:
+        query = query.where(Workman.location_id == location_id)
+    return [(trn, name, Bitmap.from_row(start_day, bits).window(start, end) if bits is not None else 0)
+            for trn, name, start_day, bits in db.session.execute(query)]
+
+
+def combine_windows(windows, op, length):
+    """Days attended by every workman (``all``) or by at least one (``any``)"""
+    if op == 'all':
+        combined = (1 << length) - 1 if windows else 0
+        for window in windows:
+            combined &= window
+    else:
+        combined = 0
+        for window in windows:
+            combined |= window
+    return combined
+
+
+def _record_clock_in(mapper, connection, target):
+    """Set the clock-in day's bit, in the transaction inserting the entry.
+
+    Every clock-in path holds Workman.clock_lock_statement first, so the
+    read-modify-write never races another clock-in of the same workman.
+    """
+    table = AttendanceBitmap.__table__
+    day = target.clock_in.date()
+    row = connection.execute(
+        select(table.c.start_day, table.c.bits).where(table.c.workman_trn == target.workman_trn)
+    ).first()
+    if row is None:
+        connection.execute(insert(table).values(
+            workman_trn=target.workman_trn, start_day=day, bits=b'\x01', updated_at=datetime.utcnow()))
+        return
+    bitmap = Bitmap.from_row(*row)
+    if bitmap.add(day):
+        connection.execute(update(table).where(table.c.workman_trn == target.workman_trn).values(
+            start_day=bitmap.start_day, bits=bitmap.to_bytes(), updated_at=datetime.utcnow()))
+
+
+def rebuild_bitmaps(batch_size=1000):
+    """Recompute this shard's bitmaps from the live and archived entries; returns how many were written"""
+    bitmaps = defaultdict(Bitmap)
+    for model in (TimeEntry, ArchivedTimeEntry):
+        rows = db.session.execute(
+            select(model.workman_trn, model.clock_in).execution_options(yield_per=batch_size))
+        for trn, clock_in in rows:
+            bitmaps[trn].add(clock_in.date())
+
+    now = datetime.utcnow()
+    rows = [{'workman_trn': trn, 'start_day': bitmap.start_day, 'bits': bitmap.to_bytes(), 'updated_at': now}
+            for trn, bitmap in bitmaps.items()]
+    db.session.execute(delete(AttendanceBitmap))
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(insert(AttendanceBitmap), rows[i:i + batch_size])
+    db.session.commit()
+    return len(rows)
+
+
+@click.command('rebuild-attendance')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Rows per insert')
+def rebuild_attendance_command(batch_size):
+    """Recompute every workman's attendance bitmap from the time entries"""
+    written = sum(sharding.gather(rebuild_bitmaps, batch_size))
+    logger.info("Rebuilt %s attendance bitmaps", written)
+    click.echo(f'Rebuilt {written} attendance bitmaps')
+
+
+def init_app(app):
+    """Keep the bitmaps current on clock-in and register the rebuild command"""
+    if not event.contains(TimeEntry, 'after_insert', _record_clock_in):
+        event.listen(TimeEntry, 'after_insert', _record_clock_in)
+    app.cli.add_command(rebuild_attendance_command)
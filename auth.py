@@ -4,6 +4,9 @@ from forms import LoginForm, RegistrationForm
 from models import User, UserRole
 from app import db
 import logging
+import rate_limit
+
+logger = logging.getLogger(__name__)
 
 # Create auth blueprint
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -16,6 +19,12 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Refuse before the deliberately slow password hash runs
+        retry_after = rate_limit.check_credentials_attempt(form.username.data)
+        if retry_after:
+            flash(f'Too many login attempts. Please try again in {retry_after} seconds.', 'error')
+            return render_template('auth/login.html', form=form), 429, {'Retry-After': str(retry_after)}
+        
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password', 'error')
@@ -51,12 +60,12 @@ def register():
         try:
             db.session.commit()
             flash('Registration successful! You can now log in.', 'success')
-            logging.info(f"New user registered: {user.username} ({user.role.value})")
+            logger.info("New user registered: %s (%s)", user.username, user.role.value)
             return redirect(url_for('auth.login'))
         except Exception as e:
             db.session.rollback()
             flash('Registration failed. Please try again.', 'error')
-            logging.error(f"Registration error: {e}")
+            logger.error("Registration error: %s", e)
     
     return render_template('auth/register.html', form=form)
 
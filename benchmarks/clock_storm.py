@@ -0,0 +1,207 @@
+"""Concurrent clock-in/out load test and correctness check.
+
+Simulates many devices hammering the clock endpoints of a small set of
+workmen at once, through the API (``/api/v1/workmen/<trn>/clock-in|clock-out``)
+and/or the HTML routes (``/workman/<trn>/clock_in|clock_out``), from a thread
+or process pool. Each device has its own HTTP session. Afterwards it reports
+throughput and latency percentiles and checks the invariants the clock logic
+must keep under contention:
+
+* no workman has more than one open entry
+* no two entries of a workman overlap, and none ends before it starts
+
+Against an in-process threaded server (throwaway SQLite by default)::
+
+    python -m benchmarks.clock_storm --devices 200 --requests 20 --workmen 20
+
+Against gunicorn with several workers sharing a database::
+
+    DATABASE_URL=postgresql:///bench gunicorn -w 4 -b 127.0.0.1:8000 main:app
+    python -m benchmarks.clock_storm --base-url http://127.0.0.1:8000 \\
+        --database-url postgresql:///bench --executor process
+
+Exits with status 1 when an invariant is violated.
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks import datagen
+from benchmarks.drivers import HttpDriver, api_token, serve
+from benchmarks.stats import latency_summary
+
+ROUTES = {
+    'api': ('/api/v1/workmen/{trn}/clock-in', '/api/v1/workmen/{trn}/clock-out'),
+    'html': ('/workman/{trn}/clock_in', '/workman/{trn}/clock_out'),
+}
+
+# Refusals the endpoints give when the workman is already in / not in
+EXPECTED = {'api': {200, 400}, 'html': {302}}
+
+
+def run_device(device, base_url, mode, trns, requests, seed, headers):
+    """One device's sequence of clock requests; returns (kind, status, seconds) samples"""
+    rng = random.Random(f'{seed}:{device}')
+    driver = HttpDriver(base_url)
+    if mode in ('html', 'mixed'):
+        driver.login_session(datagen.BENCH_USERNAME, datagen.BENCH_PASSWORD)
+
+    samples = []
+    for _ in range(requests):
+        surface = rng.choice(('api', 'html')) if mode == 'mixed' else mode
+        action = rng.randrange(2)
+        path = ROUTES[surface][action].format(trn=rng.choice(trns))
+        started = time.perf_counter()
+        try:
+            if surface == 'api':
+                status, _ = driver.request('POST', path, headers=headers, json_body={})
+            else:
+                status, _ = driver.request('POST', path, form={})
+        except OSError:
+            status = 0
+        samples.append((f"{surface}_{('clock_in', 'clock_out')[action]}", status, time.perf_counter() - started))
+    return samples
+
+
+def storm(base_url, mode, trns, devices, requests, seed, executor_class):
+    """Fire every device at once and collect their samples"""
+    headers = api_token(HttpDriver(base_url), datagen.BENCH_USERNAME, datagen.BENCH_PASSWORD)
+    started = time.perf_counter()
+    with executor_class(max_workers=devices) as executor:
+        futures = [executor.submit(run_device, device, base_url, mode, trns, requests, seed, headers)
+                   for device in range(devices)]
+        samples = [sample for future in futures for sample in future.result()]
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    by_kind = defaultdict(list)
+    statuses = defaultdict(Counter)
+    errors = 0
+    for kind, status, seconds in samples:
+        by_kind[kind].append(seconds)
+        statuses[kind][status] += 1
+        if status not in EXPECTED[kind.split('_', 1)[0]]:
+            errors += 1
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': latency_summary([seconds for _, _, seconds in samples]),
+        'by_endpoint': {kind: {
+            'requests': len(by_kind[kind]),
+            'statuses': dict(statuses[kind]),
+            'latency_ms': latency_summary(by_kind[kind]),
+        } for kind in sorted(by_kind)},
+    }
+
+
+def check_invariants(trns):
+    """Violations of the open-entry and no-overlap rules for the given workmen"""
+    from sqlalchemy import func, select
+    from app import db
+    from models import TimeEntry
+
+    double_open = db.session.execute(
+        select(TimeEntry.workman_trn, func.count(TimeEntry.id))
+        .where(TimeEntry.clock_out.is_(None), TimeEntry.workman_trn.in_(trns))
+        .group_by(TimeEntry.workman_trn)
+        .having(func.count(TimeEntry.id) > 1)
+    ).all()
+
+    previous_out = func.lag(TimeEntry.clock_out).over(partition_by=TimeEntry.workman_trn,
+                                                      order_by=(TimeEntry.clock_in, TimeEntry.id))
+    previous_id = func.lag(TimeEntry.id).over(partition_by=TimeEntry.workman_trn,
+                                              order_by=(TimeEntry.clock_in, TimeEntry.id))
+    ordered = select(TimeEntry.id, TimeEntry.workman_trn, TimeEntry.clock_in, TimeEntry.clock_out,
+                     previous_id.label('previous_id'), previous_out.label('previous_out')) \
+        .where(TimeEntry.workman_trn.in_(trns)).subquery()
+    # An entry overlaps the one before it if that one is still open or ends after this one starts
+    overlaps = db.session.execute(
+        select(ordered.c.workman_trn, ordered.c.previous_id, ordered.c.id)
+        .where(ordered.c.previous_id.is_not(None))
+        .where((ordered.c.previous_out.is_(None)) | (ordered.c.previous_out > ordered.c.clock_in))
+    ).all()
+
+    inverted = db.session.execute(
+        select(TimeEntry.workman_trn, TimeEntry.id)
+        .where(TimeEntry.workman_trn.in_(trns), TimeEntry.clock_out < TimeEntry.clock_in)
+    ).all()
+
+    return {
+        'double_open': [{'trn': trn, 'open_entries': count} for trn, count in double_open],
+        'overlapping': [{'trn': trn, 'entries': [first, second]} for trn, first, second in overlaps],
+        'clock_out_before_clock_in': [{'trn': trn, 'entry': entry_id} for trn, entry_id in inverted],
+    }
+
+
+def storm_workmen(count):
+    """TRNs of the first ``count`` workmen, generating them if the database has too few"""
+    from sqlalchemy import select
+    from app import db
+    from models import Workman
+
+    trns = list(db.session.scalars(select(Workman.trn).order_by(Workman.trn).limit(count)))
+    if len(trns) < count:
+        datagen.generate(workmen=count, companies=2, locations=2, days=0)
+        trns = list(db.session.scalars(select(Workman.trn).order_by(Workman.trn).limit(count)))
+    return trns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', help='Server to load; defaults to an in-process threaded server')
+    parser.add_argument('--database-url', help='Database the server uses; a throwaway SQLite file by default')
+    parser.add_argument('--mode', choices=('api', 'html', 'mixed'), default='api')
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--devices', type=int, default=100, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per device')
+    parser.add_argument('--workmen', type=int, default=20, help='Workmen the devices contend for')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.base_url and not args.database_url:
+        parser.error('--database-url is required with --base-url to check invariants')
+
+    database_url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/storm.db"
+    app = datagen.build_app(database_url)
+    with app.app_context():
+        trns = storm_workmen(args.workmen)
+        datagen.ensure_bench_user()
+
+    executor_class = ProcessPoolExecutor if args.executor == 'process' else ThreadPoolExecutor
+    if args.base_url:
+        samples, elapsed = storm(args.base_url, args.mode, trns, args.devices, args.requests, args.seed,
+                                 executor_class)
+    else:
+        with serve(app) as base_url:
+            samples, elapsed = storm(base_url, args.mode, trns, args.devices, args.requests, args.seed,
+                                     executor_class)
+
+    with app.app_context():
+        violations = check_invariants(trns)
+
+    ok = not any(violations.values())
+    print(json.dumps({
+        'benchmark': 'clock_storm',
+        'started_at': datetime.utcnow().isoformat(),
+        'mode': args.mode,
+        'executor': args.executor,
+        'devices': args.devices,
+        'workmen': len(trns),
+        'results': summarize(samples, elapsed),
+        'invariants_ok': ok,
+        'violations': violations,
+    }, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Synthetic data generator for benchmarks.
+
+Creates N workmen spread over M companies and L locations, each with a
+realistic clock history: mostly weekday shifts starting in the early morning,
+some split shifts around a break, the odd weekend, and an open entry for
+workmen who are on shift right now. Rows are streamed into the database in
+batches through executemany, so tens of millions of time entries can be loaded
+into SQLite or a local PostgreSQL without holding them in memory:
+
+    python -m benchmarks.datagen --database-url sqlite:////tmp/bench.db \\
+        --workmen 5000 --companies 50 --locations 200 --days 365
+
+Output is deterministic for a given --seed and --end-date.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+BENCH_USERNAME = 'bench-admin'
+BENCH_PASSWORD = 'bench-password'
+
+
+def shifts(rng, day, now):
+    """Clock spans for one workman on one day; an unfinished span has no clock-out"""
+    weekend = day.weekday() >= 5
+    if rng.random() > (0.15 if weekend else 0.9):
+        return []
+
+    start = datetime.combine(day, datetime.min.time()) + timedelta(
+        hours=min(max(rng.gauss(7.5, 0.75), 5.0), 11.0))
+    length = timedelta(hours=min(max(rng.gauss(8.5, 1.0), 4.0), 12.0))
+
+    if rng.random() < 0.25:
+        first = length * rng.uniform(0.4, 0.6)
+        resume = start + first + timedelta(minutes=rng.randint(30, 60))
+        spans = [(start, start + first), (resume, resume + length - first)]
+    else:
+        spans = [(start, start + length)]
+
+    result = []
+    for clock_in, clock_out in spans:
+        if clock_in >= now:
+            break
+        if clock_out > now:
+            result.append((clock_in, None))
+            break
+        result.append((clock_in, clock_out))
+    return result
+
+
+def time_entry_rows(trns, days, seed, end_date):
+    """Yield time entry rows for every workman, oldest day first per workman"""
+    now = datetime.combine(end_date, datetime.min.time()) + timedelta(hours=12)
+    first_day = end_date - timedelta(days=days - 1)
+    for trn in trns:
+        rng = random.Random(f'{seed}:{trn}')
+        for offset in range(days):
+            for clock_in, clock_out in shifts(rng, first_day + timedelta(days=offset), now):
+                yield {'workman_trn': trn, 'clock_in': clock_in, 'clock_out': clock_out}
+
+
+def _batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ensure_bench_user():
+    """Admin user the scenarios authenticate as; returns its API token"""
+    from app import db
+    from models import User, UserRole
+    import api_tokens
+
+    user = User.query.filter_by(username=BENCH_USERNAME).first()
+    if user is None:
+        user = User(username=BENCH_USERNAME, email='bench-admin@example.com', role=UserRole.ADMIN)
+        user.set_password(BENCH_PASSWORD)
+        db.session.add(user)
+    db.session.commit()
+    return api_tokens.issue_token(user, 'benchmark')
+
+
+def generate(workmen=1000, companies=20, locations=50, days=90, seed=1, batch_size=10000, end_date=None):
+    """Load a synthetic dataset into the current app's database"""
+    from sqlalchemy import insert, text
+    from app import db
+    from models import Company, Location, Workman, TimeEntry
+
+    end_date = end_date or date.today()
+    started = time.perf_counter()
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('PRAGMA synchronous=OFF'))
+
+    rng = random.Random(seed)
+    company_rows = [Company.get_or_create(f'Company {i:04d}') for i in range(companies)]
+    location_rows = [Location.get_or_create(f'Location {i:04d}') for i in range(locations)]
+    db.session.commit()
+    company_ids = [company.id for company in company_rows]
+    location_ids = [location.id for location in location_rows]
+
+    trns = [f'BENCH{i:08d}' for i in range(workmen)]
+    workman_rows = [{
+        'trn': trn,
+        'name': f'Workman {i:08d}',
+        'company_id': rng.choice(company_ids),
+        'location_id': rng.choice(location_ids),
+    } for i, trn in enumerate(trns)]
+    for batch in _batched(workman_rows, batch_size):
+        db.session.execute(insert(Workman), batch)
+    db.session.commit()
+
+    entries = 0
+    for batch in _batched(time_entry_rows(trns, days, seed, end_date), batch_size):
+        db.session.execute(insert(TimeEntry), batch)
+        db.session.commit()
+        entries += len(batch)
+
+    return {
+        'workmen': workmen,
+        'companies': companies,
+        'locations': locations,
+        'days': days,
+        'seed': seed,
+        'end_date': end_date.isoformat(),
+        'time_entries': entries,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def dataset_summary():
+    """Row counts of the tables the scenarios read"""
+    from sqlalchemy import func
+    from app import db
+    from models import Company, Location, Workman, TimeEntry
+
+    return {
+        'workmen': db.session.query(func.count(Workman.trn)).scalar(),
+        'companies': db.session.query(func.count(Company.id)).scalar(),
+        'locations': db.session.query(func.count(Location.id)).scalar(),
+        'time_entries': db.session.query(func.count(TimeEntry.id)).scalar(),
+        'open_entries': db.session.query(func.count(TimeEntry.id)).filter(TimeEntry.clock_out.is_(None)).scalar(),
+    }
+
+
+def build_app(database_url):
+    """App bound to ``database_url`` with background jobs and rate limiting off and the schema created"""
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('STALE_ENTRY_JOB_ENABLED', 'false')
+    # Every simulated device logs in from the same address
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import create_app, init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--workmen', type=int, default=1000)
+    parser.add_argument('--companies', type=int, default=20)
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--end-date', type=date.fromisoformat, default=None,
+                        help='Last generated day (defaults to today)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', required=True)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    app = build_app(args.database_url)
+    with app.app_context():
+        result = generate(args.workmen, args.companies, args.locations, args.days, args.seed,
+                          args.batch_size, args.end_date)
+        ensure_bench_user()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Ways of sending requests to the app, shared by the benchmark scripts.
+
+``TestClientDriver`` goes through the Flask test client (no sockets), and
+``HttpDriver`` talks HTTP through urllib to a real WSGI server, either one
+started in-process with :func:`serve` or an external gunicorn.
+"""
+import http.cookiejar
+import json
+import re
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+_CSRF_FIELD = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"|value="([^"]+)"[^>]*name="csrf_token"')
+
+
+class TestClientDriver:
+    """Requests through the Flask test client"""
+
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, json_body=None, form=None):
+        response = self.client.open(path, method=method, headers=headers, json=json_body, data=form)
+        return response.status_code, response.get_data()
+
+    def login_session(self, username, password):
+        """Log in to the HTML routes by writing the Flask-Login session directly"""
+        from models import User
+
+        with self.app.app_context():
+            user = User.query.filter_by(username=username).first()
+            user_id = str(user.id)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = user_id
+            session['_fresh'] = True
+
+
+class HttpDriver:
+    """Requests over HTTP with urllib; keeps cookies for the HTML routes"""
+
+    name = 'http'
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies),
+                                                  _NoRedirect())
+
+    def request(self, method, path, headers=None, json_body=None, form=None):
+        headers = dict(headers or {})
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def login_session(self, username, password):
+        """Log in through the HTML login form, scraping its CSRF token"""
+        status, body = self.request('GET', '/auth/login')
+        match = _CSRF_FIELD.search(body.decode(errors='replace'))
+        if status != 200 or not match:
+            raise RuntimeError(f'Could not load the login form (HTTP {status})')
+        status, _ = self.request('POST', '/auth/login', form={
+            'csrf_token': match.group(1) or match.group(2),
+            'username': username,
+            'password': password,
+        })
+        if status not in (302, 303):
+            raise RuntimeError(f'HTML login failed (HTTP {status})')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def api_token(driver, username, password):
+    """Fetch an API token and return the Authorization header for it"""
+    status, body = driver.request('POST', '/api/v1/auth/token',
+                                  json_body={'username': username, 'password': password})
+    if status != 200:
+        raise RuntimeError(f'Could not get an API token (HTTP {status})')
+    return {'Authorization': f"Bearer {json.loads(body)['token']}"}
+
+
+@contextmanager
+def serve(app, host='127.0.0.1', port=0):
+    """Run ``app`` on a threaded werkzeug server and yield its base URL"""
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True)
+    thread.start()
+    try:
+        yield f'http://{host}:{server.server_port}'
+    finally:
+        server.shutdown()
+        thread.join()
@@ -0,0 +1,119 @@
+"""Benchmark suite runner.
+
+Generates (or reuses) a synthetic dataset, runs the scenarios in scenarios.py
+through the Flask test client and a real threaded WSGI server, and prints JSON
+that can be diffed across runs:
+
+    python -m benchmarks.run --workmen 2000 --days 180 --iterations 50 > before.json
+    python -m benchmarks.run --database-url sqlite:////tmp/bench.db --reuse > after.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks import datagen
+from benchmarks.drivers import HttpDriver, TestClientDriver, serve
+from benchmarks.scenarios import SCENARIOS, ScenarioContext
+from benchmarks.stats import latency_summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(ctx, scenario, iterations, warmup):
+    """Time ``iterations`` runs of one scenario after ``warmup`` untimed ones"""
+    for _ in range(warmup):
+        scenario(ctx)
+
+    durations = []
+    requests = errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        op_started = time.perf_counter()
+        statuses = scenario(ctx)
+        durations.append(time.perf_counter() - op_started)
+        requests += len(statuses)
+        # Scenarios only issue requests that succeed without a redirect
+        errors += sum(1 for status in statuses if status >= 300)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'iterations': iterations,
+        'requests': requests,
+        'errors': errors,
+        'operations_per_second': round(iterations / elapsed, 2) if elapsed else None,
+        'latency_ms': latency_summary(durations),
+    }
+
+
+def run_driver(app, driver, names, args):
+    ctx = ScenarioContext(app, driver, seed=args.seed)
+    return {name: run_scenario(ctx, SCENARIOS[name], args.iterations, args.warmup) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='Defaults to a throwaway SQLite file')
+    parser.add_argument('--reuse', action='store_true', help='Use the existing data instead of generating')
+    parser.add_argument('--drivers', default='test_client,http')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    datagen.add_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    database_url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    app = datagen.build_app(database_url)
+    from app import db
+    with app.app_context():
+        generated = None
+        if not args.reuse:
+            generated = datagen.generate(args.workmen, args.companies, args.locations, args.days, args.seed,
+                                         args.batch_size, args.end_date)
+        datagen.ensure_bench_user()
+        dataset = datagen.dataset_summary()
+        dialect = db.engine.dialect.name
+
+    results = {}
+    for driver_name in args.drivers.split(','):
+        if driver_name == 'test_client':
+            results[driver_name] = run_driver(app, TestClientDriver(app), names, args)
+        elif driver_name == 'http':
+            with serve(app) as base_url:
+                results[driver_name] = run_driver(app, HttpDriver(base_url), names, args)
+        else:
+            parser.error(f'unknown driver: {driver_name}')
+
+    print(json.dumps({
+        'benchmark': 'suite',
+        'started_at': datetime.utcnow().isoformat(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'database': dialect,
+        'seed': args.seed,
+        'iterations': args.iterations,
+        'warmup': args.warmup,
+        'generated': generated,
+        'dataset': dataset,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
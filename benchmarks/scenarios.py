@@ -0,0 +1,93 @@
+"""Scripted request scenarios.
+
+Each scenario is one repeatable operation against a driver (see drivers.py);
+it returns the HTTP statuses of the requests it made so the runner can count
+errors. ``ScenarioContext`` picks its workmen and date ranges from a seeded RNG
+so runs against the same dataset are comparable.
+"""
+import random
+import sys
+from datetime import date, timedelta
+
+from benchmarks.datagen import BENCH_PASSWORD, BENCH_USERNAME
+from benchmarks.drivers import api_token
+
+CLOCK_BURST_SIZE = 20
+
+
+class ScenarioContext:
+    """Authentication and sample data the scenarios draw from"""
+
+    def __init__(self, app, driver, seed=1):
+        from sqlalchemy import select
+        from app import db
+        from models import Company, Workman
+
+        self.driver = driver
+        self.rng = random.Random(seed)
+        with app.app_context():
+            self.trns = list(db.session.scalars(select(Workman.trn).order_by(Workman.trn)))
+            self.idle_trns = sorted(set(self.trns) - Workman.clocked_in_trns())
+            self.company_ids = list(db.session.scalars(select(Company.id)))
+        self.headers = api_token(driver, BENCH_USERNAME, BENCH_PASSWORD)
+        try:
+            driver.login_session(BENCH_USERNAME, BENCH_PASSWORD)
+        except RuntimeError as e:
+            # HTML scenarios will then be redirected to the login page and count as errors
+            print(f'{driver.name}: HTML login failed: {e}', file=sys.stderr)
+        self.end_date = date.today()
+
+    def workman(self):
+        return self.rng.choice(self.trns)
+
+    def date_range(self, days):
+        end = self.end_date - timedelta(days=self.rng.randint(0, 30))
+        return (end - timedelta(days=days - 1)).isoformat(), end.isoformat()
+
+
+def list_workmen(ctx):
+    return [ctx.driver.request('GET', '/api/v1/workmen', headers=ctx.headers)[0]]
+
+
+def list_workmen_by_company(ctx):
+    path = f'/api/v1/workmen?company_id={ctx.rng.choice(ctx.company_ids)}'
+    return [ctx.driver.request('GET', path, headers=ctx.headers)[0]]
+
+
+def get_workman(ctx):
+    return [ctx.driver.request('GET', f'/api/v1/workmen/{ctx.workman()}', headers=ctx.headers)[0]]
+
+
+def api_time_entries(ctx):
+    path = f'/api/v1/workmen/{ctx.workman()}/time-entries'
+    return [ctx.driver.request('GET', path, headers=ctx.headers)[0]]
+
+
+def clock_burst(ctx):
+    """Clock a burst of idle workmen in, then out again"""
+    trns = ctx.rng.sample(ctx.idle_trns, min(CLOCK_BURST_SIZE, len(ctx.idle_trns)))
+    statuses = [ctx.driver.request('POST', f'/api/v1/workmen/{trn}/clock-in', headers=ctx.headers, json_body={})[0]
+                for trn in trns]
+    statuses += [ctx.driver.request('POST', f'/api/v1/workmen/{trn}/clock-out', headers=ctx.headers, json_body={})[0]
+                 for trn in trns]
+    return statuses
+
+
+def reports(ctx):
+    start_date, end_date = ctx.date_range(7)
+    return [ctx.driver.request('GET', f'/reports?start_date={start_date}&end_date={end_date}')[0]]
+
+
+def workman_time_history(ctx):
+    return [ctx.driver.request('GET', f'/workman/{ctx.workman()}/time_history')[0]]
+
+
+SCENARIOS = {
+    'list_workmen': list_workmen,
+    'list_workmen_by_company': list_workmen_by_company,
+    'get_workman': get_workman,
+    'api_time_entries': api_time_entries,
+    'clock_burst': clock_burst,
+    'reports': reports,
+    'workman_time_history': workman_time_history,
+}
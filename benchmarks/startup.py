@@ -0,0 +1,77 @@
+"""Startup-time benchmark.
+
+Measures, in fresh interpreter processes, how long it takes to import the WSGI
+entry point and to serve the first requests. Prints JSON so results can be
+compared across runs:
+
+    python -m benchmarks.startup --runs 5 > startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs inside each child process; prints one JSON line of timings in seconds
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+client.get("/api/v1/me")
+first_request = time.perf_counter()
+client.post("/api/v1/auth/token", json={"username": "nobody", "password": "x"})
+first_db_request = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "first_request": first_request - imported,
+    "first_db_request": first_db_request - first_request,
+}))
+'''
+
+
+def run_probe(env):
+    """Run the probe in a new interpreter and return its timings"""
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - started
+    return timings
+
+
+def summarize(samples):
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--database-url', help='Defaults to a throwaway SQLite file')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root, STALE_ENTRY_JOB_ENABLED='false')
+    env['DATABASE_URL'] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/startup.db"
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'main', 'init-db'],
+                   env=env, cwd=root, check=True, capture_output=True)
+
+    runs = [run_probe(env) for _ in range(args.runs)]
+    print(json.dumps({
+        'benchmark': 'startup',
+        'runs': args.runs,
+        'python': sys.version.split()[0],
+        'seconds': {key: summarize([run[key] for run in runs]) for key in runs[0]},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
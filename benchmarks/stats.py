@@ -0,0 +1,26 @@
+"""Latency summaries shared by the benchmark scripts"""
+import statistics
+
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def latency_summary(seconds):
+    """Latency statistics in milliseconds"""
+    samples = sorted(value * 1000 for value in seconds)
+    if not samples:
+        return {}
+    return {
+        'mean': round(statistics.fmean(samples), 3),
+        'median': round(statistics.median(samples), 3),
+        'p90': round(percentile(samples, 0.90), 3),
+        'p95': round(percentile(samples, 0.95), 3),
+        'p99': round(percentile(samples, 0.99), 3),
+        'min': round(samples[0], 3),
+        'max': round(samples[-1], 3),
+    }
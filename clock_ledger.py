@@ -0,0 +1,308 @@
+"""Append-only ledger of clock events with write-behind batching.
+
+Every clock-in, clock-out and stale-entry resolution is recorded as a
+ClockEvent: the workman, the action, who performed it, from which surface,
+the server time applied to the time entry and, when the device sent one, its
+own clock. Request threads only append the event to a bounded in-process
+buffer; a flusher thread writes the buffer in batched INSERTs every
+CLOCK_LEDGER_FLUSH_INTERVAL_MS or as soon as CLOCK_LEDGER_BATCH_SIZE events
+are waiting. When the buffer holds CLOCK_LEDGER_BUFFER_SIZE events, writers
+wait for the flusher instead of dropping audit records. While flushes fail
+(e.g. the database is down) the flusher retries with a growing delay, up to
+RETRY_MAX_SECONDS, and keeps the events.
+
+CLOCK_LEDGER_DURABILITY chooses when a request may respond:
+
+    buffered    as soon as the event is buffered; events of a crashed process
+                that were not flushed yet are lost (the default)
+    sync        after the buffer, including this event, was written; if
+                that write fails the event stays buffered for retry and
+                the failure is logged, since the time entry is already
+                committed and the request must not report it as lost
+
+Time entries are a projection of the ledger: ``flask replay-clock-events``
+rebuilds them from the recorded events.
+"""
+import atexit
+import click
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from flask import current_app, g, has_app_context
+from sqlalchemy import delete, insert, select
+from app import db
+from models import ClockEvent, TimeEntry, Workman
+import archive
+import sharding
+
+logger = logging.getLogger(__name__)
+
+CLOCK_IN = 'clock_in'
+CLOCK_OUT = 'clock_out'
+# Adds to the open entry's notes without closing it (e.g. a stale-entry flag)
+NOTE = 'note'
+
+BUFFERED = 'buffered'
+SYNC = 'sync'
+
+# Longest wait between flush attempts while the database keeps failing
+RETRY_MAX_SECONDS = 30
+
+
+def append_note(notes, note):
+    """Notes with ``note`` added the way clock-out notes are appended"""
+    return f"{notes} | {note}" if notes else note
+
+
+def parse_device_time(value):
+    """Device clock from a request body as a naive UTC datetime, or None if missing or unparsable"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def make_event(trn, action, actor, source, occurred_at, notes=None, device_time=None):
+    """Row for the clock_events table"""
+    return {
+        'event_id': uuid.uuid4().hex,
+        'workman_trn': trn,
+        'action': action,
+        'actor': actor,
+        'source': source,
+        'occurred_at': occurred_at,
+        'device_time': device_time,
+        'notes': notes,
+    }
+
+
+class ClockLedger:
+    """Bounded buffer of clock events and the thread that flushes it"""
+
+    def __init__(self, app, buffer_size, batch_size, flush_interval, durability):
+        self.app = app
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.flush_failures = 0
+        self._events = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def _ensure_flusher(self):
+        # Threads do not survive fork, each worker starts its own
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._events.clear()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='clock-ledger', daemon=True)
+                    self._thread.start()
+
+    def record(self, event):
+        """Buffer an event; with sync durability, return only once it is written"""
+        self._ensure_flusher()
+        with self._cond:
+            while len(self._events) >= self.buffer_size:
+                # Back-pressure: wait for the flusher rather than lose the event
+                self._cond.notify_all()
+                self._cond.wait(self.flush_interval)
+            self._events.append(event)
+            if len(self._events) >= self.batch_size:
+                self._cond.notify_all()
+        if self.durability == SYNC:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Clock ledger write failed, event %s kept for retry: %s", event['event_id'], e,
+                             extra={'event_id': event['event_id'], 'trn': event['workman_trn']})
+
+    def flush(self):
+        """Write every buffered event in batched inserts; returns how many were written"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+                if not batch:
+                    return written
+                try:
+                    with self.app.app_context():
+                        with db.engine.begin() as conn:
+                            conn.execute(insert(ClockEvent), batch)
+                except Exception:
+                    with self._cond:
+                        # Put the batch back in order for the next attempt
+                        self._events.extendleft(reversed(batch))
+                    self.flush_failures += 1
+                    raise
+                written += len(batch)
+                with self._cond:
+                    self._cond.notify_all()
+
+    def flush_at_exit(self):
+        if self._events:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Clock ledger lost %s unflushed events at exit: %s", len(self._events), e)
+
+    def _run(self):
+        retry_delay = 0
+        while True:
+            if retry_delay:
+                # However many events are waiting, never retry a failing database in a tight loop
+                time.sleep(retry_delay)
+            else:
+                with self._cond:
+                    if len(self._events) < self.batch_size:
+                        self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+                retry_delay = 0
+            except Exception as e:
+                retry_delay = min(max(retry_delay * 2, self.flush_interval), RETRY_MAX_SECONDS)
+                logger.error("Clock ledger flush failed, %s events kept for retry in %ss: %s",
+                             len(self._events), retry_delay, e)
+
+
+def ledger(app=None):
+    return (app or current_app).extensions['clock_ledger']
+
+
+def record(trn, action, actor, source, occurred_at, notes=None, device_time=None, app=None):
+    """Append a clock event to the app's ledger.
+
+    Inside an atomic API batch the event is held back and only recorded once
+    the batch commits (see api_batch.py).
+    """
+    event = make_event(trn, action, actor, source, occurred_at, notes, device_time)
+    deferred = g.get('clock_events_deferred') if has_app_context() else None
+    if deferred is not None:
+        deferred.append(event)
+        return
+    ledger(app).record(event)
+
+
+def _replay_workman(trn, events, since):
+    """Rebuild one workman's entries from ``since`` onwards; returns entries written"""
+    db.session.execute(Workman.clock_lock_statement(trn))
+    db.session.execute(delete(TimeEntry).where(TimeEntry.workman_trn == trn, TimeEntry.clock_in >= since)
+                       .execution_options(synchronize_session=False))
+
+    # An entry that started before the window and ended inside it is reopened
+    # and closed again by the window's events; its notes already include theirs
+    carried = db.session.scalars(
+        select(TimeEntry).where(TimeEntry.workman_trn == trn, TimeEntry.clock_in < since)
+        .order_by(TimeEntry.clock_in.desc()).limit(1)
+    ).first()
+    if carried is not None and carried.clock_out is not None and carried.clock_out < since:
+        carried = None
+    if carried is not None:
+        carried.clock_out = None
+    open_entry = carried
+
+    written = 0
+    for event in events:
+        if event.action == CLOCK_IN:
+            if open_entry is not None:
+                continue
+            open_entry = TimeEntry(workman_trn=trn, clock_in=event.occurred_at, notes=event.notes)
+            db.session.add(open_entry)
+            # The open-entry unique index allows one open entry at a time
+            db.session.flush()
+            written += 1
+        elif open_entry is not None:
+            if event.notes and open_entry is not carried:
+                open_entry.notes = append_note(open_entry.notes, event.notes)
+            if event.action == CLOCK_OUT:
+                open_entry.clock_out = event.occurred_at
+                db.session.flush()
+                open_entry = None
+    db.session.commit()
+    return written
+
+
+def replay(since=None, trns=None):
+    """Rebuild time entries from the ledger.
+
+    Entries of the workmen that have events are deleted from ``since`` (the
+    first recorded event by default) and refolded from their events. A
+    workman whose first event is later than ``since`` is only rebuilt from
+    that event, so older entries the ledger does not cover (written before
+    it existed, or by paths that record no events) are kept. Events older
+    than the newest archived entry, or than the workman's creation (a
+    re-used TRN), are not replayed. Returns (workmen, entries written).
+    """
+    if since is None:
+        since = db.session.scalar(select(ClockEvent.occurred_at).order_by(ClockEvent.occurred_at).limit(1))
+        if since is None:
+            return 0, 0
+    latest_archived = archive.latest_archived_clock_in()
+    if latest_archived is not None and since <= latest_archived:
+        logger.warning("Archived entries reach %s, replaying from there", latest_archived)
+        since = latest_archived + timedelta(microseconds=1)
+
+    stmt = (select(ClockEvent).join(Workman, Workman.trn == ClockEvent.workman_trn)
+            .where(ClockEvent.occurred_at >= since, ClockEvent.occurred_at >= Workman.created_at)
+            .order_by(ClockEvent.workman_trn, ClockEvent.occurred_at, ClockEvent.id))
+    if trns:
+        stmt = stmt.where(ClockEvent.workman_trn.in_(trns))
+
+    by_workman = {}
+    for event in db.session.scalars(stmt):
+        by_workman.setdefault(event.workman_trn, []).append(event)
+
+    # Workmen with events before ``since`` are covered by the ledger from there
+    covered = set(db.session.scalars(
+        select(ClockEvent.workman_trn).distinct().join(Workman, Workman.trn == ClockEvent.workman_trn)
+        .where(ClockEvent.occurred_at < since, ClockEvent.occurred_at >= Workman.created_at,
+               ClockEvent.workman_trn.in_(list(by_workman)))
+    ))
+
+    written = 0
+    for trn, events in by_workman.items():
+        written += _replay_workman(trn, events, since if trn in covered else events[0].occurred_at)
+    logger.info("Replayed clock events of %s workmen into %s entries", len(by_workman), written)
+    return len(by_workman), written
+
+
+@click.command('replay-clock-events')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='Rebuild entries from this time (defaults to the first recorded event)')
+@click.option('--trn', 'trns', multiple=True, help='Only rebuild these workmen')
+def replay_clock_events_command(since, trns):
+    """Rebuild time entries from the clock event ledger"""
+    if sharding.enabled():
+        raise click.ClickException("replay-clock-events does not support DATABASE_SHARDS yet")
+    workmen, written = replay(since, list(trns) or None)
+    click.echo(f"Rebuilt {written} time entries for {workmen} workmen")
+
+
+def init_app(app):
+    """Create the ledger buffer, flush it at exit and register the replay command"""
+    clock_ledger = ClockLedger(
+        app,
+        buffer_size=app.config['CLOCK_LEDGER_BUFFER_SIZE'],
+        batch_size=app.config['CLOCK_LEDGER_BATCH_SIZE'],
+        flush_interval=app.config['CLOCK_LEDGER_FLUSH_INTERVAL_MS'] / 1000,
+        durability=app.config['CLOCK_LEDGER_DURABILITY'],
+    )
+    app.extensions['clock_ledger'] = clock_ledger
+    atexit.register(clock_ledger.flush_at_exit)
+    app.cli.add_command(replay_clock_events_command)
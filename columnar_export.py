@@ -0,0 +1,220 @@
+"""Columnar export of time entries for analysts and BI tools.
+
+``flask export-columnar`` writes live and archived time entries as NumPy
+arrays, one directory per clock_in month, that columnar_loader.py memory-maps
+for zero-copy analysis. TRNs, companies and locations are dictionary
+encoded: months store int32 codes into append-only dictionaries, so codes
+written by earlier runs stay valid and only months missing from the manifest
+are exported. The month in progress is left out unless asked for. A month
+is only marked complete once it is over and none of its entries is still
+open, so shifts that were open at export time are picked up by a later run.
+A month whose entries were corrected later can be rewritten with
+``--refresh-month``.
+
+Needs the optional ``analytics`` dependencies (numpy).
+"""
+import click
+import heapq
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, select, union_all
+from app import db
+from models import Workman, TimeEntry, ArchivedTimeEntry, Company, Location
+from archive import add_months, month_start
+import sharding
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _modules():
+    """numpy and the loader, which defines the file layout; imported on first use"""
+    try:
+        import numpy
+        import columnar_loader
+    except ImportError:
+        raise click.ClickException("The columnar export needs numpy: pip install '.[analytics]'")
+    return numpy, columnar_loader
+
+
+class Dictionary:
+    """Append-only value -> code mapping"""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value):
+        value = value or ''
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def _write_atomic(path, write):
+    """Write a file through a temporary name so readers never see it half written"""
+    tmp = f'{path}.tmp-{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def _load_state(out_dir):
+    np, layout = _modules()
+    manifest = {'version': FORMAT_VERSION, 'months': {}}
+    dictionaries = {name: Dictionary() for name in ('trn', 'company', 'location')}
+    if os.path.exists(os.path.join(out_dir, layout.MANIFEST)):
+        with open(os.path.join(out_dir, layout.MANIFEST)) as f:
+            manifest = json.load(f)
+        with np.load(os.path.join(out_dir, layout.DICTIONARIES)) as data:
+            dictionaries = {name: Dictionary(data[name].tolist()) for name in dictionaries}
+    return manifest, dictionaries
+
+
+def _save_state(out_dir, manifest, dictionaries):
+    np, layout = _modules()
+    # Dictionaries first: the manifest must never list a month using codes not on disk yet
+    _write_atomic(os.path.join(out_dir, layout.DICTIONARIES), lambda f: np.savez(
+        f, **{name: np.array(dictionary.values, dtype=str) for name, dictionary in dictionaries.items()}))
+    manifest['exported_at'] = datetime.utcnow().isoformat()
+    _write_atomic(os.path.join(out_dir, layout.MANIFEST),
+                  lambda f: f.write(json.dumps(manifest, indent=2, sort_keys=True).encode()))
+
+
+def _month_rows(start, end):
+    """(id, trn, clock_in, clock_out, company, location) of live and archived entries in a month, from every shard"""
+    parts = sharding.gather(_shard_month_rows, start, end)
+    return list(heapq.merge(*parts, key=lambda row: (row.clock_in, row.id)))
+
+
+def _shard_month_rows(start, end):
+    def columns(model):
+        return (select(model.id, model.workman_trn, model.clock_in, model.clock_out,
+                       Company.name.label('company'), Location.name.label('location'))
+                .join(Workman, Workman.trn == model.workman_trn)
+                .join(Company, Company.id == Workman.company_id)
+                .join(Location, Location.id == Workman.location_id)
+                .where(model.clock_in >= start, model.clock_in < end, Workman.deleted_at.is_(None)))
+
+    stmt = union_all(columns(TimeEntry), columns(ArchivedTimeEntry))
+    return db.session.execute(select(stmt.subquery()).order_by('clock_in', 'id')).all()
+
+
+def _write_month(out_dir, month, rows, dictionaries):
+    np, layout = _modules()
+    clock_in = np.array([row.clock_in for row in rows], dtype='datetime64[us]')
+    clock_out = np.array([row.clock_out for row in rows], dtype='datetime64[us]')
+    columns = {
+        'entry_id': np.array([row.id for row in rows], dtype=np.int64),
+        'clock_in': clock_in,
+        'clock_out': clock_out,
+        # NaN while the entry is still open
+        'duration_hours': (clock_out - clock_in) / np.timedelta64(1, 'h'),
+        'trn_code': np.array([dictionaries['trn'].encode(row.workman_trn) for row in rows], dtype=np.int32),
+        'company_code': np.array([dictionaries['company'].encode(row.company) for row in rows], dtype=np.int32),
+        'location_code': np.array([dictionaries['location'].encode(row.location) for row in rows], dtype=np.int32),
+    }
+
+    entries_dir = os.path.join(out_dir, layout.ENTRIES_DIR)
+    final = os.path.join(entries_dir, month)
+    tmp = os.path.join(entries_dir, f'.{month}.tmp-{os.getpid()}')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name in layout.ENTRY_COLUMNS:
+        np.save(os.path.join(tmp, f'{name}.npy'), columns[name])
+
+    # Swap the finished directory in; a refreshed month replaces the old one
+    if os.path.exists(final):
+        old = f'{tmp}.old'
+        os.replace(final, old)
+        os.replace(tmp, final)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, final)
+
+
+def _write_workmen(out_dir, dictionaries):
+    np, layout = _modules()
+    parts = sharding.gather(lambda: db.session.execute(
+        select(Workman.trn, Workman.name, Company.name, Location.name)
+        .join(Company, Company.id == Workman.company_id)
+        .join(Location, Location.id == Workman.location_id)
+        .order_by(Workman.trn)
+    ).all())
+    rows = list(heapq.merge(*parts, key=lambda row: row[0]))
+    _write_atomic(os.path.join(out_dir, layout.WORKMEN), lambda f: np.savez(
+        f,
+        trn_code=np.array([dictionaries['trn'].encode(trn) for trn, _, _, _ in rows], dtype=np.int32),
+        name=np.array([name for _, name, _, _ in rows], dtype=str),
+        company_code=np.array([dictionaries['company'].encode(company) for _, _, company, _ in rows], dtype=np.int32),
+        location_code=np.array([dictionaries['location'].encode(location) for _, _, _, location in rows], dtype=np.int32),
+    ))
+
+
+def export_months():
+    """Every month from the first entry up to the month in progress, as "YYYY-MM" with its bounds"""
+    firsts = sharding.gather(lambda: (db.session.scalar(select(func.min(TimeEntry.clock_in))),
+                                      db.session.scalar(select(func.min(ArchivedTimeEntry.clock_in)))))
+    first = min((value for part in firsts for value in part if value is not None), default=None)
+    if first is None:
+        return []
+    months = []
+    start = month_start(first)
+    current = month_start(datetime.utcnow())
+    while start <= current:
+        months.append((f'{start:%Y-%m}', start, add_months(start, 1)))
+        start = add_months(start, 1)
+    return months
+
+
+def export(out_dir, refresh=(), include_current=False):
+    """Export the months missing from ``out_dir`` (and those in ``refresh``); returns them"""
+    _, layout = _modules()
+    os.makedirs(os.path.join(out_dir, layout.ENTRIES_DIR), exist_ok=True)
+    manifest, dictionaries = _load_state(out_dir)
+    current = f'{datetime.utcnow():%Y-%m}'
+
+    written = []
+    for month, start, end in export_months():
+        if month == current and not include_current:
+            continue
+        # Months still running or with open entries at the last export are written again
+        if manifest['months'].get(month, {}).get('complete') and month not in refresh:
+            continue
+        rows = _month_rows(start, end)
+        _write_month(out_dir, month, rows, dictionaries)
+        open_entries = sum(1 for row in rows if row.clock_out is None)
+        manifest['months'][month] = {'rows': len(rows), 'complete': month != current and not open_entries}
+        # Saved after every month so an interrupted run resumes where it stopped
+        _save_state(out_dir, manifest, dictionaries)
+        written.append(month)
+        logger.info("Exported %s time entries for %s", len(rows), month, extra={'month': month, 'rows': len(rows)})
+
+    _write_workmen(out_dir, dictionaries)
+    _save_state(out_dir, manifest, dictionaries)
+    return written
+
+
+@click.command('export-columnar')
+@click.argument('out_dir', required=False)
+@click.option('--refresh-month', 'refresh', multiple=True, help='Rewrite this YYYY-MM month even if exported')
+@click.option('--include-current', is_flag=True, help='Also export the month in progress')
+def export_columnar_command(out_dir, refresh, include_current):
+    """Write time entries as memory-mappable NumPy arrays, one directory per month"""
+    out_dir = out_dir or current_app.config['ANALYTICS_EXPORT_DIR']
+    if not out_dir:
+        raise click.UsageError('Pass OUT_DIR or set ANALYTICS_EXPORT_DIR')
+    written = export(out_dir, refresh=set(refresh), include_current=include_current)
+    click.echo(f"Exported {len(written)} months to {out_dir}")
+
+
+def init_app(app):
+    """Register the export command; numpy is only imported when it runs"""
+    app.cli.add_command(export_columnar_command)
@@ -0,0 +1,82 @@
+"""Read the columnar time entry export (see columnar_export.py) with NumPy.
+
+Only needs numpy, so it can be copied next to a notebook. Month columns are
+memory-mapped: nothing is read from disk until it is used, and slicing or
+filtering a column does not copy the file::
+
+    import columnar_loader as cl
+
+    export = cl.ColumnarExport('/data/analytics')
+    month = export.month('2024-03')
+    hours = month['duration_hours']
+    by_company = np.bincount(month['company_code'], weights=np.nan_to_num(hours))
+    names = export.dictionary('company')
+
+Layout of an export directory::
+
+    manifest.json                       months exported, row counts, schema version
+    dictionaries.npz                    trn, company and location values; a code is an index
+    workmen.npz                         trn_code, name, company_code, location_code
+    entries/<YYYY-MM>/<column>.npy      one array per column, one row per time entry
+"""
+import json
+import os
+import numpy as np
+
+MANIFEST = 'manifest.json'
+DICTIONARIES = 'dictionaries.npz'
+WORKMEN = 'workmen.npz'
+ENTRIES_DIR = 'entries'
+
+# Columns of every month, all of the same length
+ENTRY_COLUMNS = ('entry_id', 'clock_in', 'clock_out', 'duration_hours', 'trn_code', 'company_code', 'location_code')
+
+
+class ColumnarExport:
+    """A directory written by ``flask export-columnar``"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self._dictionaries = None
+
+    @property
+    def months(self):
+        """Exported months as sorted "YYYY-MM" strings"""
+        return sorted(self.manifest['months'])
+
+    def dictionary(self, name):
+        """Values of the ``trn``, ``company`` or ``location`` dictionary; codes index into it"""
+        if self._dictionaries is None:
+            with np.load(os.path.join(self.path, DICTIONARIES)) as data:
+                self._dictionaries = {key: data[key] for key in data.files}
+        return self._dictionaries[name]
+
+    def decode(self, name, codes):
+        """Values for an array of codes, e.g. ``decode('trn', month['trn_code'])``"""
+        return self.dictionary(name)[codes]
+
+    def workmen(self):
+        """Workman dimension as a dict of equally long arrays"""
+        with np.load(os.path.join(self.path, WORKMEN)) as data:
+            return {key: data[key] for key in data.files}
+
+    def month(self, month, columns=ENTRY_COLUMNS, mmap_mode='r'):
+        """One month's columns, memory-mapped read-only by default"""
+        directory = os.path.join(self.path, ENTRIES_DIR, month)
+        return {column: np.load(os.path.join(directory, f'{column}.npy'), mmap_mode=mmap_mode)
+                for column in columns}
+
+    def iter_months(self, start=None, end=None, columns=ENTRY_COLUMNS):
+        """(month, columns) for each exported month in the inclusive "YYYY-MM" range"""
+        for month in self.months:
+            if (start is None or month >= start) and (end is None or month <= end):
+                yield month, self.month(month, columns)
+
+    def load(self, start=None, end=None, columns=ENTRY_COLUMNS):
+        """Columns of a month range concatenated into regular arrays (this copies)"""
+        parts = [data for _, data in self.iter_months(start, end, columns)]
+        if not parts:
+            return {column: np.array([]) for column in columns}
+        return {column: np.concatenate([part[column] for part in parts]) for column in columns}
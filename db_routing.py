@@ -0,0 +1,109 @@
+"""Read-replica routing for db.session.
+
+Read-only requests (GET/HEAD/OPTIONS) read from one replica picked per request.
+Flushes, other methods and work outside a request use the primary. After a write
+a short-lived cookie keeps the client on the primary so it reads its own writes.
+Two SQLite files are enough to try it locally:
+
+    DATABASE_URL=sqlite:///primary.db DATABASE_REPLICA_URLS=sqlite:///replica.db
+
+When DATABASE_SHARDS is set, queries on the sharded tables go to the shard in
+``g.db_shard`` instead; sharding.py decides which shard that is.
+"""
+import random
+import time
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND_PREFIX = 'replica_'
+STICKY_COOKIE = 'db_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+SHARD_BIND_PREFIX = 'shard_'
+PRIMARY_SHARD = 'primary'
+# A workman and their history live on the shard of the workman's company
+SHARDED_TABLES = frozenset(('workmen', 'time_entries', 'time_entries_archive', 'daily_summaries',
+                            'attendance_bitmaps'))
+
+
+def replica_binds(urls):
+    """Build SQLALCHEMY_BINDS entries from a comma separated URL list"""
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    return {f"{REPLICA_BIND_PREFIX}{i}": url for i, url in enumerate(urls)}
+
+
+def shard_binds(spec):
+    """Build SQLALCHEMY_BINDS entries from comma separated name=url pairs"""
+    binds = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        name, _, url = item.partition('=')
+        name, url = name.strip(), url.strip()
+        if not name or not url or name == PRIMARY_SHARD:
+            raise ValueError(f"DATABASE_SHARDS entries must be name=url pairs, got {item.strip()!r}")
+        binds[f"{SHARD_BIND_PREFIX}{name}"] = url
+    return binds
+
+
+def current_shard():
+    """Shard the sharded tables are read from and written to in this context"""
+    return (g.get('db_shard') if has_app_context() else None) or PRIMARY_SHARD
+
+
+def _replica_keys(engines):
+    return [key for key in engines if isinstance(key, str) and key.startswith(REPLICA_BIND_PREFIX)]
+
+
+class RoutingSession(Session):
+    """Session that sends sharded tables to their shard and reads of read-only requests to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # A session joined to an outer transaction (atomic API batches) stays on its connection
+        if bind is None and self.bind is not None:
+            return self.bind
+        if bind is None and mapper is not None and mapper.local_table.name in SHARDED_TABLES:
+            shard = current_shard()
+            if shard != PRIMARY_SHARD:
+                return self._db.engines[f"{SHARD_BIND_PREFIX}{shard}"]
+        if bind is None and not self._flushing and has_request_context() and g.get('db_read_only'):
+            engines = self._db.engines
+            key = g.get('db_replica')
+            if key is None:
+                keys = _replica_keys(engines)
+                key = g.db_replica = random.choice(keys) if keys else False
+            if key:
+                return engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _mark_write(session, flush_context):
+    """After any flush the rest of the request must read its own writes"""
+    if has_request_context():
+        g.db_read_only = False
+        g.db_wrote = True
+
+
+def init_app(app, db):
+    """Install the request hooks that decide between primary and replica"""
+    from sqlalchemy import event
+
+    if not _replica_keys(app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+
+    sticky_seconds = app.config['DATABASE_REPLICA_STICKY_SECONDS']
+    event.listen(RoutingSession, 'after_flush', _mark_write)
+
+    @app.before_request
+    def choose_database():
+        sticky_until = request.cookies.get(STICKY_COOKIE, type=float) or 0
+        # db_wrote is preset for API batch operations following a write
+        g.db_read_only = (request.method in SAFE_METHODS and sticky_until < time.time()
+                          and not g.get('db_wrote'))
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote') or request.method not in SAFE_METHODS:
+            response.set_cookie(STICKY_COOKIE, str(time.time() + sticky_seconds),
+                                max_age=sticky_seconds, httponly=True, samesite='Lax')
+        return response
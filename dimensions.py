@@ -0,0 +1,87 @@
+import click
+import logging
+from collections import Counter, defaultdict
+from sqlalchemy import inspect, text
+from app import db
+from models import Company, Location
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical_spellings(counts, model):
+    """Group raw strings by normalized key and pick the most common spelling"""
+    groups = defaultdict(Counter)
+    for raw, count in counts:
+        spelling = model.normalize_name(raw)
+        groups[spelling.lower()][spelling] += count
+    return {key: spellings.most_common(1)[0][0] for key, spellings in groups.items()}
+
+
+def _migrate_column(column, model):
+    """Move one free-text workmen column into its lookup table"""
+    fk_column = f"{column}_id"
+    counts = db.session.execute(text(
+        f"SELECT {column}, COUNT(*) FROM workmen WHERE {column} IS NOT NULL GROUP BY {column}"
+    )).all()
+
+    ids = {}
+    for key, spelling in _canonical_spellings(counts, model).items():
+        ids[key] = model.get_or_create(spelling)
+    db.session.flush()
+
+    db.session.execute(
+        text(f"UPDATE workmen SET {fk_column} = :id WHERE {column} = :raw"),
+        [{'id': ids[model.normalize_name(raw).lower()].id, 'raw': raw} for raw, _ in counts]
+    )
+    logger.info("Migrated %s distinct %s strings into %s %s rows", len(counts), column, len(ids), model.__tablename__)
+    return len(counts), len(ids)
+
+
+def normalize_dimensions():
+    """Migrate legacy workmen.company/location strings to lookup table keys.
+
+    Safe to run repeatedly: it does nothing once the legacy columns are gone.
+    """
+    columns = {col['name'] for col in inspect(db.engine).get_columns('workmen')}
+    if 'company' not in columns and 'location' not in columns:
+        return {}
+
+    db.metadata.create_all(db.engine, tables=[Company.__table__, Location.__table__])
+    for column, model in (('company', Company), ('location', Location)):
+        if f"{column}_id" not in columns:
+            db.session.execute(text(
+                f"ALTER TABLE workmen ADD COLUMN {column}_id INTEGER REFERENCES {model.__tablename__}(id)"
+            ))
+
+    result = {}
+    for column, model in (('company', Company), ('location', Location)):
+        if column in columns:
+            result[column] = _migrate_column(column, model)
+    db.session.commit()
+
+    # Indexes first, then drop the free-text columns the ORM no longer maps
+    from models import Workman
+    for index in Workman.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    for column in ('company', 'location'):
+        if column in columns:
+            db.session.execute(text(f"ALTER TABLE workmen DROP COLUMN {column}"))
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute(text(f"ALTER TABLE workmen ALTER COLUMN {column}_id SET NOT NULL"))
+    db.session.commit()
+    return result
+
+
+@click.command('normalize-dimensions')
+def normalize_dimensions_command():
+    """Move workman company and location strings into lookup tables"""
+    result = normalize_dimensions()
+    if not result:
+        click.echo("Nothing to migrate")
+    for column, (distinct, rows) in result.items():
+        click.echo(f"{column}: {distinct} distinct strings -> {rows} rows")
+
+
+def init_app(app):
+    """Register the dimension migration command"""
+    app.cli.add_command(normalize_dimensions_command)
@@ -0,0 +1,478 @@
+"""Edge mode: a site node on local SQLite replicating with the central instance.
+
+A remote site runs its own copy of the app. DATABASE_URL points at a local
+SQLite file and EDGE_UPSTREAM_URL at the central instance, so clock actions
+and workman lookups never wait on the WAN. SQLite is tuned for concurrent
+workers: WAL journal, synchronous=NORMAL and a busy timeout (see SQLITE_*).
+
+Every EDGE_SYNC_INTERVAL_SECONDS, or on ``flask edge-sync``, the node runs
+one sync cycle. It pushes its own clock events and workman changes to the
+central instance, then pulls the changes made everywhere else. Both
+directions use gzip-compressed JSON batches of up to EDGE_SYNC_BATCH_SIZE
+rows per kind:
+
+    POST /api/v1/edge/push    workmen and clock events recorded on the node
+    GET  /api/v1/edge/pull    workmen and clock events past the node's cursors
+
+Commits do not land in id or updated_at order, so each pull also re-sends
+the last EDGE_SYNC_OVERLAP_EVENTS events and EDGE_SYNC_OVERLAP_SECONDS of
+workman changes behind the node's cursors, and late commits there still
+arrive.
+
+Both ends resolve conflicts the same way. For workmen, the most recently
+updated version wins, and on a tie the central copy wins. Clock events are
+facts: none is dropped, and duplicates are recognised by event_id. Time
+entries are a projection of the ledger, so a workman's entries are refolded
+(clock_ledger.replay) whenever new events arrive. Both ends then fold the
+same events in time order and end up with the same entries. A clock-in at
+one site while already clocked in at another is ignored, as replay ignores
+it.
+
+Refolding reads the ledger, so nodes should write events synchronously
+(CLOCK_LEDGER_DURABILITY=sync, the default in edge mode). Workmen only
+replicate soft deletes; a purge on one side does not reach the other.
+"""
+import click
+import gzip
+import json
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+from flask import Response, current_app
+from sqlalchemy import and_, event, insert, or_, select
+from app import db
+from models import ClockEvent, Location, SyncCursor, Workman
+from scheduler import PeriodicTask
+import clock_ledger
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# origin of events pulled from the central instance that it recorded itself
+UPSTREAM_ORIGIN = 'upstream'
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Cursor names; workman cursors are "<updated_at>|<trn>", event cursors ids
+PUSH_WORKMEN = 'push_workmen'
+PUSH_EVENTS = 'push_events'
+PULL_WORKMEN = 'pull_workmen'
+PULL_EVENTS = 'pull_events'
+
+
+class EdgeError(RuntimeError):
+    """Replication with the central instance failed or is not possible"""
+
+
+def enabled(app=None):
+    return bool((app or current_app).config['EDGE_UPSTREAM_URL'])
+
+
+def sqlite_pragmas(config):
+    """PRAGMA statements run on every new SQLite connection, from the SQLITE_* settings"""
+    pragmas = []
+    journal_mode = config['SQLITE_JOURNAL_MODE'].upper()
+    if journal_mode:
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"SQLITE_JOURNAL_MODE must be one of: {', '.join(JOURNAL_MODES)}")
+        pragmas.append(f'PRAGMA journal_mode={journal_mode}')
+    synchronous = config['SQLITE_SYNCHRONOUS'].upper()
+    if synchronous:
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"SQLITE_SYNCHRONOUS must be one of: {', '.join(SYNCHRONOUS_MODES)}")
+        pragmas.append(f'PRAGMA synchronous={synchronous}')
+    if config['SQLITE_BUSY_TIMEOUT_MS']:
+        pragmas.append(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    return pragmas
+
+
+def tune_sqlite(engine, pragmas):
+    """Run ``pragmas`` on every connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    event.listen(engine, 'connect', _apply_pragmas)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def pack(payload):
+    """A sync payload as gzip-compressed JSON"""
+    return gzip.compress(json.dumps(payload, default=_json_default, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(data, content_encoding=None):
+    """A sync payload from a (gzip-compressed when ``content_encoding`` says so) JSON body"""
+    if content_encoding == 'gzip':
+        data = gzip.decompress(data)
+    return json.loads(data or b'{}')
+
+
+def packed_response(payload):
+    return Response(pack(payload), mimetype='application/json', headers={'Content-Encoding': 'gzip'})
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _require_single_database():
+    if sharding.enabled():
+        raise EdgeError('Edge replication does not support DATABASE_SHARDS yet')
+
+
+def workman_row(workman):
+    return {
+        'trn': workman.trn,
+        'name': workman.name,
+        'company': workman.company,
+        'location': workman.location,
+        'created_at': workman.created_at,
+        'updated_at': workman.updated_at,
+        'deleted_at': workman.deleted_at,
+    }
+
+
+def event_row(clock_event):
+    return {
+        'event_id': clock_event.event_id,
+        'workman_trn': clock_event.workman_trn,
+        'action': clock_event.action,
+        'actor': clock_event.actor,
+        'source': clock_event.source,
+        'occurred_at': clock_event.occurred_at,
+        'device_time': clock_event.device_time,
+        'notes': clock_event.notes,
+        'origin': clock_event.origin,
+    }
+
+
+def encode_workman_cursor(workman):
+    return f'{workman.updated_at.isoformat()}|{workman.trn}'
+
+
+def decode_workman_cursor(value):
+    if not value:
+        return None
+    updated_at, _, trn = value.partition('|')
+    return datetime.fromisoformat(updated_at), trn
+
+
+def workman_changes(cursor, limit, location_id=None, until=None):
+    """Workmen updated after ``cursor`` (updated_at, trn), and up to ``until`` inclusive, soft deleted ones included, oldest first"""
+    stmt = select(Workman).execution_options(include_deleted=True)
+    if cursor:
+        updated_at, trn = cursor
+        stmt = stmt.where(or_(Workman.updated_at > updated_at,
+                              and_(Workman.updated_at == updated_at, Workman.trn > trn)))
+    if until:
+        updated_at, trn = until
+        stmt = stmt.where(or_(Workman.updated_at < updated_at,
+                              and_(Workman.updated_at == updated_at, Workman.trn <= trn)))
+    if location_id:
+        stmt = stmt.where(Workman.location_id == location_id)
+    return db.session.scalars(stmt.order_by(Workman.updated_at, Workman.trn).limit(limit)).all()
+
+
+def event_changes(after_id, limit, local_only=False, exclude_origin=None, location_id=None, until_id=None):
+    """Clock events recorded after id ``after_id``, and up to ``until_id`` inclusive, oldest first"""
+    stmt = select(ClockEvent).where(ClockEvent.id > after_id)
+    if until_id is not None:
+        stmt = stmt.where(ClockEvent.id <= until_id)
+    if local_only:
+        stmt = stmt.where(ClockEvent.origin.is_(None))
+    if exclude_origin:
+        stmt = stmt.where(or_(ClockEvent.origin.is_(None), ClockEvent.origin != exclude_origin))
+    if location_id:
+        stmt = stmt.where(ClockEvent.workman_trn.in_(
+            select(Workman.trn).where(Workman.location_id == location_id)))
+    return db.session.scalars(stmt.order_by(ClockEvent.id).limit(limit)).all()
+
+
+def apply_workmen(rows, prefer_incoming_on_tie):
+    """Create or update replicated workmen, the latest update winning; returns (applied, conflicts).
+
+    A conflict is an incoming change that lost to a newer local one.
+    """
+    applied, conflicts = 0, []
+    for row in rows:
+        incoming = {'name': row['name'], 'company': row['company'], 'location': row['location'],
+                    'deleted_at': _parse_time(row['deleted_at'])}
+        updated_at = _parse_time(row['updated_at'])
+        with db.session.no_autoflush:
+            workman = db.session.scalar(Workman.lookup_including_deleted(row['trn']))
+            if workman is None:
+                db.session.add(Workman(trn=row['trn'], created_at=_parse_time(row['created_at']),
+                                       updated_at=updated_at, **incoming))
+                applied += 1
+                continue
+
+            local = {'name': workman.name, 'company': workman.company, 'location': workman.location,
+                     'deleted_at': workman.deleted_at}
+            if local == incoming:
+                continue
+            if workman.updated_at > updated_at or (workman.updated_at == updated_at and not prefer_incoming_on_tie):
+                conflicts.append({'trn': workman.trn, 'kept': 'local', 'local_updated_at': workman.updated_at,
+                                  'incoming_updated_at': updated_at})
+                continue
+            for name, value in incoming.items():
+                setattr(workman, name, value)
+            # Keep the winning version's timestamp so every node compares the same values
+            workman.updated_at = updated_at
+            applied += 1
+    db.session.commit()
+    for conflict in conflicts:
+        logger.info("Kept local workman %s over an older replicated change", conflict['trn'],
+                    extra={'trn': conflict['trn']})
+    return applied, conflicts
+
+
+def apply_events(rows, origin):
+    """Add replicated clock events to the ledger and refold the affected workmen's entries.
+
+    Events already in the ledger (by event_id) are skipped. Returns how many
+    were new.
+    """
+    rows = {row['event_id']: row for row in rows}
+    known = set(db.session.scalars(select(ClockEvent.event_id).where(ClockEvent.event_id.in_(list(rows)))))
+    new = [row for event_id, row in rows.items() if event_id not in known]
+    if not new:
+        return 0
+
+    db.session.execute(insert(ClockEvent), [{
+        'event_id': row['event_id'],
+        'workman_trn': row['workman_trn'],
+        'action': row['action'],
+        'actor': row['actor'],
+        'source': row['source'],
+        'occurred_at': _parse_time(row['occurred_at']),
+        'device_time': _parse_time(row.get('device_time')),
+        'notes': row.get('notes'),
+        'origin': row.get('origin') or origin,
+    } for row in new])
+    db.session.commit()
+
+    # Events of this process still waiting in the write-behind buffer must be
+    # in the ledger before entries are rebuilt from it
+    clock_ledger.ledger().flush()
+    first_event = {}
+    for row in new:
+        occurred_at = _parse_time(row['occurred_at'])
+        trn = row['workman_trn']
+        first_event[trn] = min(first_event.get(trn, occurred_at), occurred_at)
+    for trn, since in first_event.items():
+        clock_ledger.replay(since, [trn])
+    return len(new)
+
+
+def accept_push(payload):
+    """Apply a node's pushed workmen and events (central side); returns the JSON-ready outcome"""
+    _require_single_database()
+    node = str(payload['node'])
+    workmen, events = payload.get('workmen') or [], payload.get('events') or []
+    limit = current_app.config['EDGE_SYNC_BATCH_SIZE']
+    if len(workmen) > limit or len(events) > limit:
+        raise ValueError(f'A push can carry at most {limit} workmen and {limit} events')
+
+    applied, conflicts = apply_workmen(workmen, prefer_incoming_on_tie=False)
+    new_events = apply_events(events, origin=node)
+    logger.info("Edge node %s pushed %s workmen and %s events", node, len(workmen), len(events),
+                extra={'node': node, 'workmen_applied': applied, 'events_new': new_events,
+                       'conflicts': len(conflicts)})
+    return {'workmen': applied, 'events': new_events, 'duplicates': len(events) - new_events,
+            'conflicts': conflicts}
+
+
+def build_pull(node, events_after=0, workmen_cursor=None, location=None, limit=None):
+    """Changes a node has not seen yet (central side); returns the JSON-ready batch and next cursors"""
+    _require_single_database()
+    limit = min(limit or current_app.config['EDGE_SYNC_BATCH_SIZE'], current_app.config['EDGE_SYNC_BATCH_SIZE'])
+    location_id = None
+    if location:
+        row = Location.find_by_name(location)
+        if row is None:
+            return {'workmen': [], 'events': [], 'workmen_cursor': None, 'events_cursor': None, 'more': False}
+        location_id = row.id
+
+    cursor = decode_workman_cursor(workmen_cursor)
+    workmen = workman_changes(cursor, limit, location_id)
+    events = event_changes(events_after, limit, exclude_origin=node, location_id=location_id)
+
+    # Concurrent transactions commit out of order, so a row can appear behind a
+    # cursor that already moved past it. Rows just behind the cursors are sent
+    # again; the node skips those it already has.
+    recent_workmen = []
+    if cursor:
+        lag = timedelta(seconds=current_app.config['EDGE_SYNC_OVERLAP_SECONDS'])
+        recent_workmen = workman_changes((cursor[0] - lag, ''), limit, location_id, until=cursor)
+    recent_events = event_changes(max(0, events_after - current_app.config['EDGE_SYNC_OVERLAP_EVENTS']), limit,
+                                  exclude_origin=node, location_id=location_id, until_id=events_after)
+    return {
+        'workmen': [workman_row(workman) for workman in recent_workmen + workmen],
+        # The pulling node records these as coming from upstream unless another node sent them
+        'events': [event_row(clock_event) for clock_event in recent_events + events],
+        'workmen_cursor': encode_workman_cursor(workmen[-1]) if workmen else None,
+        'events_cursor': events[-1].id if events else None,
+        'more': len(workmen) == limit or len(events) == limit,
+    }
+
+
+def get_cursor(name):
+    cursor = db.session.get(SyncCursor, name)
+    return cursor.value if cursor else None
+
+
+def set_cursor(name, value):
+    cursor = db.session.get(SyncCursor, name)
+    if cursor is None:
+        db.session.add(SyncCursor(name=name, value=str(value)))
+    else:
+        cursor.value = str(value)
+
+
+def _upstream(method, action, payload=None, params=None):
+    """Call an edge endpoint of the central instance; returns its unpacked reply"""
+    config = current_app.config
+    url = f"{config['EDGE_UPSTREAM_URL']}/api/v1/edge/{action}"
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    headers = {'Authorization': f"Bearer {config['EDGE_UPSTREAM_TOKEN']}", 'Accept-Encoding': 'gzip'}
+    data = None
+    if payload is not None:
+        data = pack(payload)
+        headers.update({'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=config['EDGE_SYNC_TIMEOUT_SECONDS']) as response:
+            return unpack(response.read(), response.headers.get('Content-Encoding'))
+    except urllib.error.HTTPError as e:
+        raise EdgeError(f"{method} {url} answered {e.code}: {e.read()[:200].decode('utf-8', 'replace')}")
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        raise EdgeError(f"{method} {url} failed: {e}")
+
+
+def push():
+    """Send this node's unsent workman changes and clock events upstream; returns totals"""
+    config = current_app.config
+    limit = config['EDGE_SYNC_BATCH_SIZE']
+    clock_ledger.ledger().flush()
+
+    totals = {'workmen': 0, 'events': 0, 'duplicates': 0, 'conflicts': []}
+    while True:
+        workmen = workman_changes(decode_workman_cursor(get_cursor(PUSH_WORKMEN)), limit)
+        events = event_changes(int(get_cursor(PUSH_EVENTS) or 0), limit, local_only=True)
+        if not workmen and not events:
+            break
+        result = _upstream('POST', 'push', {
+            'node': config['EDGE_NODE_ID'],
+            'workmen': [workman_row(workman) for workman in workmen],
+            'events': [event_row(clock_event) for clock_event in events],
+        })
+        if workmen:
+            set_cursor(PUSH_WORKMEN, encode_workman_cursor(workmen[-1]))
+        if events:
+            set_cursor(PUSH_EVENTS, events[-1].id)
+        db.session.commit()
+
+        for name in ('workmen', 'events', 'duplicates'):
+            totals[name] += result[name]
+        totals['conflicts'].extend(result['conflicts'])
+        if len(workmen) < limit and len(events) < limit:
+            break
+    return totals
+
+
+def pull():
+    """Fetch and apply the changes made elsewhere since the last pull; returns totals"""
+    config = current_app.config
+    totals = {'workmen': 0, 'events': 0, 'conflicts': []}
+    while True:
+        params = {'node': config['EDGE_NODE_ID'], 'events_after': get_cursor(PULL_EVENTS) or 0,
+                  'limit': config['EDGE_SYNC_BATCH_SIZE']}
+        if get_cursor(PULL_WORKMEN):
+            params['workmen_cursor'] = get_cursor(PULL_WORKMEN)
+        if config['EDGE_LOCATION']:
+            params['location'] = config['EDGE_LOCATION']
+        result = _upstream('GET', 'pull', params=params)
+
+        applied, conflicts = apply_workmen(result['workmen'], prefer_incoming_on_tie=True)
+        totals['workmen'] += applied
+        totals['conflicts'].extend(conflicts)
+        totals['events'] += apply_events(result['events'], origin=UPSTREAM_ORIGIN)
+        if result['workmen_cursor']:
+            set_cursor(PULL_WORKMEN, result['workmen_cursor'])
+        if result['events_cursor']:
+            set_cursor(PULL_EVENTS, result['events_cursor'])
+        db.session.commit()
+        if not result['more']:
+            break
+    return totals
+
+
+def sync():
+    """One replication cycle: push, then pull; returns both totals"""
+    _require_single_database()
+    result = {'pushed': push(), 'pulled': pull()}
+    logger.info("Edge sync pushed %s workmen and %s events, pulled %s workmen and %s events",
+                result['pushed']['workmen'], result['pushed']['events'],
+                result['pulled']['workmen'], result['pulled']['events'],
+                extra={'conflicts': len(result['pushed']['conflicts']) + len(result['pulled']['conflicts'])})
+    return result
+
+
+def run_sync_job(app):
+    """Periodic entry point: one sync cycle, tolerating an unreachable upstream"""
+    with app.app_context():
+        try:
+            sync()
+        except EdgeError as e:
+            db.session.rollback()
+            logger.warning("Edge sync failed, retrying in %ss: %s", app.config['EDGE_SYNC_INTERVAL_SECONDS'], e)
+
+
+@click.command('edge-sync')
+def edge_sync_command():
+    """Replicate workmen and clock events with the central instance once"""
+    if not enabled():
+        raise click.ClickException("EDGE_UPSTREAM_URL is not set")
+    try:
+        result = sync()
+    except EdgeError as e:
+        raise click.ClickException(str(e))
+    pushed, pulled = result['pushed'], result['pulled']
+    click.echo(f"Pushed {pushed['workmen']} workmen and {pushed['events']} events "
+               f"({pushed['duplicates']} already known), pulled {pulled['workmen']} workmen "
+               f"and {pulled['events']} events")
+    for conflict in pushed['conflicts']:
+        click.echo(f"Conflict on {conflict['trn']}: upstream kept its newer version", err=True)
+    for conflict in pulled['conflicts']:
+        click.echo(f"Conflict on {conflict['trn']}: this node kept its newer version", err=True)
+
+
+def init_app(app):
+    """Tune SQLite, register the sync command and, in edge mode, start the periodic sync"""
+    pragmas = sqlite_pragmas(app.config)
+    with app.app_context():
+        for engine in db.engines.values():
+            tune_sqlite(engine, pragmas)
+
+    app.cli.add_command(edge_sync_command)
+
+    if enabled(app):
+        task = PeriodicTask('edge-sync', app.config['EDGE_SYNC_INTERVAL_SECONDS'], lambda: run_sync_job(app))
+        task.start_on_first_request(app)
+        app.extensions['edge_sync'] = task
@@ -0,0 +1,12 @@
+# Loaded automatically by gunicorn from the working directory.
+# With --preload the app is built once in the master and then forked; the
+# workers must not share pooled connections opened before the fork.
+
+
+def post_fork(server, worker):
+    from app import db
+
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
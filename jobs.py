@@ -0,0 +1,220 @@
+"""In-process background jobs for heavy reports, exports and purges.
+
+Jobs are rows in ``background_jobs`` and run on a thread pool inside each web
+process, so no external broker is needed. A job's parameters are normalized
+into a cache key: while an identical job is queued, running or has an
+unexpired result, submitting it again returns that job instead of computing
+the report a second time.
+
+The process holding a queued or running job refreshes its ``heartbeat_at``
+every JOBS_HEARTBEAT_SECONDS. A job whose heartbeat is older than
+JOBS_CLAIM_TIMEOUT_SECONDS was left behind by a process that died: it is
+no longer reused, so the next identical request submits a fresh job. Expired
+results are evicted by a periodic task, which also fails abandoned jobs and
+jobs that never finished within JOBS_TIMEOUT_SECONDS.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app, g, has_app_context
+from sqlalchemy import and_, delete, func, or_, update
+from app import db
+from models import BackgroundJob
+from scheduler import PeriodicTask
+import reporting
+import workman_deletion
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# kind -> (function(params) returning str, content type)
+JOB_KINDS = {
+    'report': (lambda params: json.dumps(reporting.build_report(params)), 'application/json'),
+    'report_csv': (reporting.export_csv, 'text/csv'),
+    'report_summary': (lambda params: json.dumps(reporting.build_summary(params)), 'application/json'),
+    'workman_purge': (lambda params: json.dumps(workman_deletion.purge_workman(params['trn'])), 'application/json'),
+}
+# Kinds clients may queue through the report jobs API; the others are internal
+REPORT_JOB_KINDS = ('report', 'report_csv', 'report_summary')
+
+
+class _Pool:
+    executor = None
+    pid = None
+    # Ids of the jobs this process has queued or is running
+    active = set()
+    lock = threading.Lock()
+
+
+_pool = _Pool()
+
+
+def _executor():
+    """The process's thread pool, recreated after fork"""
+    if _pool.executor is None or _pool.pid != os.getpid():
+        _pool.executor = ThreadPoolExecutor(max_workers=current_app.config['JOBS_MAX_WORKERS'],
+                                            thread_name_prefix='background-job')
+        _pool.pid = os.getpid()
+    return _pool.executor
+
+
+def cache_key(kind, params):
+    """Stable key for a job kind and its normalized parameters"""
+    canonical = json.dumps({'kind': kind, 'params': params}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _alive_since():
+    """Pending jobs with an older heartbeat were abandoned"""
+    return datetime.utcnow() - timedelta(seconds=current_app.config['JOBS_CLAIM_TIMEOUT_SECONDS'])
+
+
+def find_reusable_job(key):
+    """A live queued or running job, or an unexpired finished one, with this cache key"""
+    return BackgroundJob.query.filter(
+        BackgroundJob.cache_key == key,
+        or_(and_(BackgroundJob.status.in_((QUEUED, RUNNING)), BackgroundJob.heartbeat_at > _alive_since()),
+            BackgroundJob.status == SUCCEEDED),
+        or_(BackgroundJob.expires_at.is_(None), BackgroundJob.expires_at > datetime.utcnow())
+    ).order_by(BackgroundJob.created_at.desc()).first()
+
+
+def submit(kind, params, user=None):
+    """Queue a job, or return the identical job that is pending or cached"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    key = cache_key(kind, params)
+    existing = find_reusable_job(key)
+    if existing:
+        return existing
+
+    job = BackgroundJob(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        params_json=json.dumps(params, sort_keys=True),
+        cache_key=key,
+        status=QUEUED,
+        content_type=JOB_KINDS[kind][1],
+        submitted_by=user.username if user else None,
+        heartbeat_at=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    # Inside an atomic API batch the commit only released a savepoint; the
+    # job is started once the batch commits (see api_batch.py)
+    deferred = g.get('jobs_deferred') if has_app_context() else None
+    if deferred is not None:
+        deferred.append(job.id)
+    else:
+        dispatch(job.id)
+    logger.info("Job %s (%s) queued", job.id, kind, extra={'job_id': job.id, 'kind': kind})
+    return job
+
+
+def dispatch(job_id):
+    """Hand a committed queued job to the thread pool"""
+    with _pool.lock:
+        _pool.active.add(job_id)
+    current_app.extensions['job_heartbeat'].start()
+    _executor().submit(run_job, current_app._get_current_object(), job_id)
+
+
+def send_heartbeat():
+    """Refresh the heartbeat of the jobs this process holds"""
+    with _pool.lock:
+        active = list(_pool.active)
+    if not active:
+        return
+    db.session.execute(update(BackgroundJob).where(BackgroundJob.id.in_(active))
+                       .values(heartbeat_at=datetime.utcnow()))
+    db.session.commit()
+
+
+def run_job(app, job_id):
+    """Execute a queued job and store its result"""
+    try:
+        _run_job(app, job_id)
+    finally:
+        with _pool.lock:
+            _pool.active.discard(job_id)
+
+
+def _run_job(app, job_id):
+    with app.app_context():
+        # Claim the job; another process may have picked it up already
+        claimed = db.session.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.id == job_id, BackgroundJob.status == QUEUED)
+            .values(status=RUNNING, started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+
+        job = db.session.get(BackgroundJob, job_id)
+        ttl = timedelta(seconds=app.config['JOBS_RESULT_TTL_SECONDS'])
+        func, _content_type = JOB_KINDS[job.kind]
+        try:
+            job.result = func(job.params)
+            job.status = SUCCEEDED
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(BackgroundJob, job_id)
+            job.status = FAILED
+            job.error = str(e)
+            logger.exception("Job %s (%s) failed", job_id, job.kind)
+        job.finished_at = datetime.utcnow()
+        job.expires_at = job.finished_at + ttl
+        db.session.commit()
+        logger.info("Job %s (%s) %s", job_id, job.kind, job.status,
+                    extra={'job_id': job_id, 'kind': job.kind, 'status': job.status})
+
+
+def get_job(job_id):
+    """A job that has not expired, or None"""
+    job = db.session.get(BackgroundJob, job_id)
+    if job is None or (job.expires_at and job.expires_at <= datetime.utcnow()):
+        return None
+    return job
+
+
+def evict_expired(timeout_seconds):
+    """Delete expired jobs and fail the abandoned ones and those that never finished"""
+    now = datetime.utcnow()
+    abandoned = db.session.execute(
+        update(BackgroundJob)
+        .where(BackgroundJob.status.in_((QUEUED, RUNNING)),
+               or_(BackgroundJob.created_at < now - timedelta(seconds=timeout_seconds),
+                   # Rows from before heartbeats count from their creation
+                   func.coalesce(BackgroundJob.heartbeat_at, BackgroundJob.created_at) < _alive_since()))
+        .values(status=FAILED, error='Job did not finish in time', finished_at=now, expires_at=now)
+    ).rowcount
+    evicted = db.session.execute(
+        delete(BackgroundJob).where(BackgroundJob.expires_at < now)
+    ).rowcount
+    db.session.commit()
+    if abandoned or evicted:
+        logger.info("Evicted %s expired jobs, abandoned %s", evicted, abandoned)
+    return evicted
+
+
+def init_app(app):
+    """Start the periodic eviction of expired job results and set up the heartbeat"""
+    task = PeriodicTask('job-eviction', app.config['JOBS_EVICT_INTERVAL_SECONDS'],
+                        lambda: evict_expired(app.config['JOBS_TIMEOUT_SECONDS']), app=app)
+    task.start_on_first_request(app)
+    app.extensions['job_eviction'] = task
+    # Started by the first dispatch in each process
+    app.extensions['job_heartbeat'] = PeriodicTask('job-heartbeat', app.config['JOBS_HEARTBEAT_SECONDS'],
+                                                   send_heartbeat, app=app)
@@ -0,0 +1,151 @@
+"""Non-blocking logging pipeline.
+
+Request threads only put records on a bounded in-memory queue; a background
+QueueListener formats (JSON by default) and writes them. When the queue is full
+records are dropped and counted instead of blocking the request.
+
+Environment:
+    LOG_LEVEL           root level (INFO)
+    LOG_LEVELS          per-logger levels, e.g. "workmen.clock=WARNING,sqlalchemy.engine=INFO"
+    LOG_FORMAT          json or text (json)
+    LOG_QUEUE_SIZE      bounded queue size (10000)
+    LOG_CLOCK_SAMPLE    fraction of INFO clock events kept, 0..1 (1.0)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+CLOCK_LOGGER = 'workmen.clock'
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with ``extra`` fields as top-level keys"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller and counts dropped records"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Message formatting is deferred to the listener thread; only render the
+        # traceback now, because the frames it refers to will not survive
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of records below WARNING"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class _Pipeline:
+    handler = None
+    listener = None
+    output = None
+
+
+_pipeline = _Pipeline()
+
+
+def parse_levels(spec):
+    """Parse "name=LEVEL,name=LEVEL" into a dict"""
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def dropped_records():
+    """Number of records dropped because the queue was full"""
+    return _pipeline.handler.dropped if _pipeline.handler else 0
+
+
+def _start_listener(queue_size):
+    _pipeline.handler.queue = queue.Queue(maxsize=queue_size)
+    _pipeline.listener = logging.handlers.QueueListener(_pipeline.handler.queue, _pipeline.output,
+                                                        respect_handler_level=True)
+    _pipeline.listener.start()
+
+
+def _stop_listener():
+    if _pipeline.listener:
+        _pipeline.listener.stop()
+        _pipeline.listener = None
+    if _pipeline.handler and _pipeline.handler.dropped:
+        sys.stderr.write(f"logging: dropped {_pipeline.handler.dropped} records (queue full)\n")
+
+
+def configure_logging():
+    """Install the queue-backed logging pipeline on the root logger (idempotent)"""
+    if _pipeline.handler is not None:
+        return
+
+    queue_size = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+    _pipeline.output = logging.StreamHandler(sys.stderr)
+    if os.environ.get('LOG_FORMAT', 'json').lower() == 'json':
+        _pipeline.output.setFormatter(JsonFormatter())
+    else:
+        _pipeline.output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    _pipeline.handler = BoundedQueueHandler(queue.Queue(maxsize=queue_size))
+    _start_listener(queue_size)
+
+    root = logging.getLogger()
+    root.handlers = [_pipeline.handler]
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    for name, level in parse_levels(os.environ.get('LOG_LEVELS')).items():
+        logging.getLogger(name).setLevel(level)
+
+    sample_rate = float(os.environ.get('LOG_CLOCK_SAMPLE', '1.0'))
+    if sample_rate < 1.0:
+        logging.getLogger(CLOCK_LOGGER).addFilter(SamplingFilter(sample_rate))
+
+    atexit.register(_stop_listener)
+    # The listener thread does not survive fork; give each child its own
+    # queue (the old one's lock may have been held mid-fork) and listener
+    os.register_at_fork(after_in_child=lambda: _start_listener(queue_size))
@@ -0,0 +1,229 @@
+"""In-process request and database metrics in Prometheus text format.
+
+Every request records its latency, status and the number of SQL statements it
+ran (and their time) per blueprint/endpoint. Connection pool gauges are read at
+scrape time. Metrics are per process; with several gunicorn workers each
+worker reports its own numbers.
+"""
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from flask import Response, current_app, g, has_request_context, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label tuples"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (bucket_counts, total, count) in sorted(self.series.items()):
+            base = _labels(self.label_names, labels)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (bound,))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{base} {total}")
+            lines.append(f"{self.name}_count{base} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by label tuples"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+_lock = threading.Lock()
+_started_at = time.time()
+
+REQUEST_LABELS = ('blueprint', 'endpoint', 'method')
+request_latency = Histogram('http_request_duration_seconds', 'Request latency', REQUEST_LABELS, LATENCY_BUCKETS)
+requests_total = Counter('http_requests_total', 'Requests served', REQUEST_LABELS + ('status',))
+request_queries = Histogram('db_queries_per_request', 'SQL statements per request', REQUEST_LABELS, QUERY_COUNT_BUCKETS)
+query_seconds = Counter('db_query_seconds_total', 'Time spent in SQL statements', REQUEST_LABELS)
+queries_total = Counter('db_queries_total', 'SQL statements executed', REQUEST_LABELS)
+pool_wait = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection', (), POOL_WAIT_BUCKETS)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            with _lock:
+                pool_wait.observe((), waited)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context: a statement that raises never reaches the after hook
+    context.metrics_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_query_start', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_queries += 1
+        g.metrics_query_time += elapsed
+
+
+def _request_labels():
+    return (request.blueprint or 'app', request.endpoint or 'unmatched', request.method)
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_time = 0.0
+
+
+def _record_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    labels = _request_labels()
+    with _lock:
+        request_latency.observe(labels, elapsed)
+        requests_total.inc(labels + (response.status_code,))
+        request_queries.observe(labels, g.metrics_queries)
+        queries_total.inc(labels, g.metrics_queries)
+        query_seconds.inc(labels, g.metrics_query_time)
+    return response
+
+
+def _pool_lines(engines):
+    lines = [
+        "# HELP db_pool_checked_out Connections currently checked out",
+        "# TYPE db_pool_checked_out gauge",
+    ]
+    overflow = [
+        "# HELP db_pool_overflow Connections opened beyond pool_size",
+        "# TYPE db_pool_overflow gauge",
+    ]
+    size = [
+        "# HELP db_pool_size Configured pool size",
+        "# TYPE db_pool_size gauge",
+    ]
+    for key, engine in engines.items():
+        pool = engine.pool
+        label = _labels(('bind',), (key or 'primary',))
+        if hasattr(pool, 'checkedout'):
+            lines.append(f"db_pool_checked_out{label} {pool.checkedout()}")
+        if hasattr(pool, 'overflow'):
+            overflow.append(f"db_pool_overflow{label} {pool.overflow()}")
+        if hasattr(pool, 'size'):
+            size.append(f"db_pool_size{label} {pool.size()}")
+    return lines + overflow + size
+
+
+def _ledger_lines(ledger):
+    if ledger is None:
+        return []
+    return [
+        "# HELP clock_ledger_buffered_events Clock events waiting to be written",
+        "# TYPE clock_ledger_buffered_events gauge",
+        f"clock_ledger_buffered_events {len(ledger)}",
+        "# HELP clock_ledger_flush_failures_total Failed clock event batch writes",
+        "# TYPE clock_ledger_flush_failures_total counter",
+        f"clock_ledger_flush_failures_total {ledger.flush_failures}",
+    ]
+
+
+def render_metrics(engines, ledger=None):
+    """All metrics in Prometheus text exposition format"""
+    import logging_config
+
+    with _lock:
+        lines = []
+        for metric in (request_latency, requests_total, request_queries, queries_total, query_seconds, pool_wait):
+            lines.extend(metric.render())
+    lines.extend(_pool_lines(engines))
+    lines.extend(_ledger_lines(ledger))
+    lines.extend([
+        "# HELP log_records_dropped_total Log records dropped because the log queue was full",
+        "# TYPE log_records_dropped_total counter",
+        f"log_records_dropped_total {logging_config.dropped_records()}",
+        "# HELP process_start_time_seconds Start time of the process",
+        "# TYPE process_start_time_seconds gauge",
+        f"process_start_time_seconds {_started_at}",
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    """Prometheus scrape endpoint"""
+    from app import db
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(render_metrics(db.engines, current_app.extensions.get('clock_ledger')), mimetype='text/plain; version=0.0.4')
+
+
+def pool_class_for(database_url):
+    """TimedQueuePool, or None when the database needs its own pool (in-memory SQLite)"""
+    if not database_url or database_url == 'sqlite://' or ':memory:' in database_url:
+        return None
+    return TimedQueuePool
+
+
+def init_app(app):
+    """Install request hooks, SQL event listeners and the /metrics endpoint"""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
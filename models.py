@@ -1,11 +1,13 @@
 from app import db
-from datetime import datetime
-from sqlalchemy import String, DateTime, Text, Boolean, Enum
+from datetime import datetime, date
+from sqlalchemy import String, DateTime, Date, Float, Integer, Text, Boolean, Enum, Index, LargeBinary, delete, func, select, text, update
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import List, Optional
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import enum
+import json
+import zlib
 import secrets
 import string
 
@@ -26,10 +28,12 @@ class User(UserMixin, db.Model):
     password_hash: Mapped[str] = mapped_column(String(255), nullable=False)
     role: Mapped[UserRole] = mapped_column(Enum(UserRole), default=UserRole.EMPLOYEE, nullable=False)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
-    api_token: Mapped[str] = mapped_column(String(64), unique=True, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # One token per device the user signed in from
+    api_tokens: Mapped[List["ApiToken"]] = relationship("ApiToken", back_populates="user", cascade="all, delete-orphan")
+    
     def set_password(self, password):
         """Set password hash"""
         self.password_hash = generate_password_hash(password)
@@ -52,43 +56,182 @@ class User(UserMixin, db.Model):
         """Check if user can clock workmen in/out"""
         return self.role in [UserRole.ADMIN, UserRole.SUPERVISOR, UserRole.EMPLOYEE]
     
-    def generate_api_token(self):
-        """Generate a new API token for the user"""
-        self.api_token = secrets.token_urlsafe(32)
-        return self.api_token
+    def revoke_api_tokens(self):
+        """Revoke the user's API tokens on every device; returns how many there were"""
+        return db.session.execute(delete(ApiToken).where(ApiToken.user_id == self.id)).rowcount
     
-    def revoke_api_token(self):
-        """Revoke the user's API token"""
-        self.api_token = None
+    @staticmethod
+    def token_lookup(token):
+        """Select statement for the active user owning an unexpired API token"""
+        return (select(User).join(ApiToken)
+                .where(ApiToken.token == token, ApiToken.expires_at > datetime.utcnow(), User.is_active.is_(True)))
     
     @staticmethod
     def find_by_token(token):
         """Find user by API token"""
-        from app import db
-        return db.session.query(User).filter_by(api_token=token, is_active=True).first()
+        return db.session.scalars(User.token_lookup(token)).first()
     
     
     def __repr__(self):
         return f'<User {self.username}: {self.role.value}>'
 
 
+class ApiToken(db.Model):
+    """API bearer token issued to one of a user's devices"""
+    __tablename__ = 'api_tokens'
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    token: Mapped[str] = mapped_column(String(64), unique=True, nullable=False)
+    user_id: Mapped[int] = mapped_column(db.ForeignKey('users.id'), nullable=False)
+    device: Mapped[str] = mapped_column(String(100), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+    # Written in batches by api_tokens.flush_last_used, so up to a minute behind
+    last_used_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    user: Mapped["User"] = relationship("User", back_populates="api_tokens")
+    
+    __table_args__ = (
+        Index('ix_api_tokens_user_device', 'user_id', 'device'),
+    )
+    
+    @staticmethod
+    def issue(user, device, ttl):
+        """New token for a user's device, valid for the ``ttl`` timedelta"""
+        now = datetime.utcnow()
+        return ApiToken(token=secrets.token_urlsafe(32), user=user, device=device,
+                        created_at=now, expires_at=now + ttl)
+    
+    @staticmethod
+    def reusable_lookup(user_id, device, valid_until):
+        """Select statement for the device's token that is still valid at ``valid_until``"""
+        return (select(ApiToken)
+                .where(ApiToken.user_id == user_id, ApiToken.device == device, ApiToken.expires_at > valid_until)
+                .order_by(ApiToken.expires_at.desc())
+                .limit(1))
+    
+    def __repr__(self):
+        return f'<ApiToken {self.user_id}: {self.device}>'
+
+
+class DimensionMixin:
+    """Shared behaviour for small name lookup tables"""
+    
+    @staticmethod
+    def normalize_name(name):
+        """Collapse whitespace so near-duplicate spellings map to one row"""
+        return ' '.join((name or '').split())
+    
+    @classmethod
+    def find_by_name(cls, name):
+        """Find a row by case-insensitive name"""
+        key = cls.normalize_name(name).lower()
+        # Rows added earlier in this transaction are not flushed yet
+        for row in db.session.new:
+            if isinstance(row, cls) and row.name.lower() == key:
+                return row
+        # Never flush a half-built workman just to look up a dimension
+        with db.session.no_autoflush:
+            return db.session.query(cls).filter(func.lower(cls.name) == key).first()
+    
+    @classmethod
+    def get_or_create(cls, name):
+        """Return the row for ``name``, adding a new one to the session if needed"""
+        row = cls.find_by_name(name)
+        if row is None:
+            row = cls(name=cls.normalize_name(name))
+            db.session.add(row)
+        return row
+
+
+class Company(DimensionMixin, db.Model):
+    """Lookup table for workman companies"""
+    __tablename__ = 'companies'
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(100), unique=True, nullable=False)
+    
+    def __repr__(self):
+        return f'<Company {self.id}: {self.name}>'
+
+
+class Location(DimensionMixin, db.Model):
+    """Lookup table for workman locations"""
+    __tablename__ = 'locations'
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(100), unique=True, nullable=False)
+    
+    def __repr__(self):
+        return f'<Location {self.id}: {self.name}>'
+
+
 class Workman(db.Model):
     """Model for storing workman information"""
     __tablename__ = 'workmen'
     
     trn: Mapped[str] = mapped_column(String(50), primary_key=True)
     name: Mapped[str] = mapped_column(String(100), nullable=False)
-    company: Mapped[str] = mapped_column(String(100), nullable=False)
-    location: Mapped[str] = mapped_column(String(100), nullable=False)
+    company_id: Mapped[int] = mapped_column(db.ForeignKey('companies.id'), nullable=False, index=True)
+    location_id: Mapped[int] = mapped_column(db.ForeignKey('locations.id'), nullable=False, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Set by a soft delete; such workmen are hidden from queries until purged (see workman_deletion.py)
+    deleted_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     
-    # Relationship to time entries
-    time_entries: Mapped[List["TimeEntry"]] = relationship("TimeEntry", back_populates="workman", cascade="all, delete-orphan")
+    # Dimension tables are tiny, so they are always joined in
+    company_ref: Mapped["Company"] = relationship("Company", lazy="joined")
+    location_ref: Mapped["Location"] = relationship("Location", lazy="joined")
+    
+    # Relationship to time entries; the database deletes them (ON DELETE CASCADE),
+    # so deleting a workman never loads their history
+    time_entries: Mapped[List["TimeEntry"]] = relationship("TimeEntry", back_populates="workman", cascade="all, delete-orphan", passive_deletes=True)
+    archived_time_entries: Mapped[List["ArchivedTimeEntry"]] = relationship("ArchivedTimeEntry", back_populates="workman", cascade="all, delete-orphan", passive_deletes=True)
+    daily_summaries: Mapped[List["DailySummary"]] = relationship("DailySummary", cascade="all, delete-orphan", passive_deletes=True)
+    attendance_bitmap: Mapped[Optional["AttendanceBitmap"]] = relationship("AttendanceBitmap", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f'<Workman {self.trn}: {self.name}>'
     
+    @property
+    def company(self):
+        """Company name"""
+        return self.company_ref.name if self.company_ref else None
+    
+    @company.setter
+    def company(self, name):
+        self.company_ref = Company.get_or_create(name)
+    
+    @property
+    def location(self):
+        """Location name"""
+        return self.location_ref.name if self.location_ref else None
+    
+    @location.setter
+    def location(self, name):
+        self.location_ref = Location.get_or_create(name)
+    
+    @staticmethod
+    def clock_lock_statement(trn):
+        """No-op UPDATE that write-locks a workman's row until commit.
+
+        Clock-in and clock-out run it before reading the open entry, so changes
+        for one workman are serialized and timestamps are taken in commit order
+        (a row lock on PostgreSQL, the database write lock on SQLite). Matches
+        no rows when the workman does not exist.
+        """
+        return update(Workman).where(Workman.trn == trn).values(updated_at=Workman.updated_at)
+
+    @staticmethod
+    def lookup_including_deleted(trn):
+        """Select statement for a workman by TRN, even one that is soft deleted"""
+        return select(Workman).filter_by(trn=trn).execution_options(include_deleted=True)
+
+    @staticmethod
+    def clocked_in_trns():
+        """TRNs of every workman with an open entry, in one query on the open-entry index"""
+        return set(db.session.scalars(select(TimeEntry.workman_trn).where(TimeEntry.clock_out.is_(None))))
+
     def get_current_status(self):
         """Get current clock status of the workman"""
         latest_entry = db.session.query(TimeEntry).filter_by(workman_trn=self.trn).order_by(TimeEntry.clock_in.desc()).first()
@@ -111,21 +254,8 @@ class Workman(db.Model):
         return None
 
 
-class TimeEntry(db.Model):
-    """Model for storing time tracking entries"""
-    __tablename__ = 'time_entries'
-    
-    id: Mapped[int] = mapped_column(primary_key=True)
-    workman_trn: Mapped[str] = mapped_column(String(50), db.ForeignKey('workmen.trn'), nullable=False)
-    clock_in: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
-    clock_out: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
-    notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    
-    # Relationship to workman
-    workman: Mapped["Workman"] = relationship("Workman", back_populates="time_entries")
-    
-    def __repr__(self):
-        return f'<TimeEntry {self.workman_trn}: {self.clock_in} - {self.clock_out}>'
+class TimeEntryMixin:
+    """Duration helpers shared by live and archived time entries"""
     
     def get_duration_hours(self):
         """Calculate duration in hours if clocked out"""
@@ -141,4 +271,232 @@ class TimeEntry(db.Model):
             hours = int(duration.total_seconds() // 3600)
             minutes = int((duration.total_seconds() % 3600) // 60)
             return f"{hours}h {minutes}m"
-        return "In Progress"
\ No newline at end of file
+        return "In Progress"
+
+
+class TimeEntry(TimeEntryMixin, db.Model):
+    """Model for storing time tracking entries"""
+    __tablename__ = 'time_entries'
+    __table_args__ = (
+        Index('ix_time_entries_workman_clock_in', 'workman_trn', 'clock_in'),
+        Index('ix_time_entries_clock_in', 'clock_in'),
+        # Partial index over open entries only: keeps "who is clocked in" and
+        # stale-entry lookups small no matter how large the table grows
+        Index('ix_time_entries_open', 'clock_in', 'workman_trn',
+              postgresql_where=text('clock_out IS NULL'),
+              sqlite_where=text('clock_out IS NULL')),
+        # At most one open entry per workman, whatever path writes the entry
+        Index('uq_time_entries_open_workman', 'workman_trn', unique=True,
+              postgresql_where=text('clock_out IS NULL'),
+              sqlite_where=text('clock_out IS NULL')),
+        # Never reuse ids on SQLite, archived rows keep theirs
+        {'sqlite_autoincrement': True},
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    workman_trn: Mapped[str] = mapped_column(String(50), db.ForeignKey('workmen.trn', ondelete='CASCADE'), nullable=False)
+    clock_in: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    clock_out: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    
+    # Relationship to workman
+    workman: Mapped["Workman"] = relationship("Workman", back_populates="time_entries")
+    
+    def __repr__(self):
+        return f'<TimeEntry {self.workman_trn}: {self.clock_in} - {self.clock_out}>'
+
+
+class ClockEvent(db.Model):
+    """Append-only record of a clock action: who clocked whom, and when.
+
+    Written in batches by the clock ledger (clock_ledger.py). Time entries are
+    a projection of these events and can be rebuilt from them with
+    ``flask replay-clock-events``. Rows are never updated, and outlive the
+    purge of a deleted workman as an audit trail.
+    """
+    __tablename__ = 'clock_events'
+    __table_args__ = (
+        Index('ix_clock_events_workman_occurred_at', 'workman_trn', 'occurred_at'),
+        Index('ix_clock_events_occurred_at', 'occurred_at'),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # Assigned when the event is recorded, so a retried batch insert cannot duplicate it
+    event_id: Mapped[str] = mapped_column(String(32), unique=True, nullable=False)
+    workman_trn: Mapped[str] = mapped_column(String(50), nullable=False)
+    action: Mapped[str] = mapped_column(String(20), nullable=False)
+    actor: Mapped[str] = mapped_column(String(80), nullable=False)
+    source: Mapped[str] = mapped_column(String(20), nullable=False)
+    # Server time applied to the time entry, and the device's own clock when it sent one
+    occurred_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    device_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    recorded_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Node the event was replicated from (edge.py); None when recorded by this instance
+    origin: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    
+    def __repr__(self):
+        return f'<ClockEvent {self.workman_trn}: {self.action} at {self.occurred_at} by {self.actor}>'
+
+
+class ArchivedTimeEntry(TimeEntryMixin, db.Model):
+    """Closed time entries moved out of time_entries by the archival command.
+
+    On PostgreSQL the table is natively range-partitioned by clock_in month;
+    on SQLite it is a single table indexed on clock_in.
+    """
+    __tablename__ = 'time_entries_archive'
+    __table_args__ = (
+        Index('ix_time_entries_archive_workman_clock_in', 'workman_trn', 'clock_in'),
+        Index('ix_time_entries_archive_clock_in', 'clock_in'),
+        {'postgresql_partition_by': 'RANGE (clock_in)'},
+    )
+    
+    # The partition key has to be part of the primary key on PostgreSQL
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    clock_in: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    workman_trn: Mapped[str] = mapped_column(String(50), db.ForeignKey('workmen.trn', ondelete='CASCADE'), nullable=False)
+    clock_out: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    workman: Mapped["Workman"] = relationship("Workman", back_populates="archived_time_entries")
+    
+    def __repr__(self):
+        return f'<ArchivedTimeEntry {self.workman_trn}: {self.clock_in} - {self.clock_out}>'
+
+
+class DailySummary(db.Model):
+    """Per-workman daily totals that stay in the hot tables after archival"""
+    __tablename__ = 'daily_summaries'
+    
+    workman_trn: Mapped[str] = mapped_column(String(50), db.ForeignKey('workmen.trn', ondelete='CASCADE'), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    total_hours: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    sessions: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailySummary {self.workman_trn}: {self.day} {self.total_hours}h>'
+
+
+class AttendanceBitmap(db.Model):
+    """Days a workman clocked in, one bit per day (see attendance.py).
+
+    ``bits`` is a little-endian bit string: bit i is set when the workman
+    clocked in on ``start_day`` + i days (UTC).
+    """
+    __tablename__ = 'attendance_bitmaps'
+    
+    workman_trn: Mapped[str] = mapped_column(String(50), db.ForeignKey('workmen.trn', ondelete='CASCADE'), primary_key=True)
+    start_day: Mapped[date] = mapped_column(Date, nullable=False)
+    bits: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AttendanceBitmap {self.workman_trn}: from {self.start_day}, {len(self.bits)} bytes>'
+
+
+class BackgroundJob(db.Model):
+    """Report and export job run by the in-process job runner (jobs.py).
+
+    Finished jobs keep their result until ``expires_at`` and are reused for
+    requests with the same ``cache_key``.
+    """
+    __tablename__ = 'background_jobs'
+    __table_args__ = (
+        Index('ix_background_jobs_cache_key', 'cache_key', 'status'),
+        Index('ix_background_jobs_expires_at', 'expires_at'),
+    )
+    
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(50), nullable=False)
+    params_json: Mapped[str] = mapped_column(Text, nullable=False, default='{}')
+    cache_key: Mapped[str] = mapped_column(String(64), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default='queued')
+    result: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    content_type: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    submitted_by: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # Refreshed by the process holding a queued or running job (jobs.py)
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    @property
+    def params(self):
+        return json.loads(self.params_json)
+    
+    def __repr__(self):
+        return f'<BackgroundJob {self.id}: {self.kind} {self.status}>'
+
+
+class ReportSnapshot(db.Model):
+    """Precomputed report summary for a standard period (snapshots.py).
+
+    ``scope`` is ``all``, ``company:<id>`` or ``location:<id>``; the summary is
+    zlib-compressed JSON of totals and per-workman statistics.
+    """
+    __tablename__ = 'report_snapshots'
+    __table_args__ = (
+        Index('uq_report_snapshots_period_scope', 'period', 'start_date', 'scope', unique=True),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    period: Mapped[str] = mapped_column(String(20), nullable=False)
+    scope: Mapped[str] = mapped_column(String(40), nullable=False)
+    start_date: Mapped[date] = mapped_column(Date, nullable=False)
+    end_date: Mapped[date] = mapped_column(Date, nullable=False)
+    summary: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    built_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Fingerprint of the entries the summary was built from (snapshots.source_digest)
+    source_digest: Mapped[Optional[str]] = mapped_column(String(64))
+    
+    @property
+    def data(self):
+        return json.loads(zlib.decompress(self.summary))
+    
+    @staticmethod
+    def compress(data):
+        return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+    
+    def __repr__(self):
+        return f'<ReportSnapshot {self.period} {self.scope}: {self.start_date} - {self.end_date}>'
+
+
+class CompanyShard(db.Model):
+    """Shard holding a company's workmen (sharding.py); companies without a row are on the primary"""
+    __tablename__ = 'company_shards'
+    
+    company_id: Mapped[int] = mapped_column(db.ForeignKey('companies.id'), primary_key=True)
+    shard: Mapped[str] = mapped_column(String(50), nullable=False)
+    # Set while the company is being moved; its workmen are read-only until the move finishes
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CompanyShard {self.company_id}: {self.shard}>'
+
+
+class WorkmanShard(db.Model):
+    """TRN to company directory on the primary, so a workman's shard is found with one lookup"""
+    __tablename__ = 'workman_shards'
+    
+    trn: Mapped[str] = mapped_column(String(50), primary_key=True)
+    company_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<WorkmanShard {self.trn}: {self.company_id}>'
+
+
+class SyncCursor(db.Model):
+    """How far an edge node has replicated in one direction (edge.py)"""
+    __tablename__ = 'sync_cursors'
+    
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    value: Mapped[str] = mapped_column(String(100), nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SyncCursor {self.name}: {self.value}>'
@@ -0,0 +1,169 @@
+"""On-demand request profiler for admins.
+
+An admin adds ``X-Profile: 1`` or ``?_profile=1`` to a request (API token or
+logged-in session) and the handler runs under cProfile. The top functions by
+cumulative time and the SQL statements the request ran are kept in a bounded
+in-memory store and read back through ``/api/v1/admin/profiles``; the response
+carries the profile id in ``X-Profile-Id``.
+
+Requests without the flag only pay for the header/argument check. One request
+per process is profiled at a time; concurrent profile requests run normally
+and get ``X-Profile-Skipped``.
+"""
+import cProfile
+import pstats
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from api_auth import extract_bearer_token
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ARG = '_profile'
+
+_lock = threading.Lock()
+_profiling = threading.Lock()
+_profiles = OrderedDict()
+
+
+def _requested():
+    return request.headers.get(PROFILE_HEADER) == '1' or request.args.get(PROFILE_ARG) == '1'
+
+
+def _requesting_admin():
+    """Username of the admin making the request, if it is one"""
+    from models import User, UserRole
+
+    token = extract_bearer_token()
+    user = User.find_by_token(token) if token else None
+    if user is None and current_user.is_authenticated:
+        user = current_user
+    if user is not None and user.role == UserRole.ADMIN:
+        return user.username
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g:
+        # On the execution context, so a statement that raises leaves nothing behind
+        context.profile_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not (has_request_context() and 'profile' in g):
+        return
+    started = getattr(context, 'profile_query_start', None)
+    if started is not None:
+        g.profile['sql'].append({
+            'statement': statement,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+        })
+
+
+def _start_profile():
+    if not _requested():
+        return
+    username = _requesting_admin()
+    if username is None:
+        return
+    if not _profiling.acquire(blocking=False):
+        g.profile_skipped = True
+        return
+
+    # SQL timing listeners are only installed once profiling is first used
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    g.profile = {'user': username, 'sql': [], 'started': time.perf_counter()}
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def top_functions(profiler, limit):
+    """Functions sorted by cumulative time"""
+    stats = pstats.Stats(profiler).sort_stats('cumulative')
+    functions = []
+    for func in stats.fcn_list[:limit]:
+        primitive_calls, calls, total_time, cumulative_time, _callers = stats.stats[func]
+        filename, line, name = func
+        functions.append({
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_time_ms': round(total_time * 1000, 3),
+            'cumulative_time_ms': round(cumulative_time * 1000, 3),
+        })
+    return functions
+
+
+def _finish_profile(response):
+    if g.pop('profile_skipped', False):
+        response.headers['X-Profile-Skipped'] = 'another request is being profiled'
+        return response
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    try:
+        profiler.disable()
+        profile = g.pop('profile')
+        duration_ms = (time.perf_counter() - profile.pop('started')) * 1000
+    finally:
+        _profiling.release()
+
+    profile_id = uuid.uuid4().hex[:12]
+    profile.update({
+        'id': profile_id,
+        'created_at': datetime.utcnow().isoformat(),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 3),
+        'sql_count': len(profile['sql']),
+        'sql_total_ms': round(sum(query['duration_ms'] for query in profile['sql']), 3),
+        'functions': top_functions(profiler, current_app.config['PROFILER_TOP_FUNCTIONS']),
+    })
+    with _lock:
+        _profiles[profile_id] = profile
+        while len(_profiles) > current_app.config['PROFILER_STORE_SIZE']:
+            _profiles.popitem(last=False)
+
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _abandon_profile(exc):
+    # after_request does not run when the response could not be built
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        g.pop('profile', None)
+        _profiling.release()
+
+
+def list_profiles():
+    """Summaries of stored profiles, newest first"""
+    with _lock:
+        profiles = list(_profiles.values())
+    return [{key: profile[key] for key in ('id', 'created_at', 'user', 'method', 'path', 'endpoint',
+                                             'status', 'duration_ms', 'sql_count', 'sql_total_ms')}
+            for profile in reversed(profiles)]
+
+
+def get_profile(profile_id):
+    """A stored profile, or None"""
+    with _lock:
+        return _profiles.get(profile_id)
+
+
+def init_app(app):
+    """Install the profiling request hooks"""
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abandon_profile)
@@ -0,0 +1,218 @@
+"""Bulk creation of user accounts from a CSV file.
+
+The CSV has a header row with ``username`` and ``email`` columns and,
+optionally, ``role`` (admin, supervisor or employee; employee by default),
+``password`` (a random one is generated when empty) and ``active``.
+
+Rows are validated up front. Duplicate usernames and emails, both inside the
+file and against existing users, are found with one IN query per batch
+rather than one lookup per row. Password hashing, the slow part, runs in a
+process pool across all cores. The users, and optionally an API token for
+each, are then inserted in batched statements within a single transaction,
+so an import either creates every valid row or nothing.
+"""
+import click
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from email_validator import EmailNotValidError, validate_email
+from flask import current_app
+from sqlalchemy import insert, select
+from werkzeug.security import generate_password_hash
+from app import db
+from models import ApiToken, User, UserRole
+import api_tokens
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_COLUMNS = ('username', 'email')
+MIN_PASSWORD_LENGTH = 8
+TOKEN_DEVICE = 'provisioned'
+
+# Below this many passwords starting worker processes costs more than it saves
+_POOL_THRESHOLD = 8
+
+
+class ProvisioningError(ValueError):
+    """The CSV cannot be imported at all"""
+
+
+def _truthy(value, default=True):
+    if value is None or str(value).strip() == '':
+        return default
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def parse_users_csv(text):
+    """Validated rows and per-line errors of a users CSV.
+
+    Returns (rows, errors): rows are dicts ready to insert except for the
+    password hash, errors are {'line', 'username', 'error'} dicts.
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    header = [name.strip().lower() for name in reader.fieldnames or []]
+    missing = [name for name in REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise ProvisioningError(f"CSV is missing the {', '.join(missing)} column(s)")
+    reader.fieldnames = header
+
+    rows, errors = [], []
+    seen_usernames, seen_emails = set(), set()
+    for line, record in enumerate(reader, start=2):
+        username = (record.get('username') or '').strip()
+        email = (record.get('email') or '').strip()
+        role = (record.get('role') or UserRole.EMPLOYEE.value).strip().lower()
+        password = record.get('password') or ''
+
+        def reject(message):
+            errors.append({'line': line, 'username': username, 'error': message})
+
+        if not 3 <= len(username) <= 80:
+            reject('Username must be between 3 and 80 characters')
+            continue
+        try:
+            email = validate_email(email, check_deliverability=False).normalized
+        except EmailNotValidError as e:
+            reject(f'Invalid email: {e}')
+            continue
+        if role not in {r.value for r in UserRole}:
+            reject(f'Unknown role: {role}')
+            continue
+        if password and len(password) < MIN_PASSWORD_LENGTH:
+            reject(f'Password must be at least {MIN_PASSWORD_LENGTH} characters')
+            continue
+        if username in seen_usernames:
+            reject('Username appears more than once in the file')
+            continue
+        if email in seen_emails:
+            reject('Email appears more than once in the file')
+            continue
+        seen_usernames.add(username)
+        seen_emails.add(email)
+
+        rows.append({
+            'line': line,
+            'username': username,
+            'email': email,
+            'role': UserRole(role),
+            'is_active': _truthy(record.get('active')),
+            'password': password,
+            'generated_password': not password,
+        })
+    return rows, errors
+
+
+def _existing(column, values, batch_size):
+    """Values of ``column`` already taken, one IN query per batch"""
+    values = list(values)
+    taken = set()
+    for i in range(0, len(values), batch_size):
+        taken.update(db.session.scalars(select(column).where(column.in_(values[i:i + batch_size]))))
+    return taken
+
+
+def hash_passwords(passwords, workers=None):
+    """Password hashes computed in a process pool across all cores"""
+    passwords = list(passwords)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < _POOL_THRESHOLD:
+        return [generate_password_hash(password) for password in passwords]
+    # spawn, not fork: the web process runs background threads holding locks
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(generate_password_hash, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def provision_users(text, issue_tokens=False, strict=False):
+    """Create the users of a CSV; returns {'created': [...], 'errors': [...]}.
+
+    Rows that are invalid or collide with existing users are reported in
+    ``errors`` and skipped, or, with ``strict``, abort the whole import.
+    Generated passwords and issued tokens are only ever returned here.
+    """
+    config = current_app.config
+    batch_size = config['PROVISION_BATCH_SIZE']
+    rows, errors = parse_users_csv(text)
+
+    taken_usernames = _existing(User.username, (row['username'] for row in rows), batch_size)
+    taken_emails = _existing(User.email, (row['email'] for row in rows), batch_size)
+    accepted = []
+    for row in rows:
+        if row['username'] in taken_usernames:
+            errors.append({'line': row['line'], 'username': row['username'], 'error': 'Username already exists'})
+        elif row['email'] in taken_emails:
+            errors.append({'line': row['line'], 'username': row['username'], 'error': 'Email already exists'})
+        else:
+            accepted.append(row)
+    errors.sort(key=lambda error: error['line'])
+
+    if strict and errors:
+        return {'created': [], 'errors': errors}
+
+    for row in accepted:
+        if row['generated_password']:
+            row['password'] = secrets.token_urlsafe(12)
+    hashes = hash_passwords((row['password'] for row in accepted), config['PROVISION_HASH_WORKERS'])
+
+    created = []
+    for i in range(0, len(accepted), batch_size):
+        batch = accepted[i:i + batch_size]
+        ids = db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [{'username': row['username'], 'email': row['email'], 'role': row['role'],
+              'is_active': row['is_active'], 'password_hash': password_hash}
+             for row, password_hash in zip(batch, hashes[i:i + batch_size])]
+        ).scalars().all()
+
+        tokens = {}
+        if issue_tokens:
+            ttl = api_tokens.token_ttl(config)
+            tokens = {user_id: ApiToken.issue(None, TOKEN_DEVICE, ttl) for user_id in ids}
+            db.session.execute(insert(ApiToken), [
+                {'token': token.token, 'user_id': user_id, 'device': token.device,
+                 'created_at': token.created_at, 'expires_at': token.expires_at}
+                for user_id, token in tokens.items()
+            ])
+
+        for row, user_id in zip(batch, ids):
+            result = {'id': user_id, 'username': row['username'], 'email': row['email'], 'role': row['role'].value}
+            if row['generated_password']:
+                result['password'] = row['password']
+            if user_id in tokens:
+                result['token'] = tokens[user_id].token
+            created.append(result)
+    db.session.commit()
+
+    logger.info("Provisioned %s users, %s rows rejected", len(created), len(errors))
+    return {'created': created, 'errors': errors}
+
+
+@click.command('provision-users')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--issue-tokens', is_flag=True, help='Issue an API token for every new user')
+@click.option('--strict', is_flag=True, help='Create nothing if any row is rejected')
+@click.option('--output', type=click.File('w'), default='-',
+              help='Where to write the created users with generated passwords and tokens (default stdout)')
+def provision_users_command(csv_file, issue_tokens, strict, output):
+    """Create user accounts from a CSV of username,email,role[,password][,active]"""
+    try:
+        result = provision_users(csv_file.read(), issue_tokens=issue_tokens, strict=strict)
+    except ProvisioningError as e:
+        raise click.ClickException(str(e))
+
+    for error in result['errors']:
+        click.echo(f"line {error['line']} ({error['username']}): {error['error']}", err=True)
+    writer = csv.writer(output)
+    writer.writerow(['id', 'username', 'email', 'role', 'password', 'token'])
+    for user in result['created']:
+        writer.writerow([user['id'], user['username'], user['email'], user['role'],
+                         user.get('password', ''), user.get('token', '')])
+    click.echo(f"Created {len(result['created'])} users, rejected {len(result['errors'])} rows", err=True)
+
+
+def init_app(app):
+    """Register the provisioning command"""
+    app.cli.add_command(provision_users_command)
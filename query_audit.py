@@ -0,0 +1,146 @@
+"""Development and test helper that catches N+1 query patterns.
+
+With QUERY_AUDIT_ENABLED every statement a request issues is normalized
+(literals and IN lists collapsed) and counted. A statement that runs at least
+QUERY_AUDIT_REPEAT_THRESHOLD times with different parameters is logged as a
+probable N+1 together with the endpoint that issued it.
+
+Tests can bound the number of statements a block or a view issues::
+
+    with assert_max_queries(3):
+        client.get('/api/v1/workmen', headers=headers)
+
+    @query_budget(3)
+    def view(): ...
+"""
+import contextvars
+import functools
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import current_app, g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r"(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)"
+_IN_LIST = re.compile(rf"\bIN\s*\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})*\s*\)", re.IGNORECASE)
+_POSTCOMPILE = re.compile(r"\(__\[POSTCOMPILE_\w+\]\)")
+_WHITESPACE = re.compile(r"\s+")
+
+# Recorders opened with count_queries() in the current thread/task
+_active_recorders = contextvars.ContextVar('query_audit_recorders', default=())
+
+
+def normalize_statement(statement):
+    """Reduce a SQL statement to its shape so repeats compare equal"""
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    statement = _POSTCOMPILE.sub('(?)', statement)
+    statement = _IN_LIST.sub('IN (?)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryRecorder:
+    """Statements executed while the recorder is active"""
+
+    def __init__(self):
+        self.statements = []
+        self._parameters = {}
+
+    def record(self, statement, parameters):
+        normalized = normalize_statement(statement)
+        self.statements.append(normalized)
+        self._parameters.setdefault(normalized, set()).add(repr(parameters))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold):
+        """Statements run at least ``threshold`` times with varying parameters"""
+        counts = Counter(self.statements)
+        return [(statement, count) for statement, count in counts.most_common()
+                if count >= threshold and len(self._parameters[statement]) > 1]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for recorder in _active_recorders.get():
+        recorder.record(statement, parameters)
+    if has_request_context():
+        recorder = g.get('query_recorder')
+        if recorder is not None:
+            recorder.record(statement, parameters)
+
+
+@contextmanager
+def count_queries():
+    """Record the statements executed inside the block"""
+    recorder = QueryRecorder()
+    token = _active_recorders.set(_active_recorders.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _active_recorders.reset(token)
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    """Fail when the block executes more than ``max_queries`` statements"""
+    with count_queries() as recorder:
+        yield recorder
+    if recorder.count > max_queries:
+        raise AssertionError(f"Expected at most {max_queries} queries, got {recorder.count}:\n"
+                             + '\n'.join(recorder.statements))
+
+
+def query_budget(max_queries):
+    """Declare the most statements a view may issue.
+
+    Checked only while query auditing is enabled: over-budget requests are
+    logged, and raise when the app is in testing mode.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not current_app.config.get('QUERY_AUDIT_ENABLED'):
+                return f(*args, **kwargs)
+            with count_queries() as recorder:
+                response = f(*args, **kwargs)
+            if recorder.count > max_queries:
+                message = f"{request.endpoint} issued {recorder.count} queries (budget {max_queries})"
+                if current_app.testing:
+                    raise AssertionError(message)
+                logger.warning(message, extra={'endpoint': request.endpoint, 'queries': recorder.count,
+                                               'budget': max_queries})
+            return response
+        return decorated_function
+    return decorator
+
+
+def _start_recording():
+    g.query_recorder = QueryRecorder()
+
+
+def _report_repeats(response):
+    recorder = g.pop('query_recorder', None)
+    if recorder is None:
+        return response
+    for statement, count in recorder.repeated(current_app.config['QUERY_AUDIT_REPEAT_THRESHOLD']):
+        logger.warning("Probable N+1 in %s: statement ran %s times: %s", request.endpoint, count, statement,
+                       extra={'endpoint': request.endpoint, 'repeats': count, 'statement': statement})
+    return response
+
+
+def init_app(app):
+    """Record every request's statements when QUERY_AUDIT_ENABLED is set"""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+
+    if app.config['QUERY_AUDIT_ENABLED']:
+        app.before_request(_start_recording)
+        app.after_request(_report_repeats)
@@ -0,0 +1,154 @@
+"""Token-bucket rate limiting for the password-checking endpoints.
+
+Every login or token request takes one token from the client IP's bucket and
+one from the username's bucket before any password hash is computed; an empty
+bucket answers 429 with Retry-After. Buckets live in a small SQLite file
+shared by all gunicorn workers on the host (or in process memory with
+``RATE_LIMIT_STORAGE=memory``), and the least recently used buckets are
+evicted once there are more than RATE_LIMIT_MAX_KEYS of them.
+
+Limits are "<requests>/<seconds>": a bucket holds <requests> tokens and
+refills at <requests>/<seconds> tokens per second.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request
+
+logger = logging.getLogger(__name__)
+
+# Evict stale SQLite buckets after this many writes
+_EVICT_EVERY = 500
+
+
+def parse_limit(spec):
+    """Parse "10/60" into (capacity 10, refill rate of 10/60 tokens per second)"""
+    requests, seconds = spec.split('/', 1)
+    capacity = float(requests)
+    return capacity, capacity / float(seconds)
+
+
+def _refill(tokens, updated_at, capacity, rate, now):
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+
+def _take(tokens, rate):
+    """(allowed, tokens left, seconds until a token is available)"""
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Buckets in a bounded LRU dict, private to the process"""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            allowed, tokens, retry_after = _take(_refill(tokens, updated_at, capacity, rate, now), rate)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file shared by every worker process on the host"""
+
+    def __init__(self, path, max_keys):
+        self.path = path
+        self.max_keys = max_keys
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+        self._connection().execute('CREATE INDEX IF NOT EXISTS ix_buckets_updated_at ON buckets (updated_at)')
+
+    def _connection(self):
+        # sqlite3 connections are per thread, and must not be shared across fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], capacity, rate, now)
+            allowed, tokens, retry_after = _take(tokens, rate)
+            conn.execute('INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+                         (key, tokens, now))
+            self._writes += 1
+            if self._writes % _EVICT_EVERY == 0:
+                conn.execute('DELETE FROM buckets WHERE updated_at < (SELECT updated_at FROM buckets '
+                             'ORDER BY updated_at DESC LIMIT 1 OFFSET ?)', (self.max_keys,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, retry_after
+
+
+class RateLimiter:
+    """Per-IP and per-username buckets in front of password checks"""
+
+    def __init__(self, store, ip_limit, username_limit):
+        self.store = store
+        self.ip_limit = parse_limit(ip_limit)
+        self.username_limit = parse_limit(username_limit)
+
+    def check(self, ip, username):
+        """Seconds to wait before retrying, or None when the attempt may proceed"""
+        now = time.time()
+        checks = [(f'ip:{ip}', self.ip_limit)]
+        if username:
+            checks.append((f'user:{username.strip().lower()}', self.username_limit))
+        for key, (capacity, rate) in checks:
+            try:
+                allowed, retry_after = self.store.take(key, capacity, rate, now)
+            except sqlite3.Error as e:
+                # Never lock everyone out because the shared store is unavailable
+                logger.warning("Rate limit store unavailable, allowing request: %s", e)
+                return None
+            if not allowed:
+                logger.warning("Rate limited %s", key, extra={'rate_limit_key': key})
+                return max(1, int(retry_after + 0.999))
+        return None
+
+
+def create_limiter(config):
+    """Limiter for the configured storage"""
+    storage = config['RATE_LIMIT_STORAGE']
+    if storage == 'memory':
+        store = MemoryBucketStore(config['RATE_LIMIT_MAX_KEYS'])
+    else:
+        store = SQLiteBucketStore(storage, config['RATE_LIMIT_MAX_KEYS'])
+    return RateLimiter(store, config['RATE_LIMIT_IP'], config['RATE_LIMIT_USERNAME'])
+
+
+def check_credentials_attempt(username, ip=None):
+    """Retry-After seconds if a password check for ``username`` must be refused now"""
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return None
+    return limiter.check(ip or request.remote_addr, username)
+
+
+def init_app(app):
+    """Create the shared limiter when rate limiting is enabled"""
+    if app.config['RATE_LIMIT_ENABLED']:
+        app.extensions['rate_limiter'] = create_limiter(app.config)
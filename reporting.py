@@ -0,0 +1,198 @@
+"""Time report computation shared by the reports page, the API and background jobs"""
+import csv
+import heapq
+import io
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.orm import contains_eager
+from app import db
+from models import Workman, TimeEntry
+import archive
+import sharding
+
+# Filters a report accepts; anything else in a request is ignored
+REPORT_FILTERS = ('start_date', 'end_date', 'workman', 'company_id', 'location_id')
+
+
+def normalize_report_params(args):
+    """Canonical report filters from request arguments or a JSON body.
+
+    Empty values are dropped, ids become ints and dates are validated, so
+    equivalent requests produce identical parameters (and cache keys).
+    Raises ValueError for malformed dates or ids.
+    """
+    params = {}
+    for name in REPORT_FILTERS:
+        value = args.get(name)
+        if value is None or str(value).strip() == '':
+            continue
+        value = str(value).strip()
+        if name in ('company_id', 'location_id'):
+            value = int(value)
+        params[name] = value
+    archive.parse_date_range(params.get('start_date'), params.get('end_date'))
+    return params
+
+
+def runs_inline(params):
+    """Whether a report is small enough to compute inside the request.
+
+    One workman's report always is. Otherwise the range needs a start date and
+    may span at most REPORT_INLINE_MAX_DAYS days; larger reports go to a job.
+    """
+    if params.get('workman'):
+        return True
+    start_dt, end_dt = archive.parse_date_range(params.get('start_date'), params.get('end_date'))
+    if start_dt is None:
+        return False
+    return ((end_dt or datetime.utcnow()) - start_dt).days <= current_app.config['REPORT_INLINE_MAX_DAYS']
+
+
+def _report_shards(params):
+    return sharding.shards_for(trn=params.get('workman'), company_id=params.get('company_id'))
+
+
+def report_entries(params, whole_archive=False):
+    """Live and archived entries matching the filters, newest first, with workmen loaded.
+
+    Without a start date only ``whole_archive`` reads archived entries (see
+    archive.with_archived_entries). Runs on every shard the filters can match
+    and merges the results.
+    """
+    parts = sharding.gather(_shard_report_entries, params, whole_archive, shards=_report_shards(params))
+    return list(heapq.merge(*parts, key=lambda entry: entry.clock_in, reverse=True))
+
+
+def _shard_report_entries(params, whole_archive):
+    start_dt, end_dt = archive.parse_date_range(params.get('start_date'), params.get('end_date'))
+    workman_trn = params.get('workman')
+    company_id = params.get('company_id')
+    location_id = params.get('location_id')
+
+    # Load each entry's workman in the same query for the per-workman summary
+    query = db.session.query(TimeEntry).join(Workman).options(contains_eager(TimeEntry.workman))
+    if start_dt:
+        query = query.filter(TimeEntry.clock_in >= start_dt)
+    if end_dt:
+        query = query.filter(TimeEntry.clock_in < end_dt)
+    if workman_trn:
+        query = query.filter(Workman.trn == workman_trn)
+    if company_id:
+        query = query.filter(Workman.company_id == company_id)
+    if location_id:
+        query = query.filter(Workman.location_id == location_id)
+
+    entries = query.order_by(TimeEntry.clock_in.desc()).all()
+    return archive.with_archived_entries(entries, start_dt, end_dt, workman_trn, company_id, location_id,
+                                         whole_archive=whole_archive)
+
+
+def archived_totals(params):
+    """(workman, hours, sessions) of archived entries matching the filters, from the daily summaries, across shards"""
+    start_dt, end_dt = archive.parse_date_range(params.get('start_date'), params.get('end_date'))
+    parts = sharding.gather(archive.archived_totals, start_dt, end_dt, params.get('workman'),
+                            params.get('company_id'), params.get('location_id'), shards=_report_shards(params))
+    return [row for part in parts for row in part]
+
+
+def summarize_entries(entries, params=None):
+    """Totals and per-workman statistics keyed by TRN.
+
+    Given the report ``params`` of entries fetched without a start date, the
+    archived entries left out of them are counted from the daily summaries.
+    """
+    total_hours = sum([entry.get_duration_hours() or 0 for entry in entries])
+    completed_sessions = len([entry for entry in entries if entry.clock_out])
+    active_sessions = len([entry for entry in entries if not entry.clock_out])
+
+    workman_stats = {}
+    for entry in entries:
+        trn = entry.workman_trn
+        if trn not in workman_stats:
+            workman_stats[trn] = {
+                'workman': entry.workman,
+                'total_hours': 0,
+                'sessions': 0,
+                'completed_sessions': 0
+            }
+        workman_stats[trn]['sessions'] += 1
+        if entry.clock_out:
+            workman_stats[trn]['completed_sessions'] += 1
+            workman_stats[trn]['total_hours'] += entry.get_duration_hours() or 0
+
+    if params is not None and not params.get('start_date'):
+        # Archived entries are all closed
+        for workman, hours, sessions in archived_totals(params):
+            stats = workman_stats.setdefault(workman.trn, {
+                'workman': workman, 'total_hours': 0, 'sessions': 0, 'completed_sessions': 0})
+            stats['total_hours'] += hours
+            stats['sessions'] += sessions
+            stats['completed_sessions'] += sessions
+            total_hours += hours
+            completed_sessions += sessions
+
+    totals = {
+        'total_hours': round(total_hours, 2),
+        'completed_sessions': completed_sessions,
+        'active_sessions': active_sessions,
+    }
+    return totals, workman_stats
+
+
+def summary_data(entries, params=None):
+    """JSON-ready totals and per-workman statistics of a list of entries (see summarize_entries)"""
+    totals, workman_stats = summarize_entries(entries, params)
+    return {
+        'totals': totals,
+        'workmen': [{
+            'trn': trn,
+            'name': stats['workman'].name,
+            'company': stats['workman'].company,
+            'location': stats['workman'].location,
+            'total_hours': round(stats['total_hours'], 2),
+            'sessions': stats['sessions'],
+            'completed_sessions': stats['completed_sessions'],
+        } for trn, stats in workman_stats.items()],
+    }
+
+
+def build_summary(params):
+    """JSON-ready totals and per-workman statistics, without the entries"""
+    return {'filters': params, **summary_data(report_entries(params), params)}
+
+
+def build_report(params):
+    """JSON-ready report: totals, per-workman statistics and the entries"""
+    entries = report_entries(params)
+    return {
+        'filters': params,
+        **summary_data(entries, params),
+        'time_entries': [{
+            'id': entry.id,
+            'workman_trn': entry.workman_trn,
+            'clock_in': entry.clock_in.isoformat(),
+            'clock_out': entry.clock_out.isoformat() if entry.clock_out else None,
+            'duration_hours': entry.get_duration_hours(),
+            'notes': entry.notes,
+        } for entry in entries],
+    }
+
+
+def export_csv(params):
+    """Matching entries as CSV, one row per entry"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['trn', 'name', 'company', 'location', 'clock_in', 'clock_out', 'duration_hours', 'notes'])
+    # A background job, so an export without a start date may read the whole archive
+    for entry in report_entries(params, whole_archive=True):
+        writer.writerow([
+            entry.workman_trn,
+            entry.workman.name,
+            entry.workman.company,
+            entry.workman.location,
+            entry.clock_in.isoformat(),
+            entry.clock_out.isoformat() if entry.clock_out else '',
+            entry.get_duration_hours() if entry.clock_out else '',
+            entry.notes or '',
+        ])
+    return output.getvalue()
@@ -1,20 +1,64 @@
-from flask import render_template, request, redirect, url_for, flash
+from flask import Response, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
-from app import app, db
-from models import Workman, TimeEntry, User, UserRole
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Workman, TimeEntry, User, UserRole, Company, Location
 from auth import require_manage_workmen, require_clock_workmen
 from forms import AdminUserForm
 from datetime import datetime
+import heapq
+import json
+import api_tokens
+import archive
+import clock_ledger
+import jobs
+import reporting
+import sharding
+import snapshots
+import workman_deletion
 import logging
 
+logger = logging.getLogger(__name__)
+clock_logger = logging.getLogger('workmen.clock')
+
 # TRN (Tax Registration Number) is now provided by user during registration
 
-def get_all_workmen():
-    """Get all workmen from the database"""
-    workmen = db.session.query(Workman).order_by(Workman.name).all()
-    return workmen
+# Routes are collected here and attached by init_app, so importing this module
+# does not need an application instance. Endpoint names stay the function names.
+_routes = []
+
+
+def route(rule, **options):
+    """Record a view function to be registered on the app"""
+    def decorator(f):
+        _routes.append((rule, f, options))
+        return f
+    return decorator
+
+
+def init_app(app):
+    """Register the HTML routes on the app"""
+    for rule, view_func, options in _routes:
+        app.add_url_rule(rule, view_func=view_func, **options)
+
+def roster(search=None, company_id=None, location_id=None):
+    """Workmen of this shard matching the dashboard filters, by name"""
+    query = db.session.query(Workman)
+    if search:
+        query = query.filter(Workman.name.ilike(f'%{search}%'))
+    if company_id:
+        query = query.filter(Workman.company_id == company_id)
+    if location_id:
+        query = query.filter(Workman.location_id == location_id)
+    return query.order_by(Workman.name).all()
 
-@app.route('/')
+def get_all_workmen(search=None, company_id=None, location_id=None):
+    """Workmen matching the filters from every shard, by name"""
+    parts = sharding.gather(roster, search, company_id, location_id,
+                            shards=sharding.shards_for(company_id=company_id))
+    return list(heapq.merge(*parts, key=lambda workman: workman.name))
+
+@route('/')
 def index():
     """Landing page or dashboard based on authentication"""
     if not current_user.is_authenticated:
@@ -22,21 +66,20 @@ def index():
     else:
         return redirect(url_for('dashboard'))
 
-@app.route('/dashboard')
+@route('/dashboard')
 @login_required
 def dashboard():
     """Dashboard showing all workmen for authenticated users"""
     search_query = request.args.get('search', '').strip()
+    company_id = request.args.get('company_id', type=int)
+    location_id = request.args.get('location_id', type=int)
     
-    # Filter workmen based on search query
-    if search_query:
-        workmen = db.session.query(Workman).filter(Workman.name.ilike(f'%{search_query}%')).order_by(Workman.name).all()
-    else:
-        workmen = get_all_workmen()
+    # Filter workmen based on search query and company/location keys
+    workmen = get_all_workmen(search_query, company_id, location_id)
     
     return render_template('index.html', workmen=workmen, search_query=search_query)
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 @require_manage_workmen
 def register_workman():
     """Register a new workman"""
@@ -51,8 +94,9 @@ def register_workman():
             flash('TRN is required', 'error')
             return render_template('register.html')
         
-        # Check if TRN already exists
-        existing_workman = db.session.query(Workman).filter_by(trn=trn).first()
+        # Check if TRN already exists, on whichever shard it is
+        sharding.route_to_workman(trn)
+        existing_workman = db.session.scalar(Workman.lookup_including_deleted(trn))
         if existing_workman:
             flash('TRN already exists. Please use a unique TRN.', 'error')
             return render_template('register.html')
@@ -69,7 +113,8 @@ def register_workman():
             flash('Location is required', 'error')
             return render_template('register.html')
         
-        # Register the workman with the provided TRN
+        # Register the workman with the provided TRN, on their company's shard
+        sharding.route_to_company(company)
         new_workman = Workman(
             trn=trn,
             name=name,
@@ -81,12 +126,12 @@ def register_workman():
         db.session.commit()
         
         flash(f'Workman {name} registered successfully with TRN {trn}', 'success')
-        logging.info(f"Workman {name} registered with TRN {trn}")
+        logger.info("Workman %s registered with TRN %s", name, trn)
         return redirect(url_for('index'))
     
     return render_template('register.html')
 
-@app.route('/workman/<string:workman_trn>')
+@route('/workman/<string:workman_trn>')
 @login_required
 def workman_detail(workman_trn):
     """View workman details"""
@@ -97,7 +142,7 @@ def workman_detail(workman_trn):
     
     return render_template('workman_detail.html', workman=workman)
 
-@app.route('/workman/<string:workman_trn>/edit', methods=['GET', 'POST'])
+@route('/workman/<string:workman_trn>/edit', methods=['GET', 'POST'])
 @require_manage_workmen
 def edit_workman(workman_trn):
     """Edit workman details"""
@@ -133,12 +178,12 @@ def edit_workman(workman_trn):
         db.session.commit()
         
         flash(f'Workman {name} updated successfully', 'success')
-        logging.info(f"Workman {workman_trn} updated")
+        logger.info("Workman %s updated", workman_trn)
         return redirect(url_for('workman_detail', workman_trn=workman_trn))
     
     return render_template('edit_workman.html', workman=workman)
 
-@app.route('/workman/<string:workman_trn>/clock_in', methods=['POST'])
+@route('/workman/<string:workman_trn>/clock_in', methods=['POST'])
 @require_clock_workmen
 def clock_in(workman_trn):
     """Clock in a workman"""
@@ -147,6 +192,9 @@ def clock_in(workman_trn):
         flash('Workman not found', 'error')
         return redirect(url_for('index'))
     
+    # Serialize clock changes for this workman so the checks below stay valid
+    db.session.execute(Workman.clock_lock_statement(workman_trn))
+    
     # Check if already clocked in
     existing_entry = db.session.query(TimeEntry).filter_by(workman_trn=workman_trn, clock_out=None).first()
     if existing_entry:
@@ -160,13 +208,22 @@ def clock_in(workman_trn):
     )
     
     db.session.add(time_entry)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another writer opened an entry first (uq_time_entries_open_workman)
+        db.session.rollback()
+        flash(f'{workman.name} is already clocked in', 'warning')
+        return redirect(url_for('workman_detail', workman_trn=workman_trn))
     
+    clock_ledger.record(workman_trn, clock_ledger.CLOCK_IN, current_user.username, 'web', time_entry.clock_in,
+                        device_time=clock_ledger.parse_device_time(request.form.get('device_time')))
     flash(f'{workman.name} clocked in successfully', 'success')
-    logging.info(f"Workman {workman_trn} clocked in at {time_entry.clock_in}")
+    clock_logger.info("Workman %s clocked in at %s", workman_trn, time_entry.clock_in,
+                      extra={'event': 'clock_in', 'trn': workman_trn, 'actor': current_user.username})
     return redirect(url_for('workman_detail', workman_trn=workman_trn))
 
-@app.route('/workman/<string:workman_trn>/clock_out', methods=['POST'])
+@route('/workman/<string:workman_trn>/clock_out', methods=['POST'])
 @require_clock_workmen
 def clock_out(workman_trn):
     """Clock out a workman"""
@@ -175,6 +232,9 @@ def clock_out(workman_trn):
         flash('Workman not found', 'error')
         return redirect(url_for('index'))
     
+    # Serialize clock changes for this workman so the checks below stay valid
+    db.session.execute(Workman.clock_lock_statement(workman_trn))
+    
     # Find the active time entry (not clocked out)
     active_entry = db.session.query(TimeEntry).filter_by(workman_trn=workman_trn, clock_out=None).first()
     if not active_entry:
@@ -185,30 +245,28 @@ def clock_out(workman_trn):
     active_entry.clock_out = datetime.utcnow()
     db.session.commit()
     
+    clock_ledger.record(workman_trn, clock_ledger.CLOCK_OUT, current_user.username, 'web', active_entry.clock_out,
+                        device_time=clock_ledger.parse_device_time(request.form.get('device_time')))
     flash(f'{workman.name} clocked out successfully', 'success')
-    logging.info(f"Workman {workman_trn} clocked out at {active_entry.clock_out}")
+    clock_logger.info("Workman %s clocked out at %s", workman_trn, active_entry.clock_out,
+                      extra={'event': 'clock_out', 'trn': workman_trn, 'actor': current_user.username})
     return redirect(url_for('workman_detail', workman_trn=workman_trn))
 
-@app.route('/locations')
+@route('/locations')
 @login_required
 def locations():
     """View workmen grouped by location"""
-    workmen = get_all_workmen()
+    # Order by location, keeping the name order within each, so grouping is a single pass
+    workmen = sorted(get_all_workmen(), key=lambda workman: workman.location)
     
     # Group workmen by location
     locations_dict = {}
     for workman in workmen:
-        location = workman.location
-        if location not in locations_dict:
-            locations_dict[location] = []
-        locations_dict[location].append(workman)
+        locations_dict.setdefault(workman.location, []).append(workman)
     
-    # Sort locations alphabetically (workmen are already sorted by name)
-    sorted_locations = dict(sorted(locations_dict.items()))
-    
-    return render_template('locations.html', locations=sorted_locations)
+    return render_template('locations.html', locations=locations_dict)
 
-@app.route('/workman/<string:workman_trn>/time_history')
+@route('/workman/<string:workman_trn>/time_history')
 @login_required
 def workman_time_history(workman_trn):
     """View time tracking history for a specific workman"""
@@ -217,20 +275,38 @@ def workman_time_history(workman_trn):
         flash('Workman not found', 'error')
         return redirect(url_for('index'))
     
-    # Get time entries for this workman
-    time_entries = db.session.query(TimeEntry).filter_by(workman_trn=workman_trn).order_by(TimeEntry.clock_in.desc()).all()
+    # An optional clock_in range; a range with a start date also lists archived entries
+    start_date = request.args.get('start_date') or None
+    end_date = request.args.get('end_date') or None
+    try:
+        start_dt, end_dt = archive.parse_date_range(start_date, end_date)
+    except ValueError:
+        flash('Invalid date format', 'error')
+        start_date = end_date = start_dt = end_dt = None
+    
+    query = db.session.query(TimeEntry).filter_by(workman_trn=workman_trn)
+    if start_dt:
+        query = query.filter(TimeEntry.clock_in >= start_dt)
+    if end_dt:
+        query = query.filter(TimeEntry.clock_in < end_dt)
+    time_entries = query.order_by(TimeEntry.clock_in.desc()).all()
+    time_entries = archive.with_archived_entries(time_entries, start_dt, end_dt, workman_trn)
+    # Without a start date archived entries are only counted, from the daily summaries
+    archived = archive.archived_totals(end_dt=end_dt, workman_trn=workman_trn) if not start_dt else []
     
     # Calculate total hours
-    total_hours = sum([entry.get_duration_hours() or 0 for entry in time_entries])
-    completed_sessions = len([entry for entry in time_entries if entry.clock_out])
+    total_hours = sum([entry.get_duration_hours() or 0 for entry in time_entries]) + sum(hours for _, hours, _ in archived)
+    completed_sessions = len([entry for entry in time_entries if entry.clock_out]) + sum(sessions for _, _, sessions in archived)
     
     return render_template('workman_time_history.html',
                          workman=workman,
                          time_entries=time_entries,
                          total_hours=round(total_hours, 2),
-                         completed_sessions=completed_sessions)
+                         completed_sessions=completed_sessions,
+                         start_date=start_date,
+                         end_date=end_date)
 
-@app.route('/workman/<string:workman_trn>/delete', methods=['POST'])
+@route('/workman/<string:workman_trn>/delete', methods=['POST'])
 @require_manage_workmen
 def delete_workman(workman_trn):
     """Delete a workman"""
@@ -240,90 +316,119 @@ def delete_workman(workman_trn):
         return redirect(url_for('index'))
     
     workman_name = workman.name
-    db.session.delete(workman)  # This will cascade delete time entries
-    db.session.commit()
+    workman_deletion.delete_workman(workman, current_user)
     
     flash(f'Workman {workman_name} deleted successfully', 'success')
-    logging.info(f"Workman {workman_trn} deleted")
+    logger.info("Workman %s deleted", workman_trn)
     return redirect(url_for('index'))
 
-@app.route('/reports')
+@route('/reports')
 @login_required
 def reports():
     """Time tracking reports"""
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    # Get date filters from request
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    workman_filter = request.args.get('workman')
-    
-    # Build query
-    query = db.session.query(TimeEntry).join(Workman)
-    
-    # Apply filters
-    if start_date:
-        try:
-            start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-            query = query.filter(TimeEntry.clock_in >= start_dt)
-        except ValueError:
-            flash('Invalid start date format', 'error')
-            start_date = None
-    
-    if end_date:
-        try:
-            end_dt = datetime.strptime(end_date, '%Y-%m-%d')
-            # Add one day to include the entire end date
-            end_dt = end_dt + timedelta(days=1)
-            query = query.filter(TimeEntry.clock_in < end_dt)
-        except ValueError:
-            flash('Invalid end date format', 'error')
-            end_date = None
-    
-    if workman_filter:
-        query = query.filter(Workman.trn == workman_filter)
-    
-    # Get time entries
-    time_entries = query.order_by(TimeEntry.clock_in.desc()).all()
-    
-    # Calculate statistics
-    total_hours = sum([entry.get_duration_hours() or 0 for entry in time_entries])
-    completed_sessions = len([entry for entry in time_entries if entry.clock_out])
-    active_sessions = len([entry for entry in time_entries if not entry.clock_out])
-    
-    # Group by workman for summary
-    workman_stats = {}
-    for entry in time_entries:
-        trn = entry.workman_trn
-        if trn not in workman_stats:
-            workman_stats[trn] = {
-                'workman': entry.workman,
-                'total_hours': 0,
-                'sessions': 0,
-                'completed_sessions': 0
-            }
-        workman_stats[trn]['sessions'] += 1
-        if entry.clock_out:
-            workman_stats[trn]['completed_sessions'] += 1
-            workman_stats[trn]['total_hours'] += entry.get_duration_hours() or 0
-    
-    # Get all workmen for filter dropdown
-    all_workmen = db.session.query(Workman).order_by(Workman.name).all()
-    
+    args = request.args.to_dict()
+    try:
+        params = reporting.normalize_report_params(snapshots.apply_period(args))
+    except ValueError:
+        flash('Invalid date format or filter', 'error')
+        for name in ('period', 'start_date', 'end_date', 'company_id', 'location_id'):
+            args.pop(name, None)
+        params = reporting.normalize_report_params(args)
+    
+    # Standard periods come from the precomputed snapshot; the entry list is then left out
+    snapshot = snapshots.find_snapshot(params)
+    if snapshot:
+        return _render_summary(params, snapshot.data, snapshot=snapshot)
+    
+    # Large reports are computed by a background job while the browser waits
+    if not reporting.runs_inline(params):
+        job = jobs.submit('report_summary', params, current_user)
+        return redirect(url_for('report_job', job_id=job.id))
+    
+    time_entries = reporting.report_entries(params)
+    totals, workman_stats = reporting.summarize_entries(time_entries, params)
+    return _render_report(params, time_entries, totals, workman_stats, get_all_workmen())
+
+@route('/reports/jobs/<string:job_id>')
+@login_required
+def report_job(job_id):
+    """Show a report computed by a background job, polling until it is ready"""
+    job = jobs.get_job(job_id)
+    if not job or job.kind != 'report_summary':
+        flash('Report not found or expired', 'error')
+        return redirect(url_for('reports'))
+    if job.status == jobs.FAILED:
+        flash('Report failed, please try again', 'error')
+        return redirect(url_for('reports'))
+    if job.status != jobs.SUCCEEDED:
+        return Response('Your report is being prepared...', status=202, mimetype='text/plain',
+                        headers={'Refresh': '2'})
+    
+    return _render_summary(job.params, json.loads(job.result))
+
+def _render_summary(params, data, snapshot=None):
+    """Render a report from precomputed totals and per-workman statistics, without entries"""
+    all_workmen = get_all_workmen()
+    workmen = {w.trn: w for w in all_workmen}
+    workman_stats = {stats['trn']: {
+        'workman': workmen.get(stats['trn']),
+        'total_hours': stats['total_hours'],
+        'sessions': stats['sessions'],
+        'completed_sessions': stats['completed_sessions']
+    } for stats in data['workmen'] if stats['trn'] in workmen}
+    return _render_report(params, [], data['totals'], workman_stats, all_workmen, snapshot)
+
+def _render_report(params, time_entries, totals, workman_stats, all_workmen, snapshot=None):
     return render_template('reports.html', 
                          time_entries=time_entries,
-                         total_hours=round(total_hours, 2),
-                         completed_sessions=completed_sessions,
-                         active_sessions=active_sessions,
+                         total_hours=totals['total_hours'],
+                         completed_sessions=totals['completed_sessions'],
+                         active_sessions=totals['active_sessions'],
                          workman_stats=workman_stats,
                          all_workmen=all_workmen,
-                         start_date=start_date,
-                         end_date=end_date,
-                         workman_filter=workman_filter)
+                         start_date=params.get('start_date'),
+                         end_date=params.get('end_date'),
+                         workman_filter=params.get('workman'),
+                         companies=db.session.query(Company).order_by(Company.name).all(),
+                         locations=db.session.query(Location).order_by(Location.name).all(),
+                         company_id=params.get('company_id'),
+                         location_id=params.get('location_id'),
+                         snapshot=snapshot)
+
+@route('/reports/export', methods=['POST'])
+@login_required
+def export_report():
+    """Queue a CSV export of the current report filters"""
+    try:
+        params = reporting.normalize_report_params(request.form)
+    except ValueError:
+        flash('Invalid date format', 'error')
+        return redirect(url_for('reports'))
+    
+    job = jobs.submit('report_csv', params, current_user)
+    return redirect(url_for('download_report', job_id=job.id))
+
+@route('/reports/jobs/<string:job_id>/download')
+@login_required
+def download_report(job_id):
+    """Download a finished export, polling until it is ready"""
+    job = jobs.get_job(job_id)
+    if not job:
+        flash('Export not found or expired', 'error')
+        return redirect(url_for('reports'))
+    if job.status == jobs.FAILED:
+        flash('Export failed, please try again', 'error')
+        return redirect(url_for('reports'))
+    if job.status != jobs.SUCCEEDED:
+        # Plain page that reloads itself until the export is ready
+        return Response('Your export is being prepared...', status=202, mimetype='text/plain',
+                        headers={'Refresh': '2'})
+    
+    return Response(job.result, mimetype=job.content_type,
+                    headers={'Content-Disposition': f'attachment; filename=report-{job.id}.csv'})
 
 # Admin routes
-@app.route('/admin/users')
+@route('/admin/users')
 @login_required
 def admin_users():
     """Admin page to manage users"""
@@ -334,7 +439,7 @@ def admin_users():
     users = db.session.query(User).order_by(User.username).all()
     return render_template('admin/users.html', users=users)
 
-@app.route('/admin/users/<int:user_id>/edit', methods=['GET', 'POST'])
+@route('/admin/users/<int:user_id>/edit', methods=['GET', 'POST'])
 @login_required
 def admin_edit_user(user_id):
     """Edit user details (admin only)"""
@@ -364,11 +469,11 @@ def admin_edit_user(user_id):
         except Exception as e:
             db.session.rollback()
             flash('Failed to update user', 'error')
-            logging.error(f"Error updating user {user_id}: {e}")
+            logger.error("Error updating user %s: %s", user_id, e)
     
     return render_template('admin/edit_user.html', form=form, user=user)
 
-@app.route('/admin/users/<int:user_id>/delete', methods=['POST'])
+@route('/admin/users/<int:user_id>/delete', methods=['POST'])
 @login_required
 def admin_delete_user(user_id):
     """Delete user (admin only)"""
@@ -390,10 +495,10 @@ def admin_delete_user(user_id):
     db.session.commit()
     
     flash(f'User {username} deleted successfully', 'success')
-    logging.info(f"Admin {current_user.username} deleted user {username}")
+    logger.info("Admin %s deleted user %s", current_user.username, username)
     return redirect(url_for('admin_users'))
 
-@app.route('/admin/users/<int:user_id>/generate-token', methods=['POST'])
+@route('/admin/users/<int:user_id>/generate-token', methods=['POST'])
 @login_required
 def admin_generate_token(user_id):
     """Generate API token for user (admin only)"""
@@ -406,14 +511,13 @@ def admin_generate_token(user_id):
         flash('User not found', 'error')
         return redirect(url_for('admin_users'))
     
-    token = user.generate_api_token()
-    db.session.commit()
+    token = api_tokens.issue_token(user, 'admin')
     
     flash(f'API token generated for {user.username}: {token}', 'success')
-    logging.info(f"Admin {current_user.username} generated API token for user {user.username}")
+    logger.info("Admin %s generated API token for user %s", current_user.username, user.username)
     return redirect(url_for('admin_edit_user', user_id=user_id))
 
-@app.route('/admin/users/<int:user_id>/revoke-token', methods=['POST'])
+@route('/admin/users/<int:user_id>/revoke-token', methods=['POST'])
 @login_required
 def admin_revoke_token(user_id):
     """Revoke API token for user (admin only)"""
@@ -426,13 +530,11 @@ def admin_revoke_token(user_id):
         flash('User not found', 'error')
         return redirect(url_for('admin_users'))
     
-    if not user.api_token:
+    if not user.revoke_api_tokens():
         flash(f'{user.username} does not have an active API token', 'warning')
         return redirect(url_for('admin_edit_user', user_id=user_id))
-    
-    user.revoke_api_token()
     db.session.commit()
     
     flash(f'API token revoked for {user.username}', 'success')
-    logging.info(f"Admin {current_user.username} revoked API token for user {user.username}")
+    logger.info("Admin %s revoked API token for user %s", current_user.username, user.username)
     return redirect(url_for('admin_edit_user', user_id=user_id))
@@ -0,0 +1,55 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Run a function on a daemon thread at a fixed interval"""
+
+    def __init__(self, name, interval, func, app=None):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.app = app
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the background thread if it is not already running in this process"""
+        # Threads do not survive fork, so a worker forked from a preloaded
+        # master starts its own
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info("Periodic task %s started (every %ss)", self.name, self.interval)
+    
+    def start_on_first_request(self, app):
+        """Start the thread lazily in whichever process serves requests"""
+        @app.before_request
+        def _start_periodic_task():
+            if self._pid != os.getpid():
+                self.start()
+
+    def stop(self):
+        """Signal the background thread to stop"""
+        self._stop_event.set()
+
+    def run_once(self):
+        """Run the task once, inside an app context when an app is attached"""
+        if self.app is not None:
+            with self.app.app_context():
+                return self.func()
+        return self.func()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Periodic task %s failed: %s", self.name, e)
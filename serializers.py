@@ -0,0 +1,82 @@
+def serialize_user(user):
+    """Public fields of a user"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'role': user.role.value
+    }
+
+
+def serialize_user_with_permissions(user):
+    """User fields plus the permissions the API checks"""
+    data = serialize_user(user)
+    data['permissions'] = {
+        'can_manage_workmen': user.can_manage_workmen(),
+        'can_clock_workmen': user.can_clock_workmen()
+    }
+    return data
+
+
+def serialize_workman(workman, status):
+    """Workman fields shared by list, create and update responses"""
+    return {
+        'trn': workman.trn,
+        'name': workman.name,
+        'company': workman.company,
+        'company_id': workman.company_id,
+        'location': workman.location,
+        'location_id': workman.location_id,
+        'status': status,
+        'created_at': workman.created_at.isoformat(),
+        'updated_at': workman.updated_at.isoformat()
+    }
+
+
+def serialize_workman_detail(workman, status, latest_clock_in, latest_clock_out):
+    """Workman fields plus latest clock times"""
+    data = serialize_workman(workman, status)
+    data['latest_clock_in'] = latest_clock_in.isoformat() if latest_clock_in else None
+    data['latest_clock_out'] = latest_clock_out.isoformat() if latest_clock_out else None
+    return data
+
+
+def serialize_time_entry(entry):
+    """Time entry fields with computed durations"""
+    return {
+        'id': entry.id,
+        'clock_in': entry.clock_in.isoformat(),
+        'clock_out': entry.clock_out.isoformat() if entry.clock_out else None,
+        'duration_hours': entry.get_duration_hours(),
+        'duration_formatted': entry.get_duration_formatted(),
+        'notes': entry.notes
+    }
+
+
+def serialize_time_entries(workman, entries):
+    """Time entry listing for one workman with totals"""
+    return {
+        'workman': {
+            'trn': workman.trn,
+            'name': workman.name
+        },
+        'time_entries': [serialize_time_entry(entry) for entry in entries],
+        'total_completed_hours': sum([entry.get_duration_hours() or 0 for entry in entries]),
+        'completed_sessions': len([entry for entry in entries if entry.clock_out])
+    }
+
+
+def serialize_job(job):
+    """Status fields of a background job"""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'params': job.params,
+        'error': job.error,
+        'submitted_by': job.submitted_by,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None
+    }
@@ -0,0 +1,461 @@
+"""Optional horizontal sharding of workmen by company.
+
+DATABASE_SHARDS lists extra databases as comma separated name=url pairs. The
+primary database (DATABASE_URL) is a shard too, named "primary". Several
+SQLite files are enough to try it locally::
+
+    DATABASE_URL=sqlite:///primary.db \\
+    DATABASE_SHARDS=east=sqlite:///east.db,west=sqlite:///west.db
+
+Each company's workmen live on a single shard, together with their time
+entries, archived entries and daily summaries. The primary holds everything
+else: users, tokens, jobs and the clock ledger. It also holds the shard map:
+
+- ``company_shards`` assigns companies to shards. A company with no row
+  there is on the primary, as every company was before sharding.
+- ``workman_shards`` maps each TRN to its company, so a request for a
+  workman is routed with a single lookup on the primary.
+
+Companies and locations are small, so they are copied to every shard and
+workman queries can join them locally.
+
+Requests with a TRN in the URL are routed before the view runs. Creating a
+workman is routed by its company (``route_to_company``), and a new company
+is spread over the shards by its id. Roster and report queries that have no
+shard key run on every shard in parallel (``gather``) and merge the results.
+
+``flask move-company`` moves a company to another shard: it locks the
+company, so writes get 503 while it runs, copies the rows in batches,
+switches the map and then deletes the source rows. Background jobs that
+write workman history (stale entries, archival) skip the workmen of a locked
+company through ``unlocked_workmen`` and catch up on their next run.
+``flask shard-status`` shows how companies and workmen are spread over the
+shards.
+"""
+import click
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app, g, has_app_context, jsonify, request
+from sqlalchemy import delete, event, func, insert, inspect, select, true
+from sqlalchemy.orm import object_session
+from app import db
+from db_routing import PRIMARY_SHARD, SAFE_METHODS, SHARD_BIND_PREFIX, RoutingSession, current_shard
+from models import (Company, Location, Workman, TimeEntry, ArchivedTimeEntry, DailySummary, AttendanceBitmap,
+                    CompanyShard, WorkmanShard)
+
+logger = logging.getLogger(__name__)
+
+# URL arguments naming a workman in the HTML and API routes
+TRN_VIEW_ARGS = ('workman_trn', 'trn')
+
+# Copied to every shard so workman queries can join them locally
+DIMENSION_TABLES = (Company.__table__, Location.__table__)
+# Workmen before their history, the order rows are copied in
+SHARD_TABLES = (Workman.__table__, TimeEntry.__table__, ArchivedTimeEntry.__table__, DailySummary.__table__,
+                AttendanceBitmap.__table__)
+
+RETRY_AFTER_SECONDS = 30
+
+_MOVES_KEY = 'shard_moves'
+
+
+class ShardLocked(Exception):
+    """The workman's company is being moved to another shard; its workmen are read-only"""
+
+
+def shard_names(app=None):
+    """The primary followed by the configured shards"""
+    binds = (app or current_app).config.get('SQLALCHEMY_BINDS') or {}
+    return [PRIMARY_SHARD] + sorted(key[len(SHARD_BIND_PREFIX):] for key in binds if key.startswith(SHARD_BIND_PREFIX))
+
+
+def enabled(app=None):
+    return len(shard_names(app)) > 1
+
+
+def engine_for(shard):
+    return db.engine if shard == PRIMARY_SHARD else db.engines[f"{SHARD_BIND_PREFIX}{shard}"]
+
+
+def placement(company_id, shards):
+    """Shard a new company goes to: companies are spread over the shards by id"""
+    return shards[company_id % len(shards)]
+
+
+def _workman_key(table):
+    return table.c.trn if table is Workman.__table__ else table.c.workman_trn
+
+
+# The shard map is always read from the primary, never from a lagging replica
+def _on_primary(stmt):
+    return db.session.execute(stmt, bind_arguments={'bind': db.engine})
+
+
+def shard_for_company(company_id):
+    """(shard, locked) of a company"""
+    row = _on_primary(select(CompanyShard.shard, CompanyShard.locked_at)
+                      .where(CompanyShard.company_id == company_id)).first()
+    if row is None:
+        return PRIMARY_SHARD, False
+    return row.shard, row.locked_at is not None
+
+
+def shard_for_trn(trn):
+    """(shard, locked) of a workman's company; unknown TRNs are on the primary"""
+    row = _on_primary(select(CompanyShard.shard, CompanyShard.locked_at)
+                      .join(WorkmanShard, WorkmanShard.company_id == CompanyShard.company_id)
+                      .where(WorkmanShard.trn == trn)).first()
+    if row is None:
+        return PRIMARY_SHARD, False
+    return row.shard, row.locked_at is not None
+
+
+def locked_company_ids():
+    """Companies being moved to another shard"""
+    if not enabled():
+        return set()
+    return set(_on_primary(select(CompanyShard.company_id).where(CompanyShard.locked_at.isnot(None))).scalars())
+
+
+def unlocked_workmen(trn_column):
+    """Filter on ``trn_column`` leaving out the workmen of companies being moved.
+
+    For batch jobs writing to the current shard: they check it for every
+    batch, and a move waits its grace period after locking, like it does for
+    requests, before it copies anything.
+    """
+    locked = locked_company_ids()
+    if not locked:
+        return true()
+    return trn_column.notin_(select(Workman.trn).where(Workman.company_id.in_(locked)))
+
+
+def route_to_workman(trn, write=False):
+    """Point the sharded tables at the shard of a workman for the rest of this context"""
+    if not enabled():
+        return PRIMARY_SHARD
+    shard, locked = shard_for_trn(trn)
+    if locked and write:
+        raise ShardLocked(trn)
+    g.db_shard = shard
+    return shard
+
+
+def route_to_company(name):
+    """Point the sharded tables at the shard for new workmen of company ``name``.
+
+    Creates the company if it does not exist yet and places it on a shard.
+    """
+    if not enabled():
+        return PRIMARY_SHARD
+    company = Company.get_or_create(name)
+    if company.id is None:
+        db.session.flush()
+        shard, locked = placement(company.id, shard_names()), False
+        db.session.add(CompanyShard(company_id=company.id, shard=shard))
+    else:
+        shard, locked = shard_for_company(company.id)
+    if locked:
+        raise ShardLocked(name)
+    g.db_shard = shard
+    return shard
+
+
+def shards_for(trn=None, company_id=None):
+    """Shards a query filtered by TRN or company has to look at, or None for all"""
+    if not enabled():
+        return None
+    if trn:
+        return [shard_for_trn(trn)[0]]
+    if company_id:
+        return [shard_for_company(company_id)[0]]
+    return None
+
+
+class _Pool:
+    executor = None
+    pid = None
+
+
+_pool = _Pool()
+
+
+def _executor():
+    """The process's gather thread pool, recreated after fork"""
+    if _pool.executor is None or _pool.pid != os.getpid():
+        _pool.executor = ThreadPoolExecutor(max_workers=current_app.config['SHARD_GATHER_WORKERS'],
+                                            thread_name_prefix='shard-gather')
+        _pool.pid = os.getpid()
+    return _pool.executor
+
+
+def gather(func, *args, shards=None, **kwargs):
+    """Run ``func`` on every shard (or ``shards``) in parallel; returns the results in shard order.
+
+    Each call runs in its own app context, with its own session, and the
+    sharded tables pointed at its shard. Objects it returns are detached, so
+    it should load everything the caller uses. Without sharding ``func`` just
+    runs here.
+    """
+    if not enabled():
+        return [func(*args, **kwargs)]
+    app = current_app._get_current_object()
+
+    def run(shard):
+        with app.app_context():
+            g.db_shard = shard
+            return func(*args, **kwargs)
+
+    futures = [_executor().submit(run, shard) for shard in shards or shard_names()]
+    return [future.result() for future in futures]
+
+
+def _copy_dimension(mapper, connection, target):
+    """Copy a new company or location to every shard, in the same transaction"""
+    session = object_session(target)
+    for shard in shard_names()[1:]:
+        session.connection(bind_arguments={'bind': engine_for(shard)}).execute(
+            insert(mapper.local_table), [{'id': target.id, 'name': target.name}])
+
+
+def sync_dimensions(shard):
+    """Copy the companies and locations a shard is missing from the primary"""
+    with db.engine.connect() as source, engine_for(shard).begin() as target:
+        for table in DIMENSION_TABLES:
+            present = set(target.scalars(select(table.c.id)))
+            rows = [dict(row) for row in source.execute(select(table)).mappings() if row['id'] not in present]
+            if rows:
+                target.execute(insert(table), rows)
+
+
+def create_shard_schema():
+    """Create the sharded and dimension tables on every shard and copy the dimensions"""
+    for shard in shard_names()[1:]:
+        engine = engine_for(shard)
+        db.metadata.create_all(engine, tables=[*DIMENSION_TABLES, *SHARD_TABLES])
+        for table in SHARD_TABLES:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+        sync_dimensions(shard)
+
+
+def _copy_workmen(source, target, trns):
+    """Copy workmen and their history between two connections; returns rows copied"""
+    copied = 0
+    for table in SHARD_TABLES:
+        rows = [dict(row) for row in source.execute(select(table).where(_workman_key(table).in_(trns))).mappings()]
+        if table is TimeEntry.__table__:
+            # Entry ids are per database, the target numbers the entries itself
+            for row in rows:
+                del row['id']
+        if rows:
+            target.execute(insert(table), rows)
+            copied += len(rows)
+    return copied
+
+
+def _delete_workmen(conn, trns):
+    for table in reversed(SHARD_TABLES):
+        conn.execute(delete(table).where(_workman_key(table).in_(trns)))
+
+
+def _track_workmen(session, flush_context):
+    """Keep workman_shards in step with the workmen added, deleted or given another company"""
+    if not has_app_context() or not enabled():
+        return
+    added = [obj for obj in session.new if isinstance(obj, Workman)]
+    removed = [obj.trn for obj in session.deleted if isinstance(obj, Workman)]
+    changed = [obj for obj in session.dirty
+               if isinstance(obj, Workman) and inspect(obj).attrs.company_ref.history.has_changes()]
+    if not (added or removed or changed):
+        return
+
+    primary = session.connection(bind_arguments={'bind': db.engine})
+    here = current_shard()
+    for obj in added + changed:
+        row = primary.execute(select(CompanyShard.shard, CompanyShard.locked_at)
+                              .where(CompanyShard.company_id == obj.company_id)).first()
+        if row is None and obj.company_ref in session.new:
+            # A company created without route_to_company stays where its first workman was written
+            primary.execute(insert(CompanyShard), [{'company_id': obj.company_id, 'shard': here}])
+            row = (here, None)
+        shard, locked_at = row or (PRIMARY_SHARD, None)
+        if locked_at is not None:
+            raise ShardLocked(obj.trn)
+        if shard == here:
+            continue
+        if obj in added:
+            raise RuntimeError(f"Workman {obj.trn} belongs on shard {shard}, not {here}; "
+                               "call sharding.route_to_company first")
+        session.info.setdefault(_MOVES_KEY, {})[obj.trn] = (here, shard)
+
+    trns = [obj.trn for obj in added + changed] + removed
+    primary.execute(delete(WorkmanShard.__table__).where(WorkmanShard.trn.in_(trns)))
+    rows = [{'trn': obj.trn, 'company_id': obj.company_id} for obj in added + changed]
+    if rows:
+        primary.execute(insert(WorkmanShard.__table__), rows)
+
+
+def _relocate_workmen(session):
+    """Move workmen whose new company is on another shard, within the committing transaction"""
+    if not has_app_context() or not enabled():
+        return
+    session.flush()
+    moves = session.info.pop(_MOVES_KEY, {})
+    for trn, (source, target) in moves.items():
+        source_conn = session.connection(bind_arguments={'bind': engine_for(source)})
+        target_conn = session.connection(bind_arguments={'bind': engine_for(target)})
+        _copy_workmen(source_conn, target_conn, [trn])
+        _delete_workmen(source_conn, [trn])
+        # The instance is reloaded from its new shard after the commit
+        session.expire_all()
+        if has_app_context():
+            g.db_shard = target
+        logger.info("Moved workman %s from shard %s to %s", trn, source, target,
+                    extra={'trn': trn, 'source_shard': source, 'target_shard': target})
+
+
+def _delete_company(shard, company_id, batch_size):
+    """Delete a company's workmen and their history from one shard, in batches"""
+    workmen = Workman.__table__
+    deleted = 0
+    while True:
+        with engine_for(shard).begin() as conn:
+            trns = list(conn.scalars(select(workmen.c.trn).where(workmen.c.company_id == company_id).limit(batch_size)))
+            if not trns:
+                return deleted
+            _delete_workmen(conn, trns)
+        deleted += len(trns)
+
+
+def move_company(company_id, target, batch_size=None, grace=None):
+    """Move a company's workmen and their history to shard ``target``; returns workmen moved.
+
+    The company is locked first, and the copy starts after ``grace`` seconds
+    so requests routed before the lock have finished writing. The copy is done
+    in batches of ``batch_size`` workmen. Then the map is switched, and after
+    another grace period the source rows are deleted. Running it again after
+    an interruption starts over and first removes what the failed run copied.
+    """
+    config = current_app.config
+    batch_size = batch_size or config['SHARD_MOVE_BATCH_SIZE']
+    grace = config['SHARD_MOVE_GRACE_SECONDS'] if grace is None else grace
+    if target not in shard_names():
+        raise ValueError(f"Unknown shard: {target}")
+
+    assignment = db.session.get(CompanyShard, company_id)
+    if assignment is None:
+        assignment = CompanyShard(company_id=company_id, shard=PRIMARY_SHARD)
+        db.session.add(assignment)
+    source = assignment.shard
+    # Rows of this company outside its shard were left by an interrupted move
+    for shard in shard_names():
+        if shard != source:
+            _delete_company(shard, company_id, batch_size)
+    if source == target:
+        assignment.locked_at = None
+        db.session.commit()
+        return 0
+
+    assignment.locked_at = datetime.utcnow()
+    db.session.commit()
+    time.sleep(grace)
+
+    sync_dimensions(target)
+    workmen = Workman.__table__
+    with engine_for(source).connect() as conn:
+        trns = list(conn.scalars(select(workmen.c.trn).where(workmen.c.company_id == company_id)))
+    for i in range(0, len(trns), batch_size):
+        batch = trns[i:i + batch_size]
+        with engine_for(source).connect() as source_conn, engine_for(target).begin() as target_conn:
+            _copy_workmen(source_conn, target_conn, batch)
+        with db.engine.begin() as conn:
+            conn.execute(delete(WorkmanShard.__table__).where(WorkmanShard.trn.in_(batch)))
+            conn.execute(insert(WorkmanShard.__table__), [{'trn': trn, 'company_id': company_id} for trn in batch])
+        logger.info("Copied %s of %s workmen of company %s to shard %s", i + len(batch), len(trns), company_id, target)
+
+    assignment.shard = target
+    assignment.locked_at = None
+    db.session.commit()
+    # Requests that looked up the old assignment may still be reading the source
+    time.sleep(grace)
+    _delete_company(source, company_id, batch_size)
+
+    logger.info("Moved company %s from shard %s to %s", company_id, source, target,
+                extra={'company_id': company_id, 'source_shard': source, 'target_shard': target,
+                       'workmen': len(trns)})
+    return len(trns)
+
+
+def shard_status():
+    """Companies assigned to and workmen stored on each shard"""
+    assigned = dict(db.session.execute(
+        select(CompanyShard.shard, func.count()).group_by(CompanyShard.shard)).all())
+    # Companies without an assignment are on the primary
+    assigned[PRIMARY_SHARD] = (assigned.get(PRIMARY_SHARD, 0)
+                               + db.session.scalar(select(func.count(Company.id)))
+                               - db.session.scalar(select(func.count()).select_from(CompanyShard)))
+    status = []
+    for shard in shard_names():
+        with engine_for(shard).connect() as conn:
+            workmen = conn.scalar(select(func.count()).select_from(Workman.__table__))
+        status.append({'shard': shard, 'companies': assigned.get(shard, 0), 'workmen': workmen})
+    return status
+
+
+def _route_request():
+    view_args = request.view_args or {}
+    trn = next((view_args[name] for name in TRN_VIEW_ARGS if name in view_args), None)
+    if trn is not None:
+        route_to_workman(trn, write=request.method not in SAFE_METHODS)
+
+
+def _shard_locked(e):
+    message = 'This company is being moved to another database, please try again shortly'
+    headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), 503, headers
+    return message, 503, headers
+
+
+@click.command('move-company')
+@click.argument('company')
+@click.argument('shard')
+@click.option('--batch-size', type=int, default=None, help='Workmen copied per transaction')
+def move_company_command(company, shard, batch_size):
+    """Move COMPANY (name or id) and its workmen to SHARD"""
+    row = db.session.get(Company, int(company)) if company.isdigit() else Company.find_by_name(company)
+    if row is None:
+        raise click.ClickException(f"Unknown company: {company}")
+    try:
+        moved = move_company(row.id, shard, batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Moved {moved} workmen of {row.name} to {shard}")
+
+
+@click.command('shard-status')
+def shard_status_command():
+    """Show companies and workmen per shard"""
+    for entry in shard_status():
+        click.echo(f"{entry['shard']}: {entry['companies']} companies, {entry['workmen']} workmen")
+
+
+def init_app(app):
+    """Route requests to their shard and keep the shard map current; no-op without DATABASE_SHARDS"""
+    app.cli.add_command(move_company_command)
+    app.cli.add_command(shard_status_command)
+    if not enabled(app):
+        return
+
+    if not event.contains(RoutingSession, 'after_flush', _track_workmen):
+        event.listen(RoutingSession, 'after_flush', _track_workmen)
+        event.listen(RoutingSession, 'before_commit', _relocate_workmen)
+        for model in (Company, Location):
+            event.listen(model, 'after_insert', _copy_dimension)
+
+    app.before_request(_route_request)
+    app.register_error_handler(ShardLocked, _shard_locked)
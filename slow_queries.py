@@ -0,0 +1,122 @@
+"""Slow query log.
+
+Statements that take at least SLOW_QUERY_THRESHOLD_MS are logged and kept in a
+bounded in-memory ring buffer (newest last) with redacted parameters, the
+endpoint that issued them and, for SELECTs, the query plan: ``EXPLAIN`` on
+PostgreSQL, ``EXPLAIN QUERY PLAN`` on SQLite.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import current_app, has_app_context, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_buffer = deque(maxlen=100)
+
+
+def redact_parameters(parameters):
+    """Replace parameter values with their type names"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact_parameters(value) if isinstance(value, (dict, list, tuple)) else type(value).__name__
+                for value in parameters]
+    return type(parameters).__name__
+
+
+def _explain(conn, statement, parameters):
+    """Query plan for a SELECT, run on a separate raw cursor"""
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        prefix = 'EXPLAIN '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            # A failed EXPLAIN must not abort the caller's transaction
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if dialect == 'postgresql':
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return f'EXPLAIN failed: {e}'
+        if dialect == 'postgresql':
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return '\n'.join(row[0] for row in rows)
+        return '\n'.join(str(row[-1]) for row in rows)
+    finally:
+        cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # On the execution context, not the connection: a failed statement never reaches the after hook
+    context.slow_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'slow_query_start', None)
+    if started is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    if not has_app_context():
+        return
+    config = current_app.config
+    if not config['SLOW_QUERY_ENABLED'] or duration_ms < config['SLOW_QUERY_THRESHOLD_MS']:
+        return
+
+    plan = None
+    if config['SLOW_QUERY_EXPLAIN'] and not executemany \
+            and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        plan = _explain(conn, statement, parameters)
+
+    record = {
+        'recorded_at': datetime.utcnow().isoformat(),
+        'duration_ms': round(duration_ms, 2),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'statement': statement,
+        'parameters': redact_parameters(parameters),
+        'plan': plan,
+    }
+    with _lock:
+        _buffer.append(record)
+    logger.warning("Slow query (%.0f ms) in %s", duration_ms, record['endpoint'],
+                   extra={'duration_ms': record['duration_ms'], 'endpoint': record['endpoint'],
+                          'statement': statement})
+
+
+def recent_slow_queries(limit=None):
+    """Slow queries in the buffer, newest first"""
+    with _lock:
+        records = list(_buffer)
+    records.reverse()
+    return records[:limit] if limit else records
+
+
+def clear_slow_queries():
+    """Empty the buffer"""
+    with _lock:
+        _buffer.clear()
+
+
+def init_app(app):
+    """Size the ring buffer and install the cursor execute listeners"""
+    global _buffer
+    with _lock:
+        if _buffer.maxlen != app.config['SLOW_QUERY_LOG_SIZE']:
+            _buffer = deque(_buffer, maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
@@ -0,0 +1,201 @@
+"""Precomputed report snapshots for the standard periods.
+
+The snapshot builder materializes the report summary (totals and
+per-workman statistics) of the most recently completed yesterday, last week
+(Monday to Sunday), last month and pay period, for everyone and for each
+company and location. Periods are UTC dates, like the stored entries. Report
+requests whose filters are exactly one of those periods, optionally narrowed
+to one company or location, are answered from the snapshot; anything else is
+computed live.
+
+A period's entries keep changing after it ends: shifts open at build time
+close, edge nodes sync late events, stale entries are auto-closed and ledger
+replays rewrite entries. Every check (REPORT_SNAPSHOT_CHECK_SECONDS) hashes
+the ids and times of each period's entries and rebuilds the periods whose
+hash no longer matches the one stored with their snapshot.
+"""
+import click
+import hashlib
+import logging
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import ArchivedTimeEntry, ReportSnapshot, TimeEntry, Workman
+from scheduler import PeriodicTask
+import archive
+import reporting
+import sharding
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('yesterday', 'last_week', 'last_month', 'pay_period')
+
+# Filters a snapshot can stand in for
+SNAPSHOT_FILTERS = {'start_date', 'end_date', 'company_id', 'location_id'}
+
+
+def period_range(period, today, pay_period_days, pay_period_anchor):
+    """Inclusive (start, end) dates of the latest complete period before ``today``"""
+    if period == 'yesterday':
+        day = today - timedelta(days=1)
+        return day, day
+    if period == 'last_week':
+        start = today - timedelta(days=today.weekday() + 7)
+        return start, start + timedelta(days=6)
+    if period == 'last_month':
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    if period == 'pay_period':
+        elapsed = (today - pay_period_anchor).days
+        current_start = pay_period_anchor + timedelta(days=(elapsed // pay_period_days) * pay_period_days)
+        return current_start - timedelta(days=pay_period_days), current_start - timedelta(days=1)
+    raise ValueError(f"Unknown report period: {period}")
+
+
+def current_period_range(period, today=None):
+    """Period range using the app's pay period settings"""
+    return period_range(period, today or datetime.utcnow().date(), current_app.config['PAY_PERIOD_DAYS'],
+                        date.fromisoformat(current_app.config['PAY_PERIOD_ANCHOR']))
+
+
+def apply_period(args):
+    """Copy of request arguments with a ``period`` replaced by its start and end dates"""
+    args = dict(args)
+    period = args.pop('period', None)
+    if period:
+        start, end = current_period_range(period)
+        args['start_date'] = start.isoformat()
+        args['end_date'] = end.isoformat()
+    return args
+
+
+def scope_for(params):
+    if params.get('company_id'):
+        return f"company:{params['company_id']}"
+    if params.get('location_id'):
+        return f"location:{params['location_id']}"
+    return 'all'
+
+
+def find_snapshot(params, today=None):
+    """The snapshot answering these normalized report filters, or None"""
+    if not set(params) <= SNAPSHOT_FILTERS or ('company_id' in params and 'location_id' in params):
+        return None
+    if 'start_date' not in params or 'end_date' not in params:
+        return None
+
+    start = date.fromisoformat(params['start_date'])
+    end = date.fromisoformat(params['end_date'])
+    for period in PERIODS:
+        if current_period_range(period, today) == (start, end):
+            return ReportSnapshot.query.filter_by(period=period, start_date=start, scope=scope_for(params)).first()
+    return None
+
+
+def _shard_digest(start_dt, end_dt, batch_size):
+    digest = hashlib.sha256()
+    for model in (TimeEntry, ArchivedTimeEntry):
+        # Joined to workmen so that deleting one also changes the digest
+        rows = db.session.execute(
+            select(model.id, model.clock_in, model.clock_out).join(Workman, Workman.trn == model.workman_trn)
+            .where(model.clock_in >= start_dt, model.clock_in < end_dt).order_by(model.id)
+            .execution_options(yield_per=batch_size))
+        for row in rows:
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def source_digest(start, end, batch_size=5000):
+    """Fingerprint of the entries a period's report reads, across shards.
+
+    Changes whenever one of them is added, closed, edited or deleted.
+    """
+    start_dt, end_dt = archive.parse_date_range(start.isoformat(), end.isoformat())
+    parts = sharding.gather(_shard_digest, start_dt, end_dt, batch_size)
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def _store(period, start, end, scope, entries, digest):
+    db.session.add(ReportSnapshot(period=period, scope=scope, start_date=start, end_date=end,
+                                  summary=ReportSnapshot.compress(reporting.summary_data(entries)),
+                                  source_digest=digest))
+
+
+def build_snapshots(today=None, force=False):
+    """Build the snapshots of every standard period that is missing or out of date.
+
+    Each period's entries are read once and split per company and location in
+    memory. Returns the number of periods built.
+    """
+    built = 0
+    for period in PERIODS:
+        start, end = current_period_range(period, today)
+        digest = source_digest(start, end)
+        current = ReportSnapshot.query.filter_by(period=period, start_date=start, scope='all').first()
+        if not force and current and current.source_digest == digest:
+            continue
+
+        entries = reporting.report_entries({'start_date': start.isoformat(), 'end_date': end.isoformat()})
+        by_company = {}
+        by_location = {}
+        for entry in entries:
+            by_company.setdefault(entry.workman.company_id, []).append(entry)
+            by_location.setdefault(entry.workman.location_id, []).append(entry)
+
+        # Every scope is replaced; companies and locations left without entries lose theirs
+        db.session.execute(delete(ReportSnapshot).where(ReportSnapshot.period == period,
+                                                       ReportSnapshot.start_date == start))
+        _store(period, start, end, 'all', entries, digest)
+        for company_id, subset in by_company.items():
+            _store(period, start, end, f'company:{company_id}', subset, digest)
+        for location_id, subset in by_location.items():
+            _store(period, start, end, f'location:{location_id}', subset, digest)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker built the same period at the same time
+            db.session.rollback()
+            continue
+        built += 1
+        logger.info("Built %s report snapshots for %s to %s", period, start, end)
+    return built
+
+
+def prune_snapshots(retention_days):
+    """Delete snapshots of periods that ended more than ``retention_days`` ago"""
+    cutoff = datetime.utcnow().date() - timedelta(days=retention_days)
+    deleted = db.session.execute(delete(ReportSnapshot).where(ReportSnapshot.end_date < cutoff)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def run_snapshot_job(app):
+    """Build missing and out of date snapshots and prune old ones"""
+    built = build_snapshots()
+    prune_snapshots(app.config['REPORT_SNAPSHOT_RETENTION_DAYS'])
+    return built
+
+
+@click.command('build-report-snapshots')
+@click.option('--force', is_flag=True, help='Rebuild snapshots that already exist')
+@click.option('--date', 'today', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Build the periods as of this day instead of today')
+def build_snapshots_command(force, today):
+    """Precompute the standard report periods"""
+    built = build_snapshots(today.date() if today else None, force=force)
+    click.echo(f"Built snapshots for {built} periods")
+
+
+def init_app(app):
+    """Register the CLI command and start the snapshot builder"""
+    app.cli.add_command(build_snapshots_command)
+
+    if app.config['REPORT_SNAPSHOTS_ENABLED']:
+        # Checks regularly; builds new periods and rebuilds those whose entries changed
+        task = PeriodicTask('report-snapshots', app.config['REPORT_SNAPSHOT_CHECK_SECONDS'],
+                            lambda: run_snapshot_job(app), app=app)
+        task.start_on_first_request(app)
+        app.extensions['report_snapshots'] = task
@@ -0,0 +1,153 @@
+import click
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_
+from app import db
+from models import TimeEntry
+from scheduler import PeriodicTask
+import clock_ledger
+import sharding
+
+logger = logging.getLogger(__name__)
+
+AUTO_CLOSE_MARKER = '[auto-closed]'
+FLAG_MARKER = '[flagged: missing clock-out]'
+
+# Summary of the most recent run, exposed through the admin API
+last_run = {}
+
+
+def stale_cutoff(max_shift_hours):
+    """Clock-in time before which an open entry counts as stale"""
+    return datetime.utcnow() - timedelta(hours=max_shift_hours)
+
+
+def stale_entries_query(max_shift_hours):
+    """Open entries older than the max shift.
+
+    Filters on ``clock_out IS NULL`` and a ``clock_in`` range so the planner can
+    answer it from the open-entry partial index instead of scanning the table.
+    Entries that were already flagged are skipped.
+    """
+    return db.session.query(TimeEntry).filter(
+        TimeEntry.clock_out.is_(None),
+        TimeEntry.clock_in < stale_cutoff(max_shift_hours),
+        or_(TimeEntry.notes.is_(None), ~TimeEntry.notes.contains(FLAG_MARKER))
+    )
+
+
+def find_stale_entries(max_shift_hours, limit=50):
+    """Return the oldest stale open entries"""
+    return stale_entries_query(max_shift_hours).order_by(TimeEntry.clock_in).limit(limit).all()
+
+
+def count_stale_entries(max_shift_hours):
+    """Count stale open entries"""
+    return stale_entries_query(max_shift_hours).with_entities(func.count(TimeEntry.id)).scalar()
+
+
+def count_open_entries():
+    """Count all open entries"""
+    return db.session.query(func.count(TimeEntry.id)).filter(TimeEntry.clock_out.is_(None)).scalar()
+
+
+def _append_note(entry, note):
+    if entry.notes:
+        entry.notes += f" | {note}"
+    else:
+        entry.notes = note
+
+
+def resolve_stale_entries(max_shift_hours, action='close', batch_size=500, max_batches=None):
+    """Close or flag stale open entries in batches.
+
+    ``close`` sets ``clock_out`` to ``clock_in`` plus the max shift so a forgotten
+    clock-out never counts for more than one shift. ``flag`` leaves the entry open
+    and only marks it in the notes. Each batch is committed on its own to keep
+    transactions short.
+    """
+    if action not in ('close', 'flag'):
+        raise ValueError(f"Unknown stale entry action: {action}")
+
+    started_at = datetime.utcnow()
+    processed = 0
+    batches = 0
+    max_shift = timedelta(hours=max_shift_hours)
+
+    while max_batches is None or batches < max_batches:
+        # Workmen of a company being moved to another shard are left for the next run
+        entries = (stale_entries_query(max_shift_hours).filter(sharding.unlocked_workmen(TimeEntry.workman_trn))
+                   .order_by(TimeEntry.clock_in).limit(batch_size).all())
+        if not entries:
+            break
+
+        events = []
+        for entry in entries:
+            if action == 'close':
+                entry.clock_out = entry.clock_in + max_shift
+                note = f"{AUTO_CLOSE_MARKER} no clock-out after {max_shift_hours:g}h"
+                events.append((entry.workman_trn, clock_ledger.CLOCK_OUT, entry.clock_out, note))
+            else:
+                note = FLAG_MARKER
+                events.append((entry.workman_trn, clock_ledger.NOTE, datetime.utcnow(), note))
+            _append_note(entry, note)
+
+        db.session.commit()
+        for trn, event_action, occurred_at, note in events:
+            clock_ledger.record(trn, event_action, 'system', 'stale-entries', occurred_at, notes=note)
+        processed += len(entries)
+        batches += 1
+
+        if len(entries) < batch_size:
+            break
+
+    last_run.update({
+        'action': action,
+        'max_shift_hours': max_shift_hours,
+        'processed': processed,
+        'batches': batches,
+        'started_at': started_at.isoformat(),
+        'finished_at': datetime.utcnow().isoformat()
+    })
+
+    if processed:
+        logger.info("Stale entry job %s %s entries in %s batches", action, processed, batches)
+    return processed
+
+
+def run_stale_entry_job(app):
+    """Run one pass of the stale entry job on every shard with the app's configuration"""
+    return sum(sharding.gather(
+        resolve_stale_entries,
+        app.config['STALE_ENTRY_MAX_SHIFT_HOURS'],
+        action=app.config['STALE_ENTRY_ACTION'],
+        batch_size=app.config['STALE_ENTRY_BATCH_SIZE']
+    ))
+
+
+@click.command('resolve-stale-entries')
+@click.option('--action', type=click.Choice(['close', 'flag']), default=None,
+              help='Override the configured action')
+@click.option('--max-shift-hours', type=float, default=None,
+              help='Override the configured maximum shift length')
+def resolve_stale_entries_command(action, max_shift_hours):
+    """Close or flag open time entries that were never clocked out"""
+    from flask import current_app
+    processed = sum(sharding.gather(
+        resolve_stale_entries,
+        max_shift_hours or current_app.config['STALE_ENTRY_MAX_SHIFT_HOURS'],
+        action=action or current_app.config['STALE_ENTRY_ACTION'],
+        batch_size=current_app.config['STALE_ENTRY_BATCH_SIZE']
+    ))
+    click.echo(f"Processed {processed} stale entries")
+
+
+def init_app(app):
+    """Register the CLI command and start the periodic job"""
+    app.cli.add_command(resolve_stale_entries_command)
+
+    if app.config['STALE_ENTRY_JOB_ENABLED']:
+        task = PeriodicTask('stale-entry-job', app.config['STALE_ENTRY_INTERVAL_SECONDS'],
+                            lambda: run_stale_entry_job(app), app=app)
+        task.start_on_first_request(app)
+        app.extensions['stale_entry_job'] = task
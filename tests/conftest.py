@@ -0,0 +1,42 @@
+import pytest
+from app import create_app, db, init_db
+from models import User, UserRole
+
+
+@pytest.fixture
+def app_config():
+    """Extra settings for the app; override in a test module to change them"""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'workmen.db'}",
+        'RATE_LIMIT_STORAGE': 'memory',
+        'STALE_ENTRY_JOB_ENABLED': False,
+        **app_config,
+    })
+    with app.app_context():
+        init_db()
+        user = User(username='admin', email='admin@example.com', role=UserRole.ADMIN)
+        user.set_password('password123')
+        db.session.add(user)
+        db.session.commit()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(client):
+    response = client.post('/api/v1/auth/token', json={'username': 'admin', 'password': 'password123'})
+    return {'Authorization': f"Bearer {response.json['token']}"}
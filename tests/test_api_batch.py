@@ -0,0 +1,85 @@
+import pytest
+from sqlalchemy import func, select
+from app import db
+from models import BackgroundJob, ClockEvent, TimeEntry, Workman
+import clock_ledger
+import jobs
+
+
+def _create_workman(client, headers, trn):
+    response = client.post('/api/v1/workmen', headers=headers,
+                           json={'trn': trn, 'name': f'Workman {trn}', 'company': 'Acme', 'location': 'Site A'})
+    assert response.status_code == 201
+
+
+def _counts(app):
+    with app.app_context():
+        clock_ledger.ledger().flush()
+        return (db.session.scalar(select(func.count()).select_from(TimeEntry)),
+                db.session.scalar(select(func.count()).select_from(ClockEvent)))
+
+
+@pytest.mark.parametrize('durability', [clock_ledger.BUFFERED, clock_ledger.SYNC])
+def test_rolled_back_atomic_batch_records_no_clock_events(app, client, auth_headers, durability):
+    app.extensions['clock_ledger'].durability = durability
+    _create_workman(client, auth_headers, 'T1')
+
+    response = client.post('/api/v1/batch', headers=auth_headers, json={'atomic': True, 'operations': [
+        {'method': 'POST', 'path': '/workmen/T1/clock-in', 'body': {}},
+        {'method': 'GET', 'path': '/workmen/NOPE'},
+        {'method': 'POST', 'path': '/workmen', 'body': {'trn': 'T2', 'name': 'Two', 'company': 'Acme',
+                                                        'location': 'Site A'}},
+    ]})
+
+    assert response.status_code == 200
+    assert response.json['committed'] is False
+    assert [result['status'] for result in response.json['results']] == [200, 404, 424]
+    assert _counts(app) == (0, 0)
+
+
+@pytest.mark.parametrize('durability', [clock_ledger.BUFFERED, clock_ledger.SYNC])
+def test_committed_atomic_batch_records_its_clock_events(app, client, auth_headers, durability):
+    app.extensions['clock_ledger'].durability = durability
+    _create_workman(client, auth_headers, 'T1')
+
+    response = client.post('/api/v1/batch', headers=auth_headers, json={'atomic': True, 'operations': [
+        {'method': 'POST', 'path': '/workmen/T1/clock-in', 'body': {}},
+        {'method': 'POST', 'path': '/workmen/T1/clock-out', 'body': {}},
+    ]})
+
+    assert response.json['committed'] is True
+    assert [result['status'] for result in response.json['results']] == [200, 200]
+    assert _counts(app) == (1, 2)
+
+
+def test_atomic_batch_starts_its_jobs_after_the_commit(app, client, auth_headers, monkeypatch):
+    app.config['WORKMAN_DELETE_MODE'] = 'soft'
+    _create_workman(client, auth_headers, 'T1')
+    visible = []
+    run_job = jobs.run_job
+
+    def checked_run_job(app, job_id):
+        # The worker's own session must already see the job row
+        with app.app_context():
+            visible.append(db.session.get(BackgroundJob, job_id) is not None)
+        run_job(app, job_id)
+
+    monkeypatch.setattr(jobs, 'run_job', checked_run_job)
+
+    response = client.post('/api/v1/batch', headers=auth_headers, json={'atomic': True, 'operations': [
+        {'method': 'DELETE', 'path': '/workmen/T1'},
+        {'method': 'POST', 'path': '/reports/jobs', 'body': {'kind': 'report'}},
+    ]})
+
+    assert response.json['committed'] is True
+    assert [result['status'] for result in response.json['results']] == [200, 202]
+    # Wait for the jobs; the next submit starts a fresh pool
+    jobs._executor().shutdown(wait=True)
+    jobs._pool.executor = None
+    assert visible == [True, True]
+    with app.app_context():
+        statuses = db.session.scalars(select(BackgroundJob.status)).all()
+        assert statuses == [jobs.SUCCEEDED, jobs.SUCCEEDED]
+        # The purge saw the committed deleted_at
+        assert db.session.scalar(select(func.count()).select_from(Workman)
+                                 .execution_options(include_deleted=True)) == 0
@@ -0,0 +1,28 @@
+from sqlalchemy import func, select
+from app import db
+from models import ApiToken
+
+
+def _sign_in(client, **extra):
+    response = client.post('/api/v1/auth/token', headers={'User-Agent': 'okhttp/4.12'},
+                           json={'username': 'admin', 'password': 'password123', **extra})
+    return response.json
+
+
+def _token_rows(app):
+    with app.app_context():
+        return db.session.scalar(select(func.count()).select_from(ApiToken))
+
+
+def test_unnamed_sign_ins_reuse_one_token(app, client):
+    first, second = _sign_in(client), _sign_in(client)
+    assert first['token'] == second['token']
+    assert _token_rows(app) == 1
+
+
+def test_named_devices_get_their_own_tokens(app, client):
+    phone, tablet = _sign_in(client, device='phone'), _sign_in(client, device='tablet')
+    assert phone['token'] != tablet['token']
+    assert phone['token'] != _sign_in(client)['token']
+    assert _sign_in(client, device='phone')['token'] == phone['token']
+    assert _token_rows(app) == 3
@@ -0,0 +1,79 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import select
+from app import db
+from models import Company, TimeEntry, AttendanceBitmap
+import attendance
+
+START = date(2026, 3, 2)
+
+
+def add_workman(client, auth_headers, trn, company='Acme'):
+    client.post('/api/v1/workmen', headers=auth_headers,
+                json={'trn': trn, 'name': trn, 'company': company, 'location': 'Site A'})
+
+
+def clock_in(trn, *days):
+    """Completed entries of ``trn`` on the given offsets from START"""
+    for offset in days:
+        clock_in = datetime.combine(START + timedelta(days=offset), datetime.min.time()) + timedelta(hours=8)
+        db.session.add(TimeEntry(workman_trn=trn, clock_in=clock_in, clock_out=clock_in + timedelta(hours=8)))
+        db.session.commit()
+
+
+def window_args(days=7, **args):
+    return {'start_date': START.isoformat(), 'end_date': (START + timedelta(days=days - 1)).isoformat(), **args}
+
+
+def test_clock_ins_set_their_day_bit(app, client, auth_headers):
+    add_workman(client, auth_headers, 'T1')
+    with app.app_context():
+        clock_in('T1', 3, 5, 5)
+        row = db.session.get(AttendanceBitmap, 'T1')
+        assert (row.start_day, row.bits) == (START + timedelta(days=3), bytes([0b101]))
+
+        # An earlier day moves the start of the bitmap back
+        clock_in('T1', 0, 1)
+        db.session.expire_all()
+        row = db.session.get(AttendanceBitmap, 'T1')
+        assert (row.start_day, row.bits) == (START, bytes([0b101011]))
+
+    response = client.get('/api/v1/workmen/T1/attendance', headers=auth_headers, query_string=window_args())
+    assert response.status_code == 200
+    assert response.json['days'] == [(START + timedelta(days=offset)).isoformat() for offset in (0, 1, 3, 5)]
+    assert (response.json['days_worked'], response.json['longest_streak']) == (4, 2)
+
+
+def test_days_attended_by_all_or_any_workmen(app, client, auth_headers):
+    for trn in ('T1', 'T2'):
+        add_workman(client, auth_headers, trn)
+    add_workman(client, auth_headers, 'T3', company='Other')
+    with app.app_context():
+        clock_in('T1', 0, 1, 2)
+        clock_in('T2', 1, 2, 3)
+        clock_in('T3', 6)
+        acme = db.session.scalar(select(Company.id).where(Company.name == 'Acme'))
+
+    def days(**args):
+        response = client.get('/api/v1/attendance/days', headers=auth_headers, query_string=window_args(**args))
+        assert response.status_code == 200
+        return [date.fromisoformat(day) - START for day in response.json['days']]
+
+    assert days(company_id=acme) == [timedelta(days=1), timedelta(days=2)]
+    assert days(op='any', company_id=acme) == [timedelta(days=offset) for offset in range(4)]
+    assert days() == []
+    assert days(op='any') == [timedelta(days=offset) for offset in (0, 1, 2, 3, 6)]
+
+    response = client.get('/api/v1/attendance', headers=auth_headers, query_string=window_args(days=3))
+    assert {row['trn']: (row['days_worked'], row['every_day']) for row in response.json['workmen']} \
+        == {'T1': (3, True), 'T2': (2, False), 'T3': (0, False)}
+    assert client.get('/api/v1/attendance/days', headers=auth_headers,
+                      query_string={'op': 'none'}).status_code == 400
+
+
+def test_rebuild_matches_the_clock_in_hook(app, client, auth_headers):
+    add_workman(client, auth_headers, 'T1')
+    with app.app_context():
+        clock_in('T1', 4, 0, 2)
+        expected = db.session.get(AttendanceBitmap, 'T1').bits
+        assert attendance.rebuild_bitmaps() == 1
+        assert db.session.get(AttendanceBitmap, 'T1').bits == expected == bytes([0b10101])
@@ -0,0 +1,60 @@
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from app import db
+from models import ClockEvent, TimeEntry
+import clock_ledger
+
+
+def test_replay_keeps_entries_older_than_the_ledger(app, client, auth_headers):
+    client.post('/api/v1/workmen', headers=auth_headers,
+                json={'trn': 'T1', 'name': 'One', 'company': 'Acme', 'location': 'Site A'})
+    with app.app_context():
+        # Written before the ledger existed: no events cover it
+        old_in = datetime.utcnow() - timedelta(hours=5)
+        db.session.add(TimeEntry(workman_trn='T1', clock_in=old_in, clock_out=old_in + timedelta(hours=1)))
+        db.session.commit()
+
+    client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={})
+    client.post('/api/v1/workmen/T1/clock-out', headers=auth_headers, json={})
+
+    with app.app_context():
+        clock_ledger.ledger().flush()
+        workmen, written = clock_ledger.replay(since=datetime.utcnow() - timedelta(days=365))
+        assert (workmen, written) == (1, 1)
+        clock_ins = db.session.scalars(select(TimeEntry.clock_in).order_by(TimeEntry.clock_in)).all()
+        assert len(clock_ins) == 2
+        assert clock_ins[0] == old_in
+
+
+def test_sync_ledger_failure_does_not_fail_a_recorded_clock_in(app, client, auth_headers):
+    app.extensions['clock_ledger'].durability = clock_ledger.SYNC
+    client.post('/api/v1/workmen', headers=auth_headers,
+                json={'trn': 'T1', 'name': 'One', 'company': 'Acme', 'location': 'Site A'})
+    with app.app_context():
+        ClockEvent.__table__.drop(db.engine)
+    try:
+        response = client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={})
+        assert response.status_code == 200
+        # Kept for the flusher to retry
+        assert len(app.extensions['clock_ledger']) == 1
+    finally:
+        with app.app_context():
+            ClockEvent.__table__.create(db.engine)
+            assert clock_ledger.ledger().flush() == 1
+            assert db.session.scalar(select(func.count()).select_from(TimeEntry)) == 1
+
+
+def test_flusher_backs_off_while_the_database_fails(app):
+    ledger = clock_ledger.ClockLedger(app, buffer_size=10, batch_size=1, flush_interval=0.05,
+                                      durability=clock_ledger.BUFFERED)
+    with app.app_context():
+        ClockEvent.__table__.drop(db.engine)
+    try:
+        ledger.record(clock_ledger.make_event('T1', clock_ledger.CLOCK_IN, 'admin', 'api', datetime.utcnow()))
+        time.sleep(0.5)
+        # A full buffer used to retry in a tight loop
+        assert 1 <= ledger.flush_failures <= 5
+    finally:
+        with app.app_context():
+            ClockEvent.__table__.create(db.engine)
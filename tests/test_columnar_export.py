@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+import pytest
+from app import db
+from models import Workman, TimeEntry
+import columnar_export
+
+pytest.importorskip('numpy')
+
+
+def test_export_rewrites_a_month_exported_while_it_was_running(app, tmp_path):
+    with app.app_context():
+        last_month = (datetime.utcnow().replace(day=1) - timedelta(days=1)).replace(day=10, hour=8)
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        db.session.add(TimeEntry(workman_trn='T1', clock_in=last_month, clock_out=last_month + timedelta(hours=1)))
+        db.session.commit()
+
+        month = f'{last_month:%Y-%m}'
+        assert month in columnar_export.export(tmp_path)
+        # As left by an export run during that month
+        manifest, dictionaries = columnar_export._load_state(tmp_path)
+        manifest['months'][month]['complete'] = False
+        columnar_export._save_state(tmp_path, manifest, dictionaries)
+
+        assert month in columnar_export.export(tmp_path)
+        assert month not in columnar_export.export(tmp_path)
+
+
+def test_export_rewrites_a_month_while_it_has_open_entries(app, tmp_path):
+    with app.app_context():
+        last_month = (datetime.utcnow().replace(day=1) - timedelta(days=1)).replace(hour=22)
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        entry = TimeEntry(workman_trn='T1', clock_in=last_month)
+        db.session.add(entry)
+        db.session.commit()
+
+        month = f'{last_month:%Y-%m}'
+        assert month in columnar_export.export(tmp_path)
+        # Still open: exported again
+        assert month in columnar_export.export(tmp_path)
+
+        entry.clock_out = last_month + timedelta(hours=8)
+        db.session.commit()
+        assert month in columnar_export.export(tmp_path)
+        assert month not in columnar_export.export(tmp_path)
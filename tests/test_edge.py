@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+from app import db
+from models import ClockEvent, Workman
+import edge
+
+
+def _event(id, event_id):
+    return ClockEvent(id=id, event_id=event_id, workman_trn='T1', action='clock_in', actor='admin',
+                      source='api', occurred_at=datetime.utcnow())
+
+
+def test_pull_resends_rows_committed_behind_the_cursors(app):
+    with app.app_context():
+        now = datetime.utcnow()
+        db.session.add_all([_event(1, 'e1'), _event(3, 'e3'),
+                            Workman(trn='T2', name='Two', company='Acme', location='Site A', updated_at=now)])
+        db.session.commit()
+        first = edge.build_pull('site-a')
+        assert [row['event_id'] for row in first['events']] == ['e1', 'e3']
+
+        # Transactions that got the lower id and an earlier updated_at commit late
+        db.session.add_all([_event(2, 'e2'),
+                            Workman(trn='T1', name='One', company='Acme', location='Site A',
+                                    updated_at=now - timedelta(seconds=1))])
+        db.session.commit()
+        second = edge.build_pull('site-a', events_after=first['events_cursor'],
+                                 workmen_cursor=first['workmen_cursor'])
+        assert 'e2' in [row['event_id'] for row in second['events']]
+        assert 'T1' in [row['trn'] for row in second['workmen']]
+        assert second['events_cursor'] is None and second['workmen_cursor'] is None
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+from app import db
+from models import BackgroundJob
+import jobs
+
+
+def _wait_for_jobs():
+    # The next submit starts a fresh pool
+    jobs._executor().shutdown(wait=True)
+    jobs._pool.executor = None
+
+
+def test_large_report_runs_as_a_job(client, auth_headers):
+    response = client.get('/api/v1/reports', headers=auth_headers)
+    assert response.status_code == 202
+    assert response.json['kind'] == 'report_summary'
+    _wait_for_jobs()
+
+    result = client.get(f"{response.headers['Location']}/result", headers=auth_headers)
+    assert result.status_code == 200
+    assert result.json['totals']['completed_sessions'] == 0
+
+    day = f'{datetime.utcnow():%Y-%m-%d}'
+    response = client.get(f'/api/v1/reports?start_date={day}', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json['source'] == 'live'
+
+
+def test_job_of_a_dead_process_is_not_reused(app):
+    with app.app_context():
+        params = {'start_date': '2025-01-01'}
+        stale = datetime.utcnow() - timedelta(seconds=app.config['JOBS_CLAIM_TIMEOUT_SECONDS'] + 1)
+        db.session.add(BackgroundJob(id='dead', kind='report', params_json='{}', status=jobs.RUNNING,
+                                     cache_key=jobs.cache_key('report', params), heartbeat_at=stale))
+        db.session.commit()
+
+        job = jobs.submit('report', params)
+        assert job.id != 'dead'
+        _wait_for_jobs()
+        jobs.evict_expired(app.config['JOBS_TIMEOUT_SECONDS'])
+        assert db.session.get(BackgroundJob, 'dead').status == jobs.FAILED
+        assert db.session.get(BackgroundJob, job.id).status == jobs.SUCCEEDED
+
+
+def test_heartbeat_keeps_pending_jobs_alive(app):
+    with app.app_context():
+        stale = datetime.utcnow() - timedelta(minutes=5)
+        db.session.add(BackgroundJob(id='mine', kind='report', params_json='{}', status=jobs.QUEUED,
+                                     cache_key='key', heartbeat_at=stale))
+        db.session.commit()
+        jobs._pool.active.add('mine')
+        try:
+            jobs.send_heartbeat()
+        finally:
+            jobs._pool.active.discard('mine')
+        db.session.expire_all()
+        assert db.session.get(BackgroundJob, 'mine').heartbeat_at > stale
+        assert jobs.find_reusable_job('key').id == 'mine'
@@ -0,0 +1,43 @@
+import pytest
+import rate_limit
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return rate_limit.MemoryBucketStore(max_keys=100)
+    return rate_limit.SQLiteBucketStore(str(tmp_path / 'buckets.sqlite3'), max_keys=100)
+
+
+def test_bucket_empties_and_refills(store):
+    capacity, rate = rate_limit.parse_limit('2/10')
+    assert store.take('user:a', capacity, rate, 1000.0) == (True, 0.0)
+    assert store.take('user:a', capacity, rate, 1000.0) == (True, 0.0)
+    allowed, retry_after = store.take('user:a', capacity, rate, 1000.0)
+    assert not allowed and retry_after == pytest.approx(5.0)
+    # Other keys have their own bucket
+    assert store.take('user:b', capacity, rate, 1000.0)[0]
+    # One token comes back every 5 seconds, and never more than the capacity
+    assert store.take('user:a', capacity, rate, 1005.0)[0]
+    assert not store.take('user:a', capacity, rate, 1005.0)[0]
+    assert store.take('user:a', capacity, rate, 2000.0)[0]
+    assert store.take('user:a', capacity, rate, 2000.0)[0]
+    assert not store.take('user:a', capacity, rate, 2000.0)[0]
+
+
+@pytest.mark.parametrize('storage', ['memory', 'sqlite'])
+def test_token_requests_over_the_limit_get_429(app, client, tmp_path, storage):
+    app.config.update(RATE_LIMIT_USERNAME='2/60',
+                      RATE_LIMIT_STORAGE='memory' if storage == 'memory' else str(tmp_path / 'buckets.sqlite3'))
+    app.extensions['rate_limiter'] = rate_limit.create_limiter(app.config)
+
+    def sign_in(username='admin'):
+        return client.post('/api/v1/auth/token', json={'username': username, 'password': 'wrong'})
+
+    assert [sign_in().status_code for _ in range(2)] == [401, 401]
+    response = sign_in()
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 30
+    # The bucket is per username, and usernames are case-insensitive
+    assert sign_in('ADMIN ').status_code == 429
+    assert sign_in('someone-else').status_code == 401
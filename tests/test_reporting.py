@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from app import db
+from models import Workman, TimeEntry
+import archive
+import reporting
+
+
+def test_report_without_start_date_counts_the_archive_from_daily_summaries(app):
+    with app.app_context():
+        old = datetime.utcnow() - timedelta(days=800)
+        recent = datetime.utcnow() - timedelta(days=1)
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        db.session.add_all([TimeEntry(workman_trn='T1', clock_in=old, clock_out=old + timedelta(hours=2)),
+                            TimeEntry(workman_trn='T1', clock_in=recent, clock_out=recent + timedelta(hours=3))])
+        db.session.commit()
+        assert archive.archive_time_entries(12) == 1
+
+        report = reporting.build_report({})
+        assert len(report['time_entries']) == 1
+        assert report['totals']['total_hours'] == 5
+        assert report['totals']['completed_sessions'] == 2
+        assert report['workmen'][0]['sessions'] == 2
+
+        # An explicit range still lists archived entries
+        ranged = reporting.build_report({'start_date': f'{old:%Y-%m-%d}'})
+        assert len(ranged['time_entries']) == 2
+        assert ranged['totals']['total_hours'] == 5
+        assert reporting.export_csv({}).count('T1') == 2
+
+
+def test_time_history_reaches_the_archive_for_a_date_range(app, client, monkeypatch):
+    import routes
+    rendered = {}
+    monkeypatch.setattr(routes, 'render_template', lambda name, **context: rendered.update(context) or '')
+    app.config['WTF_CSRF_ENABLED'] = False
+    client.post('/auth/login', data={'username': 'admin', 'password': 'password123'})
+    with app.app_context():
+        old = datetime.utcnow() - timedelta(days=800)
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        db.session.add(TimeEntry(workman_trn='T1', clock_in=old, clock_out=old + timedelta(hours=2)))
+        db.session.commit()
+        archive.archive_time_entries(12)
+
+    client.get('/workman/T1/time_history')
+    assert (len(rendered['time_entries']), rendered['total_hours']) == (0, 2)
+    client.get(f'/workman/T1/time_history?start_date={old:%Y-%m-%d}&end_date={old:%Y-%m-%d}')
+    assert (len(rendered['time_entries']), rendered['total_hours']) == (1, 2)
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import func, select
+from app import db
+from db_routing import PRIMARY_SHARD, shard_binds
+from models import Company, CompanyShard, Workman, TimeEntry, AttendanceBitmap
+import archive
+import sharding
+import stale_entries
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {
+        'SQLALCHEMY_BINDS': shard_binds(f"east=sqlite:///{tmp_path / 'east.db'}"),
+        'SHARD_MOVE_GRACE_SECONDS': 0,
+    }
+
+
+def stored(app, shard):
+    """(workmen, time entries, attendance bitmaps) stored on a shard"""
+    with app.app_context(), sharding.engine_for(shard).connect() as conn:
+        return tuple(conn.scalar(select(func.count()).select_from(model.__table__))
+                     for model in (Workman, TimeEntry, AttendanceBitmap))
+
+
+def add_workman(client, auth_headers, trn='T1', company='Acme'):
+    response = client.post('/api/v1/workmen', headers=auth_headers,
+                           json={'trn': trn, 'name': trn, 'company': company, 'location': 'Site A'})
+    assert response.status_code == 201
+
+
+def company_id(name='Acme'):
+    return db.session.scalar(select(Company.id).where(Company.name == name))
+
+
+def test_move_company_copies_history_and_switches_routing(app, client, auth_headers):
+    add_workman(client, auth_headers)
+    client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={})
+    client.post('/api/v1/workmen/T1/clock-out', headers=auth_headers, json={})
+    with app.app_context():
+        assert sharding.shard_for_trn('T1') == ('east', False)
+    assert stored(app, 'east') == (1, 1, 1)
+    assert stored(app, PRIMARY_SHARD) == (0, 0, 0)
+
+    with app.app_context():
+        assert sharding.move_company(company_id(), PRIMARY_SHARD) == 1
+        assert sharding.shard_for_trn('T1') == (PRIMARY_SHARD, False)
+    assert stored(app, PRIMARY_SHARD) == (1, 1, 1)
+    assert stored(app, 'east') == (0, 0, 0)
+
+    # Requests for the workman now read and write the primary
+    assert client.get('/api/v1/workmen/T1', headers=auth_headers).json['company'] == 'Acme'
+    assert client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={}).status_code == 200
+    assert len(client.get('/api/v1/workmen/T1/time-entries', headers=auth_headers).json['time_entries']) == 2
+    assert stored(app, PRIMARY_SHARD)[1] == 2
+
+
+def test_writes_to_a_company_being_moved_are_refused(app, client, auth_headers):
+    add_workman(client, auth_headers)
+    with app.app_context():
+        db.session.get(CompanyShard, company_id()).locked_at = datetime.utcnow()
+        db.session.commit()
+
+    response = client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(sharding.RETRY_AFTER_SECONDS)
+    assert client.get('/api/v1/workmen/T1', headers=auth_headers).status_code == 200
+
+
+def test_background_jobs_leave_companies_being_moved_alone(app, client, auth_headers):
+    add_workman(client, auth_headers)
+    old = datetime.utcnow() - timedelta(days=400)
+    with app.app_context():
+        sharding.route_to_workman('T1')
+        db.session.add_all([TimeEntry(workman_trn='T1', clock_in=old, clock_out=old + timedelta(hours=8)),
+                            TimeEntry(workman_trn='T1', clock_in=old + timedelta(days=1))])
+        db.session.get(CompanyShard, company_id()).locked_at = datetime.utcnow()
+        db.session.commit()
+
+    with app.app_context():
+        assert sum(sharding.gather(stale_entries.resolve_stale_entries, 16)) == 0
+        assert sum(sharding.gather(archive.archive_time_entries, 1)) == 0
+
+        db.session.get(CompanyShard, company_id()).locked_at = None
+        db.session.commit()
+        assert sum(sharding.gather(stale_entries.resolve_stale_entries, 16)) == 1
+        assert sum(sharding.gather(archive.archive_time_entries, 1)) == 2
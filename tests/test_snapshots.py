@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from app import db
+from models import Workman, TimeEntry
+import snapshots
+
+
+def _yesterday_at(hour):
+    yesterday = datetime.utcnow().date() - timedelta(days=1)
+    return datetime(yesterday.year, yesterday.month, yesterday.day, hour)
+
+
+def test_snapshot_is_rebuilt_when_its_entries_change(app, client, auth_headers):
+    with app.app_context():
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        entry = TimeEntry(workman_trn='T1', clock_in=_yesterday_at(20))
+        db.session.add(entry)
+        db.session.commit()
+        entry_id = entry.id
+        assert snapshots.build_snapshots() == len(snapshots.PERIODS)
+        # Nothing changed: nothing is rebuilt
+        assert snapshots.build_snapshots() == 0
+
+    response = client.get('/api/v1/reports?period=yesterday', headers=auth_headers)
+    assert response.json['source'] == 'snapshot'
+    assert response.json['totals'] == {'total_hours': 0, 'completed_sessions': 0, 'active_sessions': 1}
+
+    with app.app_context():
+        # The overnight shift closes after the snapshot was built
+        entry = db.session.get(TimeEntry, entry_id)
+        entry.clock_out = entry.clock_in + timedelta(hours=8)
+        db.session.commit()
+        assert snapshots.build_snapshots() >= 1
+
+    response = client.get('/api/v1/reports?period=yesterday', headers=auth_headers)
+    assert response.json['source'] == 'snapshot'
+    assert response.json['totals'] == {'total_hours': 8, 'completed_sessions': 1, 'active_sessions': 0}
+
+
+def test_other_ranges_are_computed_live(app, client, auth_headers):
+    with app.app_context():
+        db.session.add(Workman(trn='T1', name='One', company='Acme', location='Site A'))
+        db.session.add(TimeEntry(workman_trn='T1', clock_in=_yesterday_at(8), clock_out=_yesterday_at(10)))
+        db.session.commit()
+        snapshots.build_snapshots()
+
+    day = f'{_yesterday_at(0):%Y-%m-%d}'
+    response = client.get(f'/api/v1/reports?start_date={day}&end_date={day}&workman=T1', headers=auth_headers)
+    assert response.json['source'] == 'live'
+    assert response.json['totals']['total_hours'] == 2
@@ -0,0 +1,27 @@
+from sqlalchemy import func, select
+from app import db
+from models import Workman, TimeEntry, AttendanceBitmap
+import workman_deletion
+
+
+def test_hard_delete_without_cascading_foreign_keys(app, client, auth_headers):
+    app.config['WORKMAN_DELETE_MODE'] = workman_deletion.HARD
+    client.post('/api/v1/workmen', headers=auth_headers,
+                json={'trn': 'T1', 'name': 'One', 'company': 'Acme', 'location': 'Site A'})
+    client.post('/api/v1/workmen/T1/clock-in', headers=auth_headers, json={})
+    client.post('/api/v1/workmen/T1/clock-out', headers=auth_headers, json={})
+
+    with app.app_context():
+        # A database created before the history tables cascaded
+        db.session.execute(db.text('PRAGMA foreign_keys=OFF'))
+        workman = db.session.scalar(select(Workman).where(Workman.trn == 'T1'))
+        workman.time_entries  # loaded collections must not be deleted twice
+        workman_deletion.delete_workman(workman)
+        assert db.session.scalar(select(func.count()).select_from(Workman)) == 0
+        assert db.session.scalar(select(func.count()).select_from(TimeEntry)) == 0
+        assert db.session.scalar(select(func.count()).select_from(AttendanceBitmap)) == 0
+
+
+def test_purge_jobs_cannot_be_queued_through_the_api(client, auth_headers):
+    response = client.post('/api/v1/reports/jobs', headers=auth_headers, json={'kind': 'workman_purge', 'trn': 'T1'})
+    assert response.status_code == 400
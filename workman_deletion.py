@@ -0,0 +1,157 @@
+"""Deleting workmen without loading their history.
+
+A hard delete removes the history tables and the workman row in one
+transaction. The history tables reference their workman with ON DELETE
+CASCADE, but databases created before that (SQLite cannot alter a foreign
+key) still have the old constraint, so the history is deleted explicitly
+rather than left to the database. For a workman with years of entries that
+is still a few long statements holding locks, so the default soft mode
+instead stamps ``deleted_at``, which hides the workman from every ORM query at
+once, and queues a background job that deletes the history in batches of
+WORKMAN_PURGE_BATCH_SIZE rows, committing between batches, and finally the
+workman row itself.
+
+Queries that need soft deleted workmen (e.g. checking whether a TRN is free)
+opt in with ``execution_options(include_deleted=True)``.
+"""
+import click
+import logging
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import delete, event, select
+from sqlalchemy.orm import Session, with_loader_criteria
+from app import db
+from models import Workman, TimeEntry, ArchivedTimeEntry, DailySummary, AttendanceBitmap
+import sharding
+
+logger = logging.getLogger(__name__)
+
+SOFT = 'soft'
+HARD = 'hard'
+
+# Tables holding a workman's history, with the column each purge batch is picked by
+HISTORY_TABLES = [
+    (TimeEntry, TimeEntry.id),
+    (ArchivedTimeEntry, ArchivedTimeEntry.id),
+    (DailySummary, DailySummary.day),
+    (AttendanceBitmap, AttendanceBitmap.workman_trn),
+]
+
+
+def _hide_deleted_workmen(state):
+    """Add ``deleted_at IS NULL`` to every ORM select involving workmen"""
+    if (state.is_select and not state.is_column_load and not state.is_relationship_load
+            and not state.execution_options.get('include_deleted', False)):
+        state.statement = state.statement.options(
+            with_loader_criteria(Workman, lambda cls: cls.deleted_at.is_(None), include_aliases=True))
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys (and so ON DELETE CASCADE) when asked, per connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def enable_sqlite_foreign_keys(engine):
+    """Turn on foreign key enforcement for every connection of a SQLite engine"""
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _enable_foreign_keys):
+        event.listen(engine, 'connect', _enable_foreign_keys)
+
+
+def submit_purge(workman, user=None):
+    """Queue the background purge of a soft deleted workman"""
+    import jobs
+    # deleted_at keeps a re-created and re-deleted TRN from reusing an earlier purge's cached result
+    return jobs.submit('workman_purge', {'trn': workman.trn, 'deleted_at': workman.deleted_at.isoformat()}, user)
+
+
+def hard_delete_statements(trn):
+    """DELETEs of a workman's history tables and then the workman, run in one transaction"""
+    return [delete(model).where(model.workman_trn == trn).execution_options(synchronize_session=False)
+            for model, _ in HISTORY_TABLES] + [
+        delete(Workman).where(Workman.trn == trn).execution_options(synchronize_session=False)]
+
+
+def delete_workman(workman, user=None):
+    """Delete a workman as configured by WORKMAN_DELETE_MODE and commit"""
+    if current_app.config['WORKMAN_DELETE_MODE'] == HARD:
+        trn = workman.trn
+        # Statements only: loaded history collections would be deleted a second time by the ORM
+        db.session.expunge(workman)
+        for statement in hard_delete_statements(trn):
+            db.session.execute(statement)
+        db.session.commit()
+        return
+
+    workman.deleted_at = datetime.utcnow()
+    db.session.commit()
+    submit_purge(workman, user)
+
+
+def _delete_in_batches(model, key_column, trn, batch_size):
+    total = 0
+    while True:
+        keys = select(key_column).where(model.workman_trn == trn).limit(batch_size)
+        deleted = db.session.execute(
+            delete(model).where(model.workman_trn == trn, key_column.in_(keys))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def purge_workman(trn, batch_size=None):
+    """Delete a soft deleted workman's history in batches, then the workman.
+
+    Does nothing if the workman was not soft deleted. Returns the number of
+    rows deleted per table.
+    """
+    batch_size = batch_size or current_app.config['WORKMAN_PURGE_BATCH_SIZE']
+    sharding.route_to_workman(trn)
+    workman = db.session.scalar(Workman.lookup_including_deleted(trn))
+    if workman is None or workman.deleted_at is None:
+        return {}
+    db.session.expunge(workman)
+
+    counts = {}
+    for model, key_column in HISTORY_TABLES:
+        counts[model.__tablename__] = _delete_in_batches(model, key_column, trn, batch_size)
+    counts[Workman.__tablename__] = db.session.execute(
+        delete(Workman).where(Workman.trn == trn, Workman.deleted_at.is_not(None))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    logger.info("Purged deleted workman %s", trn, extra={'trn': trn, 'deleted_rows': counts})
+    return counts
+
+
+def deleted_workman_trns():
+    return list(db.session.scalars(
+        select(Workman.trn).where(Workman.deleted_at.is_not(None)).execution_options(include_deleted=True)))
+
+
+@click.command('purge-deleted-workmen')
+@click.option('--batch-size', type=int, default=None, help='Rows deleted per transaction')
+def purge_deleted_workmen_command(batch_size):
+    """Purge every soft deleted workman whose background purge did not finish"""
+    trns = [trn for part in sharding.gather(deleted_workman_trns) for trn in part]
+    for trn in trns:
+        purge_workman(trn, batch_size)
+    click.echo(f"Purged {len(trns)} deleted workmen")
+
+
+def init_app(app):
+    """Hide soft deleted workmen, enforce cascades on SQLite and register the CLI"""
+    # On the Session class so the ASGI app's async sessions are covered too
+    if not event.contains(Session, 'do_orm_execute', _hide_deleted_workmen):
+        event.listen(Session, 'do_orm_execute', _hide_deleted_workmen)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            enable_sqlite_foreign_keys(engine)
+
+    app.cli.add_command(purge_deleted_workmen_command)